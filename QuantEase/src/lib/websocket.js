@@ -12,15 +12,39 @@ class MarketDataWebSocket {
     this.reconnectTimeout = null
     this.pingInterval = null
     this.lastPong = null
+    this.connecting = false
+    this.connectAttempt = 0
   }
 
-  connect() {
+  async getAccessToken() {
+    try {
+      const { data: { session } } = await import('./supabase').then(m => m.supabase.auth.getSession())
+      return session?.access_token || null
+    } catch (error) {
+      console.warn('Could not read auth session, connecting anonymously:', error)
+      return null
+    }
+  }
+
+  async connect() {
     // Clear any existing connection
     this.disconnect()
+    const attempt = ++this.connectAttempt
+    this.connecting = true
     
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:'
     // Use backend port (8000) for WebSocket connection
-    const wsUrl = `${protocol}//${window.location.hostname}:8000/api/v1/ws`
+    let wsUrl = `${protocol}//${window.location.hostname}:8000/api/v1/ws`
+    
+    // Signed-in connections are counted per user rather than per address
+    const token = await this.getAccessToken()
+    if (attempt !== this.connectAttempt) {
+      return // Disconnected or reconnected while reading the session
+    }
+    this.connecting = false
+    if (token) {
+      wsUrl += `?token=${encodeURIComponent(token)}`
+    }
     
     try {
       this.ws = new WebSocket(wsUrl)
@@ -54,6 +78,11 @@ class MarketDataWebSocket {
           if (data.type === 'pong') {
             return
           }
+          // Answer server heartbeats so the connection isn't evicted as dead
+          if (data.type === 'heartbeat') {
+            this.ws.send(JSON.stringify({ type: 'pong' }))
+            return
+          }
           this.handleMessage(data)
         } catch (error) {
           console.error('Error parsing WebSocket message:', error, event.data)
@@ -116,6 +145,8 @@ class MarketDataWebSocket {
 
   disconnect() {
     this.stopPing()
+    this.connectAttempt++
+    this.connecting = false
     
     if (this.reconnectTimeout) {
       clearTimeout(this.reconnectTimeout)
@@ -152,7 +183,7 @@ class MarketDataWebSocket {
       this.pendingSubscriptions.add(symbol)
       
       // Try to reconnect if not already attempting to
-      if (!this.reconnectTimeout && this.reconnectAttempts < this.maxReconnectAttempts) {
+      if (!this.reconnectTimeout && !this.connecting && this.reconnectAttempts < this.maxReconnectAttempts) {
         this.connect()
       }
       return
@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Query
+
+from app.services.market_data import market_data_service
+from app.services.tick_history import tick_history_service
+
+router = APIRouter()
+
+
+@router.get("/status")
+async def get_market_data_status():
+    """Get upstream rate limiter and circuit breaker status"""
+    return market_data_service.get_upstream_status()
+
+
+@router.get("/prefetch-status")
+async def get_prefetch_status():
+    """Get hot-symbol prefetcher status"""
+    return market_data_service.get_prefetch_status()
+
+
+@router.get("/ticks/{symbol}")
+async def get_tick_history(symbol: str, minutes: float = Query(30, gt=0, le=1440)):
+    """Get recent intraday ticks for a symbol as compact arrays (t, p, v)"""
+    return tick_history_service.get_history(symbol, minutes)
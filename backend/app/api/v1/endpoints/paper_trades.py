@@ -1,17 +1,21 @@
+import json
 from datetime import datetime
 from typing import List, Optional
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
 from starlette.concurrency import run_in_threadpool
 
 from app.core.database import supabase
 from app.models.paper_trade import (
-    PaperTradeCreate, PaperTradeOut, PaperTradeUpdate, 
+    PaperTradeCreate, PaperTradeOut, PaperTradeUpdate, PaperOrderOut,
+    PaperBasketCreate, PaperBasketOut, EquityCurve,
     PortfolioSummary, Position, MarketData, PaperTradeStats
 )
 from app.services.auth import get_current_user
 from app.services.paper_trading import paper_trading_service
+from app.services.paper_equity import paper_equity_service
 from app.services.market_data import market_data_service
 
 router = APIRouter()
@@ -41,7 +45,8 @@ async def execute_trade(trade_data: PaperTradeCreate, user=Depends(get_current_u
             quantity=trade_data.quantity,
             price=trade_data.price,
             order_type=trade_data.order_type,
-            notes=trade_data.notes
+            notes=trade_data.notes,
+            stop_price=trade_data.stop_price
         )
         
         return PaperTradeOut(**result)
@@ -58,17 +63,184 @@ async def execute_trade(trade_data: PaperTradeCreate, user=Depends(get_current_u
         )
 
 
+@router.post("/basket", response_model=PaperBasketOut)
+async def execute_basket(basket: PaperBasketCreate, user=Depends(get_current_user)):
+    """Execute several market orders against one portfolio snapshot, booked together"""
+    try:
+        results = await paper_trading_service.execute_basket(
+            user["id"], [order.model_dump() for order in basket.orders]
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to execute basket: {str(e)}"
+        )
+    
+    executed = sum(1 for result in results if result["status"] == "executed")
+    return PaperBasketOut(results=results, executed=executed, rejected=len(results) - executed)
+
+
+@router.get("/orders", response_model=List[PaperOrderOut])
+async def get_open_orders(user=Depends(get_current_user)):
+    """Get user's resting limit and stop orders"""
+    try:
+        orders = await paper_trading_service.get_open_orders(user["id"])
+        return [PaperOrderOut(**order) for order in orders]
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get open orders: {str(e)}"
+        )
+
+
+@router.delete("/orders/{order_id}")
+async def cancel_order(order_id: UUID, user=Depends(get_current_user)):
+    """Cancel a resting limit or stop order"""
+    try:
+        cancelled = await paper_trading_service.cancel_order(user["id"], str(order_id))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to cancel order: {str(e)}"
+        )
+    
+    if not cancelled:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Open order not found"
+        )
+    return {"message": "Order cancelled", "id": order_id}
+
+
+def _trade_filters(symbol: Optional[str] = None, action: Optional[str] = None,
+                   start: Optional[datetime] = None, end: Optional[datetime] = None,
+                   fields: Optional[str] = None) -> dict:
+    """Trade history filters shared by the list and export endpoints"""
+    return {
+        "symbol": symbol,
+        "action": action,
+        "start": start,
+        "end": end,
+        "fields": [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+    }
+
+
 @router.get("/trades", response_model=List[PaperTradeOut])
-async def get_trade_history(limit: int = 50, user=Depends(get_current_user)):
-    """Get user's trade history"""
+async def get_trade_history(
+    response: Response,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    symbol: Optional[str] = None,
+    action: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    user=Depends(get_current_user)
+):
+    """Get user's trade history, newest first.
+    
+    Pass the ``X-Next-Cursor`` response header back as ``cursor`` for the
+    next page; it is absent on the last page.
+    """
     try:
-        trades = await paper_trading_service.get_trade_history(user["id"], limit)
-        return [PaperTradeOut(**trade) for trade in trades]
+        trades, next_cursor = await paper_trading_service.get_trade_history(
+            user["id"], limit, cursor, **_trade_filters(symbol, action, start, end)
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to get trade history: {str(e)}"
         )
+    
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [PaperTradeOut(**trade) for trade in trades]
+
+
+@router.get("/trades/page")
+async def get_trade_page(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    filters: dict = Depends(_trade_filters),
+    user=Depends(get_current_user)
+):
+    """Get one page of trade history with only the requested ``fields`` (comma-separated)"""
+    try:
+        trades, next_cursor = await paper_trading_service.get_trade_history(
+            user["id"], limit, cursor, **filters
+        )
+        return {"trades": trades, "next_cursor": next_cursor}
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get trade history: {str(e)}"
+        )
+
+
+@router.get("/trades/export")
+async def export_trade_history(filters: dict = Depends(_trade_filters), user=Depends(get_current_user)):
+    """Stream the full trade history as NDJSON, one trade per line"""
+    trades = paper_trading_service.iter_trade_history(user["id"], **filters)
+    try:
+        # Fetch the first page up front so bad filters still get a 400
+        first = await trades.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to export trade history: {str(e)}"
+        )
+    
+    async def lines():
+        if first is None:
+            return
+        yield json.dumps(first, default=str) + "\n"
+        async for trade in trades:
+            yield json.dumps(trade, default=str) + "\n"
+    
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=paper-trades.ndjson"}
+    )
+
+
+@router.get("/equity", response_model=EquityCurve)
+async def get_equity_curve(
+    kind: str = "daily",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    user=Depends(get_current_user)
+):
+    """Get the portfolio's recorded equity curve (daily or intraday) and drawdown"""
+    try:
+        curve = await paper_equity_service.get_equity_curve(user["id"], kind, start, end)
+        return EquityCurve(**curve)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get equity curve: {str(e)}"
+        )
 
 
 @router.get("/stats", response_model=PaperTradeStats)
@@ -161,23 +333,9 @@ async def get_current_price(symbol: str, user=Depends(get_current_user)):
 async def reset_portfolio(user=Depends(get_current_user)):
     """Reset user's portfolio to initial state"""
     try:
-        # Delete all positions
-        await run_in_threadpool(
-            lambda: supabase.table("paper_positions")
-            .delete()
-            .eq("user_id", user["id"])
-            .execute()
-        )
-        
-        # Reset cash balance
-        await run_in_threadpool(
-            lambda: supabase.table("user_portfolios")
-            .update({"cash_balance": 1000000})  # Reset to ₹10,00,000
-            .eq("user_id", user["id"])
-            .execute()
-        )
+        await paper_trading_service.reset_portfolio(user["id"])
         
-        return {"message": "Portfolio reset successfully", "cash_balance": 1000000}
+        return {"message": "Portfolio reset successfully", "cash_balance": paper_trading_service.initial_cash}
         
     except Exception as e:
         raise HTTPException(
@@ -1,18 +1,38 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
+from typing import Optional
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query
 from fastapi.responses import HTMLResponse
 import json
 import logging
-from app.services.websocket_service import websocket_service
+from app.services.auth import get_current_user
+from app.services.websocket_service import websocket_service, ConnectionLimitError, ADDRESS_KEY_PREFIX
+from app.services.websocket_connection import UNAUTHORIZED_CLOSE_CODE, TRY_AGAIN_LATER_CLOSE_CODE
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+async def _connection_owner(websocket: WebSocket, token: Optional[str]) -> str:
+    """Key for the per-owner connection cap: the user id, or the client address"""
+    if token:
+        user = await get_current_user(f"Bearer {token}")
+        return f"user:{user['id']}"
+    return f"{ADDRESS_KEY_PREFIX}{websocket.client.host if websocket.client else 'unknown'}"
+
 @router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, token: Optional[str] = Query(None)):
     """WebSocket endpoint for real-time market data"""
     await websocket.accept()
-    await websocket_service.register(websocket)
+    try:
+        owner = await _connection_owner(websocket, token)
+        await websocket_service.register(websocket, owner)
+    except HTTPException as e:
+        await websocket.send_text(json.dumps({"type": "error", "message": e.detail}))
+        await websocket.close(code=UNAUTHORIZED_CLOSE_CODE)
+        return
+    except ConnectionLimitError as e:
+        await websocket.send_text(json.dumps({"type": "error", "message": str(e)}))
+        await websocket.close(code=TRY_AGAIN_LATER_CLOSE_CODE)
+        return
     
     try:
         while True:
@@ -85,6 +105,10 @@ async def websocket_test():
                 
                 ws.onmessage = function(event) {
                     const data = JSON.parse(event.data);
+                    if (data.type === 'heartbeat') {
+                        ws.send(JSON.stringify({type: 'pong'}));
+                        return;
+                    }
                     displayData(data);
                 };
                 
@@ -184,5 +208,11 @@ async def websocket_status():
         "connections": len(websocket_service.connections),
         "subscribed_symbols": list(websocket_service.subscribed_symbols.keys()),
         "is_running": websocket_service.is_running,
-        "update_interval": websocket_service.update_interval
+        "update_interval": websocket_service.update_interval,
+        "subscriptions": websocket_service.get_subscription_status(),
+        "connection_limits": websocket_service.get_connection_status(),
+        "send_queues": websocket_service.get_queue_status(),
+        "update_cycles": websocket_service.get_cycle_status(),
+        "poll_schedule": websocket_service.scheduler.get_status(),
+        "cluster": websocket_service.bus.get_status() if websocket_service.bus is not None else None
     }
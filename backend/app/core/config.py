@@ -1,5 +1,5 @@
 import os
-from typing import Optional
+from typing import Literal, Optional
 from pydantic_settings import BaseSettings
 
 
@@ -19,7 +19,61 @@ class Settings(BaseSettings):
     
     # Data Configuration
     stock_data_path: str = "./stock_data"
-    
+
+    # Market Data Upstream Configuration
+    market_data_executor_workers: int = 10  # threads for blocking yfinance calls
+    market_data_fetch_timeout: float = 10.0  # seconds per upstream fetch
+    market_data_rate_limit: float = 5.0  # yfinance requests per second
+    market_data_rate_burst: int = 10
+    market_data_breaker_failure_threshold: int = 5  # per symbol
+    market_data_global_breaker_failure_threshold: int = 20
+    market_data_breaker_recovery_seconds: float = 30.0
+    market_data_max_symbol_breakers: int = 2000  # least recently used symbols are forgotten past this
+    market_data_prefetch_enabled: bool = True
+    market_data_prefetch_interval: float = 5.0  # seconds between prefetch cycles
+    market_data_prefetch_lead_seconds: float = 10.0  # refresh this long before cache expiry
+    market_data_prefetch_budget: int = 10  # max upstream refreshes per cycle
+    market_data_prefetch_min_score: float = 3.0  # decayed accesses needed to count as hot
+    market_data_prefetch_half_life: float = 300.0  # seconds
+    market_data_shared_cache_enabled: bool = True  # share quotes across uvicorn workers
+    market_data_shared_cache_name: str = "quantease_quotes"
+    market_data_shared_cache_slots: int = 2048
+    market_data_shared_lease_seconds: float = 10.0  # max time one worker owns an upstream fetch
+
+    # Real-time Data Configuration
+    tick_history_capacity: int = 720  # ticks kept per symbol (1 hour at 5s polling)
+    tick_history_backfill_minutes: float = 30.0  # sent to clients on subscribe
+    websocket_updates_enabled: bool = True  # run the market data loop for /ws clients
+    websocket_bus_enabled: bool = True  # one worker polls, all workers fan out
+    websocket_bus_path: str = ""  # Unix socket for the worker bus; defaults to the temp dir
+    websocket_refresh_concurrency: int = 20  # symbols fetched in parallel per update cycle
+    websocket_min_poll_interval: float = 2.0  # fastest per-symbol refresh; also the scheduler tick
+    websocket_max_poll_interval: float = 60.0  # slowest refresh while the market is open
+    websocket_closed_poll_interval: float = 900.0  # refresh outside NSE trading hours
+    websocket_poll_budget: float = 4.0  # upstream refreshes per second across subscribed symbols
+    websocket_volatility_reference: float = 0.001  # 1-minute absolute return polled at the base rate
+    nse_holidays: list = []  # NSE trading holidays as YYYY-MM-DD
+    websocket_max_subscriptions_per_connection: int = 200  # 0 for no limit
+    websocket_max_connections: int = 1000  # per worker, 0 for no limit
+    websocket_max_connections_per_user: int = 5  # per signed-in user across workers, 0 for no limit
+    websocket_max_connections_per_address: int = 50  # per tokenless client address across workers, 0 for no limit
+    websocket_heartbeat_interval: float = 25.0  # seconds between server heartbeats
+    websocket_heartbeat_timeout: float = 75.0  # close clients silent for this long
+    websocket_idle_timeout: float = 600.0  # close connections without subscriptions for this long
+    websocket_send_queue_size: int = 256  # outbound messages buffered per connection
+    # Checked at startup: ClientConnection only learns of a bad value after accepting a socket
+    websocket_overflow_policy: Literal["drop_oldest", "conflate", "disconnect"] = "conflate"
+
+    # Paper Trading Configuration
+    paper_ledger_enabled: bool = False  # serve active traders from memory, persist write-behind; single worker only
+    paper_ledger_journal_dir: str = "./paper_ledger"  # durable journal of unpersisted trades
+    paper_ledger_flush_interval: float = 1.0  # seconds between write-behind flushes
+    paper_ledger_flush_batch: int = 100  # max trades per user per Supabase call
+    paper_ledger_idle_seconds: float = 900.0  # drop ledgers of users inactive this long
+    paper_equity_snapshots_enabled: bool = True  # record portfolio equity curves
+    paper_equity_interval: float = 900.0  # seconds between intraday equity points while NSE is open
+    paper_equity_intraday_retention_days: int = 30  # older intraday points are pruned; daily ones are kept
+
     class Config:
         env_file = ".env"
         case_sensitive = False
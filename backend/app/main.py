@@ -3,6 +3,9 @@ from fastapi.middleware.cors import CORSMiddleware
 from app.core.config import settings
 from app.api.v1.api import api_router
 import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Create FastAPI application
 app = FastAPI(
@@ -21,6 +24,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Trade history page cursor
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Include API router
@@ -44,19 +49,81 @@ async def health_check():
     return {"status": "healthy", "version": settings.app_version}
 
 
-# WebSocket service startup (disabled for now)
-# @app.on_event("startup")
-# async def startup_event():
-#     """Start WebSocket service on startup"""
-#     from app.services.websocket_service import websocket_service
-#     # Start the market data update loop
-#     asyncio.create_task(websocket_service.start_market_data_updates())
+@app.on_event("startup")
+async def start_market_data_prefetcher():
+    """Keep frequently requested quotes warm in the cache"""
+    if settings.market_data_prefetch_enabled:
+        from app.services.market_data import market_data_service
+        market_data_service.start_prefetcher()
+
+
+@app.on_event("shutdown")
+async def stop_market_data_prefetcher():
+    """Stop the quote prefetcher on shutdown"""
+    from app.services.market_data import market_data_service
+    await market_data_service.stop_prefetcher()
+
+
+@app.on_event("startup")
+async def start_websocket_service():
+    """Start the market data loop and worker bus for WebSocket clients"""
+    if settings.websocket_updates_enabled:
+        from app.services.websocket_service import websocket_service
+        await websocket_service.start()
+
+
+@app.on_event("shutdown")
+async def stop_websocket_service():
+    """Stop WebSocket service on shutdown"""
+    from app.services.websocket_service import websocket_service
+    await websocket_service.stop()
+
+
+@app.on_event("startup")
+async def start_paper_ledger():
+    """Replay the paper trade journal and start write-behind persistence"""
+    from app.services.paper_trading import paper_trading_service
+    await paper_trading_service.start_ledger()
+
+
+@app.on_event("shutdown")
+async def stop_paper_ledger():
+    """Persist pending paper trades on shutdown"""
+    from app.services.paper_trading import paper_trading_service
+    if paper_trading_service.ledger is not None:
+        await paper_trading_service.ledger.stop()
+
+
+@app.on_event("startup")
+async def start_paper_order_book():
+    """Reload resting paper orders and match them against live quotes"""
+    from app.services.paper_trading import paper_trading_service
+    from app.services.websocket_service import websocket_service
+    try:
+        await paper_trading_service.load_open_orders()
+    except Exception as e:
+        # Orders placed from now on still rest and match
+        logger.error(f"Could not load open paper orders: {e}")
+    if settings.websocket_updates_enabled:
+        websocket_service.register_quote_consumer(paper_trading_service.order_engine)
+    else:
+        logger.warning("WebSocket updates are disabled; resting paper orders will not be matched")
+
+
+@app.on_event("startup")
+async def start_paper_equity_snapshots():
+    """Record paper portfolio equity points on a schedule"""
+    if settings.paper_equity_snapshots_enabled:
+        from app.services.paper_equity import paper_equity_service
+        paper_equity_service.start()
+
+
+@app.on_event("shutdown")
+async def stop_paper_equity_snapshots():
+    """Stop recording equity points on shutdown"""
+    from app.services.paper_equity import paper_equity_service
+    await paper_equity_service.stop()
 
-# @app.on_event("shutdown")
-# async def shutdown_event():
-#     """Stop WebSocket service on shutdown"""
-#     from app.services.websocket_service import websocket_service
-#     await websocket_service.stop_market_data_updates()
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from uuid import UUID
 from pydantic import BaseModel, Field
 
@@ -9,8 +9,9 @@ class PaperTradeCreate(BaseModel):
     symbol: str = Field(..., description="Stock symbol (e.g., BHARTIARTL.NS)")
     action: str = Field(..., description="Trade action: 'buy' or 'sell'")
     quantity: int = Field(..., gt=0, description="Number of shares")
-    price: Optional[float] = Field(None, description="Trade price (if None, uses current market price)")
-    order_type: str = Field(default="market", description="Order type: 'market' or 'limit'")
+    price: Optional[float] = Field(None, description="Trade price (if None, uses current market price); the limit price for limit orders")
+    order_type: str = Field(default="market", description="Order type: 'market', 'limit' or 'stop'")
+    stop_price: Optional[float] = Field(None, gt=0, description="Trigger price for stop orders")
     notes: Optional[str] = Field(None, description="Optional trade notes")
 
 
@@ -27,7 +28,46 @@ class PaperTradeOut(BaseModel):
     notes: Optional[str]
     created_at: datetime
     executed_at: Optional[datetime] = None
-    status: str = Field(default="pending", description="Trade status: pending, executed, cancelled")
+    status: str = Field(default="pending", description="Trade status: pending, executed, rejected, cancelled")
+    rejection_reason: Optional[str] = None
+    realized_pnl: Optional[float] = Field(None, description="FIFO realized P&L of a sell")
+
+
+class PaperBasketCreate(BaseModel):
+    """Model for submitting several market orders at once"""
+    orders: List[PaperTradeCreate] = Field(..., min_length=1, max_length=100, description="Orders, validated in sequence")
+
+
+class PaperBasketResult(BaseModel):
+    """Model for the outcome of one basket order"""
+    index: int = Field(..., description="Position of the order in the basket")
+    status: str = Field(..., description="Order status: executed or rejected")
+    trade: Optional[PaperTradeOut] = None
+    error: Optional[str] = None
+
+
+class PaperBasketOut(BaseModel):
+    """Model for basket order results"""
+    results: List[PaperBasketResult]
+    executed: int
+    rejected: int
+
+
+class PaperOrderOut(BaseModel):
+    """Model for a resting limit or stop order"""
+    id: UUID
+    user_id: str
+    symbol: str
+    action: str
+    order_type: str
+    quantity: int
+    trigger_price: float
+    status: str = Field(..., description="Order status: open, triggered, filled, rejected, cancelled")
+    notes: Optional[str] = None
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    fill_price: Optional[float] = None
+    reason: Optional[str] = None
 
 
 class PaperTradeUpdate(BaseModel):
@@ -75,6 +115,25 @@ class MarketData(BaseModel):
     timestamp: datetime
 
 
+class EquityPoint(BaseModel):
+    """Model for one recorded portfolio valuation"""
+    ts: datetime
+    equity: float
+    cash: float
+    invested: float
+    drawdown_percent: float = Field(..., description="Below the running peak, as a negative percent")
+
+
+class EquityCurve(BaseModel):
+    """Model for a portfolio equity curve"""
+    kind: str = Field(..., description="Point kind: daily or intraday")
+    points: List[EquityPoint]
+    peak_equity: float
+    max_drawdown: float
+    max_drawdown_percent: float
+    current_drawdown_percent: float
+
+
 class PaperTradeStats(BaseModel):
     """Model for paper trading statistics"""
     total_trades: int
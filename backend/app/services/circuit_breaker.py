@@ -0,0 +1,113 @@
+import time
+from typing import Dict, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    rejects calls for ``recovery_timeout`` seconds. It then lets a single
+    trial call through (half-open); success closes it, failure re-opens it.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, recovery_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.total_failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_started_at: Optional[float] = None
+        self.rejected_calls = 0
+
+    def allow(self) -> bool:
+        """Check whether a call may go through right now"""
+        now = time.monotonic()
+
+        if self.state == STATE_CLOSED:
+            return True
+
+        if self.state == STATE_OPEN:
+            if now - self.opened_at >= self.recovery_timeout:
+                self.state = STATE_HALF_OPEN
+                self.trial_started_at = now
+                logger.info(f"Circuit breaker {self.name} half-open, allowing trial call")
+                return True
+            self.rejected_calls += 1
+            return False
+
+        # Half-open: only one trial in flight, unless it has gone missing
+        if self.trial_started_at is None or now - self.trial_started_at >= self.recovery_timeout:
+            self.trial_started_at = now
+            return True
+        self.rejected_calls += 1
+        return False
+
+    def would_allow(self) -> bool:
+        """Whether allow() would let a call through, without claiming a half-open trial"""
+        if self.state == STATE_CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == STATE_OPEN:
+            return now - self.opened_at >= self.recovery_timeout
+        return self.trial_started_at is None or now - self.trial_started_at >= self.recovery_timeout
+
+    def record_success(self):
+        """Record a successful call"""
+        if self.state != STATE_CLOSED:
+            logger.info(f"Circuit breaker {self.name} closed")
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+
+    def record_failure(self):
+        """Record a failed call"""
+        self.consecutive_failures += 1
+        self.total_failures += 1
+
+        if self.state == STATE_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != STATE_OPEN:
+                logger.warning(
+                    f"Circuit breaker {self.name} opened after {self.consecutive_failures} consecutive failures"
+                )
+            self.state = STATE_OPEN
+            self.opened_at = time.monotonic()
+            self.trial_started_at = None
+
+    def get_status(self) -> Dict:
+        """Get a snapshot of the breaker state"""
+        retry_in = None
+        if self.state == STATE_OPEN:
+            retry_in = max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+
+        return {
+            "name": self.name,
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "total_failures": self.total_failures,
+            "rejected_calls": self.rejected_calls,
+            "retry_in_seconds": round(retry_in, 2) if retry_in is not None else None,
+        }
+
+
+def allow_all(*breakers: CircuitBreaker) -> bool:
+    """Let a call through only if every breaker allows it.
+
+    Half-open trials are claimed only when all of them would pass, so one
+    breaker refusing never uses up another's trial.
+    """
+    if all(breaker.would_allow() for breaker in breakers):
+        return all([breaker.allow() for breaker in breakers])
+    for breaker in breakers:
+        if not breaker.would_allow():
+            breaker.rejected_calls += 1
+    return False
@@ -1,20 +1,148 @@
 import yfinance as yf
+try:
+    from yfinance.exceptions import YFRateLimitError
+except ImportError:  # older yfinance
+    YFRateLimitError = None
 import pandas as pd
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 import asyncio
+import time
 from concurrent.futures import ThreadPoolExecutor
 import logging
+from app.core.config import settings
+from app.services.circuit_breaker import CircuitBreaker, STATE_CLOSED, allow_all
+from app.services.shared_quote_cache import create_shared_quote_cache
+from app.services.rate_limiter import TokenBucketRateLimiter, PRIORITY_DASHBOARD, PRIORITY_PREFETCH
 
 logger = logging.getLogger(__name__)
 
+
+class UpstreamUnavailableError(ValueError):
+    """Raised when the market data upstream is short-circuited and nothing is cached"""
+
+
+class SymbolDataError(ValueError):
+    """Raised when the upstream answered but has no data for the symbol"""
+
+
+def _is_upstream_failure(error: Exception) -> bool:
+    """Whether a fetch error means the upstream itself is failing, not just this symbol.
+    
+    Only these count against the global breaker, so unknown or delisted
+    symbols can't shut off quotes for everyone.
+    """
+    if isinstance(error, SymbolDataError):
+        return False
+    if YFRateLimitError is not None and isinstance(error, YFRateLimitError):
+        return True
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        # 4xx other than throttling is about the request (e.g. an unknown symbol)
+        return status >= 500 or status == 429
+    return isinstance(error, (TimeoutError, asyncio.TimeoutError, OSError))
+
+
+def _fetch_price_sync(nse_symbol: str, symbol: str) -> float:
+    """Fetch the current price in a single blocking call (runs in the executor)"""
+    ticker = yf.Ticker(nse_symbol)
+    info = ticker.info
+    
+    current_price = info.get('currentPrice') or info.get('regularMarketPrice')
+    
+    if current_price is None:
+        # Fallback to last close price
+        hist = ticker.history(period="1d")
+        if not hist.empty:
+            current_price = hist['Close'].iloc[-1]
+        else:
+            raise SymbolDataError(f"No price data available for {symbol}")
+    
+    return float(current_price)
+
+
+def _fetch_market_data_sync(nse_symbol: str, symbol: str) -> Dict:
+    """Fetch quote and 2-day history in a single blocking call (runs in the executor)"""
+    ticker = yf.Ticker(nse_symbol)
+    info = ticker.info
+    hist = ticker.history(period="2d")
+    
+    if hist.empty:
+        raise SymbolDataError(f"No historical data available for {symbol}")
+    
+    current_price = info.get('currentPrice') or info.get('regularMarketPrice')
+    if current_price is None:
+        current_price = hist['Close'].iloc[-1]
+    
+    previous_close = hist['Close'].iloc[-2] if len(hist) > 1 else current_price
+    
+    return {
+        'symbol': symbol,
+        'price': float(current_price),
+        'change': float(current_price - previous_close),
+        'change_percent': float((current_price - previous_close) / previous_close * 100),
+        'volume': int(hist['Volume'].iloc[-1]) if 'Volume' in hist.columns else 0,
+        'high': float(hist['High'].iloc[-1]),
+        'low': float(hist['Low'].iloc[-1]),
+        'open': float(hist['Open'].iloc[-1]),
+        'previous_close': float(previous_close),
+        'timestamp': datetime.now()
+    }
+
+
+def _fetch_history_sync(nse_symbol: str, symbol: str, period: str) -> pd.DataFrame:
+    """Fetch price history in a single blocking call (runs in the executor)"""
+    hist = yf.Ticker(nse_symbol).history(period=period)
+    
+    if hist.empty:
+        raise SymbolDataError(f"No historical data available for {symbol}")
+    
+    return hist
+
+
 class MarketDataService:
     """Service for fetching real-time market data using yfinance"""
     
     def __init__(self):
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.market_data_executor_workers,
+            thread_name_prefix="market-data"
+        )
+        # Upstream calls queue here rather than inside the executor, so the
+        # per-fetch timeout only covers the yfinance call itself
+        self.executor_slots = asyncio.Semaphore(settings.market_data_executor_workers)
+        self.executor_stats = {
+            "waiting": 0,
+            "active": 0,
+            "max_waiting": 0,
+            "completed": 0,
+            "timeouts": 0,
+            "total_queue_seconds": 0.0,
+            "total_fetch_seconds": 0.0
+        }
         self.cache = {}
         self.cache_duration = timedelta(minutes=1)  # Cache for 1 minute
+        self.rate_limiter = TokenBucketRateLimiter(
+            rate=settings.market_data_rate_limit,
+            capacity=settings.market_data_rate_burst
+        )
+        self.global_breaker = CircuitBreaker(
+            "global",
+            failure_threshold=settings.market_data_global_breaker_failure_threshold,
+            recovery_timeout=settings.market_data_breaker_recovery_seconds
+        )
+        # Least recently used first; symbols come from user input, so it is capped
+        self.symbol_breakers: "OrderedDict[str, CircuitBreaker]" = OrderedDict()
+        self.shared_cache = None
+        if settings.market_data_shared_cache_enabled:
+            self.shared_cache = create_shared_quote_cache(
+                settings.market_data_shared_cache_name,
+                settings.market_data_shared_cache_slots
+            )
+        self.access_stats: Dict[str, Dict] = {}
+        self.prefetch_task = None
+        self.prefetch_stats = {"cycles": 0, "refreshed": 0, "failed": 0, "skipped_over_budget": 0}
     
     def _get_nse_symbol(self, symbol: str) -> str:
         """Convert symbol to NSE format for yfinance"""
@@ -22,117 +150,256 @@ class MarketDataService:
             return f"{symbol}.NS"
         return symbol
     
-    async def get_current_price(self, symbol: str) -> float:
+    def _get_symbol_breaker(self, nse_symbol: str) -> CircuitBreaker:
+        """Get or create the circuit breaker for a symbol"""
+        breaker = self.symbol_breakers.get(nse_symbol)
+        if breaker is not None:
+            self.symbol_breakers.move_to_end(nse_symbol)
+            return breaker
+        
+        while self.symbol_breakers and len(self.symbol_breakers) >= settings.market_data_max_symbol_breakers:
+            self._forget_symbol_breaker()
+        breaker = CircuitBreaker(
+            nse_symbol,
+            failure_threshold=settings.market_data_breaker_failure_threshold,
+            recovery_timeout=settings.market_data_breaker_recovery_seconds
+        )
+        self.symbol_breakers[nse_symbol] = breaker
+        return breaker
+    
+    def _forget_symbol_breaker(self):
+        """Drop the least recently used breaker, preferring a closed one"""
+        victim = next(
+            (symbol for symbol, breaker in self.symbol_breakers.items() if breaker.state == STATE_CLOSED),
+            None
+        )
+        if victim is None:
+            victim = next(iter(self.symbol_breakers))
+        del self.symbol_breakers[victim]
+    
+    async def _guarded_fetch(self, nse_symbol: str, cache_key: Optional[str], fetch, priority: int,
+                             max_age: Optional[timedelta] = None):
+        """Run an upstream fetch behind the circuit breakers and rate limiter.
+        
+        While a breaker is open the last known cached value is served, however
+        old; without one the call fails fast with UpstreamUnavailableError.
+        Cacheable fetches are first looked up in the cross-worker shared cache.
+        """
+        if cache_key and self.shared_cache is not None:
+            return await self._fetch_through_shared_cache(
+                nse_symbol, cache_key, fetch, priority, max_age or self.cache_duration
+            )
+        return await self._fetch_upstream(nse_symbol, cache_key, fetch, priority)
+    
+    async def _fetch_upstream(self, nse_symbol: str, cache_key: Optional[str], fetch, priority: int):
+        """Call yfinance, subject to the circuit breakers and rate limiter"""
+        breaker = self._get_symbol_breaker(nse_symbol)
+        if not allow_all(self.global_breaker, breaker):
+            if cache_key and cache_key in self.cache:
+                logger.warning(f"Circuit open for {nse_symbol}, serving last known data")
+                return self.cache[cache_key][0]
+            raise UpstreamUnavailableError(f"Market data temporarily unavailable for {nse_symbol}")
+        
+        await self.rate_limiter.acquire(priority)
+        
+        try:
+            result = await fetch()
+        except Exception as e:
+            breaker.record_failure()
+            if _is_upstream_failure(e):
+                self.global_breaker.record_failure()
+            else:
+                # The upstream answered; only this symbol is at fault
+                self.global_breaker.record_success()
+            raise
+        
+        breaker.record_success()
+        self.global_breaker.record_success()
+        return result
+    
+    async def _run_upstream(self, func, *args):
+        """Run one blocking yfinance call in the executor with a timeout"""
+        stats = self.executor_stats
+        queued_at = time.monotonic()
+        stats["waiting"] += 1
+        stats["max_waiting"] = max(stats["max_waiting"], stats["waiting"])
+        try:
+            await self.executor_slots.acquire()
+        finally:
+            stats["waiting"] -= 1
+        
+        started_at = time.monotonic()
+        stats["total_queue_seconds"] += started_at - queued_at
+        stats["active"] += 1
+        
+        def release(_):
+            # The slot is held until the thread is really done, even after a timeout
+            stats["active"] -= 1
+            stats["completed"] += 1
+            stats["total_fetch_seconds"] += time.monotonic() - started_at
+            self.executor_slots.release()
+        
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        future.add_done_callback(release)
+        
+        timeout = settings.market_data_fetch_timeout
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            stats["timeouts"] += 1
+            raise TimeoutError(f"Upstream fetch timed out after {timeout}s")
+    
+    def get_executor_status(self) -> Dict:
+        """Get executor sizing and queue-depth metrics"""
+        stats = self.executor_stats
+        completed = stats["completed"]
+        return {
+            "max_workers": settings.market_data_executor_workers,
+            "fetch_timeout_seconds": settings.market_data_fetch_timeout,
+            "waiting": stats["waiting"],
+            "active": stats["active"],
+            "max_waiting": stats["max_waiting"],
+            "completed": completed,
+            "timeouts": stats["timeouts"],
+            "avg_queue_ms": round(stats["total_queue_seconds"] / completed * 1000, 2) if completed else 0,
+            "avg_fetch_ms": round(stats["total_fetch_seconds"] / completed * 1000, 2) if completed else 0
+        }
+    
+    def _store_cached(self, cache_key: str, value):
+        """Cache a freshly fetched value locally and for the other workers"""
+        self.cache[cache_key] = (value, datetime.now())
+        if self.shared_cache is not None:
+            self.shared_cache.put(cache_key, value)
+    
+    def _read_shared(self, cache_key: str, max_age: timedelta):
+        """Copy a fresh shared-cache entry into the local cache"""
+        entry = self.shared_cache.get(cache_key, max_age.total_seconds())
+        if entry is None:
+            return None
+        value, written_at = entry
+        self.cache[cache_key] = (value, datetime.fromtimestamp(written_at))
+        return value
+    
+    async def _fetch_through_shared_cache(self, nse_symbol: str, cache_key: str, fetch,
+                                          priority: int, max_age: timedelta):
+        """Serve from the shared cache, or fetch as the single upstream poller.
+        
+        If another worker holds the upstream lease for this key we wait for
+        its result instead of issuing a duplicate request; if the lease lapses
+        without a result we take it over.
+        """
+        lease_seconds = settings.market_data_shared_lease_seconds
+        deadline = time.monotonic() + lease_seconds
+        
+        while True:
+            value = self._read_shared(cache_key, max_age)
+            if value is not None:
+                return value
+            if self.shared_cache.try_lease(cache_key, lease_seconds):
+                break
+            if time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(0.05)
+        
+        try:
+            return await self._fetch_upstream(nse_symbol, cache_key, fetch, priority)
+        finally:
+            self.shared_cache.release_lease(cache_key)
+    
+    def _record_access(self, cache_key: str, symbol: str, kind: str):
+        """Bump the exponentially decayed access score for a cache entry"""
+        now = time.monotonic()
+        stats = self.access_stats.get(cache_key)
+        if stats is None:
+            self.access_stats[cache_key] = {"symbol": symbol, "kind": kind, "score": 1.0, "updated_at": now}
+            return
+        
+        decay = 0.5 ** ((now - stats["updated_at"]) / settings.market_data_prefetch_half_life)
+        stats["score"] = stats["score"] * decay + 1.0
+        stats["updated_at"] = now
+    
+    def _current_score(self, stats: Dict, now: float) -> float:
+        """Access score decayed to the given time"""
+        return stats["score"] * 0.5 ** ((now - stats["updated_at"]) / settings.market_data_prefetch_half_life)
+    
+    async def get_current_price(self, symbol: str, priority: int = PRIORITY_DASHBOARD,
+                                refresh: bool = False) -> float:
         """Get current market price for a symbol"""
         try:
             nse_symbol = self._get_nse_symbol(symbol)
             
             # Check cache first
             cache_key = f"price_{nse_symbol}"
-            if cache_key in self.cache:
+            if not refresh:
+                self._record_access(cache_key, symbol, "price")
+            if not refresh and cache_key in self.cache:
                 cached_data, timestamp = self.cache[cache_key]
                 if datetime.now() - timestamp < self.cache_duration:
                     return cached_data
             
-            # Fetch from yfinance
-            loop = asyncio.get_event_loop()
-            ticker = await loop.run_in_executor(
-                self.executor, 
-                lambda: yf.Ticker(nse_symbol)
-            )
+            async def fetch():
+                current_price = await self._run_upstream(_fetch_price_sync, nse_symbol, symbol)
+                
+                # Cache the result
+                self._store_cached(cache_key, current_price)
+                return current_price
             
-            info = await loop.run_in_executor(
-                self.executor,
-                lambda: ticker.info
+            # Fetch from yfinance
+            current_price = await self._guarded_fetch(
+                nse_symbol, cache_key, fetch, priority, self._refresh_max_age() if refresh else None
             )
             
-            current_price = info.get('currentPrice') or info.get('regularMarketPrice')
-            
-            if current_price is None:
-                # Fallback to last close price
-                hist = await loop.run_in_executor(
-                    self.executor,
-                    lambda: ticker.history(period="1d")
-                )
-                if not hist.empty:
-                    current_price = hist['Close'].iloc[-1]
-                else:
-                    raise ValueError(f"No price data available for {symbol}")
-            
-            # Cache the result
-            self.cache[cache_key] = (current_price, datetime.now())
-            
             return float(current_price)
             
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
             logger.error(f"Error fetching price for {symbol}: {e}")
             raise ValueError(f"Failed to fetch price for {symbol}: {str(e)}")
     
-    async def get_market_data(self, symbol: str) -> Dict:
-        """Get comprehensive market data for a symbol"""
+    async def get_market_data(self, symbol: str, priority: int = PRIORITY_DASHBOARD,
+                              refresh: bool = False, max_age: Optional[timedelta] = None) -> Dict:
+        """Get comprehensive market data for a symbol
+        
+        ``max_age`` overrides how old a cached quote may be, for callers that
+        poll on their own schedule.
+        """
         try:
             nse_symbol = self._get_nse_symbol(symbol)
+            if refresh:
+                max_age = self._refresh_max_age()
             
             # Check cache first
             cache_key = f"data_{nse_symbol}"
-            if cache_key in self.cache:
+            if not refresh:
+                self._record_access(cache_key, symbol, "data")
+            if not refresh and cache_key in self.cache:
                 cached_data, timestamp = self.cache[cache_key]
-                if datetime.now() - timestamp < self.cache_duration:
+                if datetime.now() - timestamp < (max_age or self.cache_duration):
                     return cached_data
             
-            # Fetch from yfinance
-            loop = asyncio.get_event_loop()
-            ticker = await loop.run_in_executor(
-                self.executor, 
-                lambda: yf.Ticker(nse_symbol)
-            )
-            
-            # Get info and history
-            info = await loop.run_in_executor(
-                self.executor,
-                lambda: ticker.info
-            )
-            
-            hist = await loop.run_in_executor(
-                self.executor,
-                lambda: ticker.history(period="2d")
-            )
-            
-            if hist.empty:
-                raise ValueError(f"No historical data available for {symbol}")
+            async def fetch():
+                market_data = await self._run_upstream(_fetch_market_data_sync, nse_symbol, symbol)
+                
+                # Cache the result
+                self._store_cached(cache_key, market_data)
+                return market_data
             
-            current_price = info.get('currentPrice') or info.get('regularMarketPrice')
-            if current_price is None:
-                current_price = hist['Close'].iloc[-1]
-            
-            previous_close = hist['Close'].iloc[-2] if len(hist) > 1 else current_price
-            
-            market_data = {
-                'symbol': symbol,
-                'price': float(current_price),
-                'change': float(current_price - previous_close),
-                'change_percent': float((current_price - previous_close) / previous_close * 100),
-                'volume': int(hist['Volume'].iloc[-1]) if 'Volume' in hist.columns else 0,
-                'high': float(hist['High'].iloc[-1]),
-                'low': float(hist['Low'].iloc[-1]),
-                'open': float(hist['Open'].iloc[-1]),
-                'previous_close': float(previous_close),
-                'timestamp': datetime.now()
-            }
-            
-            # Cache the result
-            self.cache[cache_key] = (market_data, datetime.now())
+            # Fetch from yfinance
+            market_data = await self._guarded_fetch(nse_symbol, cache_key, fetch, priority, max_age)
             
             return market_data
             
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
             logger.error(f"Error fetching market data for {symbol}: {e}")
             raise ValueError(f"Failed to fetch market data for {symbol}: {str(e)}")
     
-    async def get_multiple_prices(self, symbols: List[str]) -> Dict[str, float]:
+    async def get_multiple_prices(self, symbols: List[str], priority: int = PRIORITY_DASHBOARD) -> Dict[str, float]:
         """Get current prices for multiple symbols"""
         try:
-            tasks = [self.get_current_price(symbol) for symbol in symbols]
+            tasks = [self.get_current_price(symbol, priority) for symbol in symbols]
             prices = await asyncio.gather(*tasks, return_exceptions=True)
             
             result = {}
@@ -154,29 +421,137 @@ class MarketDataService:
         try:
             nse_symbol = self._get_nse_symbol(symbol)
             
-            loop = asyncio.get_event_loop()
-            ticker = await loop.run_in_executor(
-                self.executor, 
-                lambda: yf.Ticker(nse_symbol)
-            )
-            
-            hist = await loop.run_in_executor(
-                self.executor,
-                lambda: ticker.history(period=period)
-            )
+            async def fetch():
+                return await self._run_upstream(_fetch_history_sync, nse_symbol, symbol, period)
             
-            if hist.empty:
-                raise ValueError(f"No historical data available for {symbol}")
+            hist = await self._guarded_fetch(nse_symbol, None, fetch, PRIORITY_DASHBOARD)
             
             return hist
             
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
             logger.error(f"Error fetching historical data for {symbol}: {e}")
             raise ValueError(f"Failed to fetch historical data for {symbol}: {str(e)}")
     
+    def _refresh_max_age(self) -> timedelta:
+        """Age after which a cache entry is due for a prefetch refresh"""
+        return self.cache_duration - timedelta(seconds=settings.market_data_prefetch_lead_seconds)
+    
+    def _select_prefetch_candidates(self) -> List[Dict]:
+        """Pick hot cache entries that are about to expire, hottest first"""
+        now = time.monotonic()
+        refresh_after = self._refresh_max_age()
+        candidates = []
+        
+        for cache_key, stats in list(self.access_stats.items()):
+            score = self._current_score(stats, now)
+            if score < settings.market_data_prefetch_min_score:
+                # Forget symbols that have gone cold
+                if score < 0.01:
+                    del self.access_stats[cache_key]
+                continue
+            
+            cached = self.cache.get(cache_key)
+            if cached is not None and datetime.now() - cached[1] < refresh_after:
+                continue
+            
+            candidates.append({**stats, "score": score})
+        
+        candidates.sort(key=lambda c: c["score"], reverse=True)
+        return candidates
+    
+    async def _prefetch_once(self):
+        """Refresh the hot set within the per-cycle upstream budget"""
+        candidates = self._select_prefetch_candidates()
+        budget = settings.market_data_prefetch_budget
+        selected = candidates[:budget]
+        self.prefetch_stats["skipped_over_budget"] += len(candidates) - len(selected)
+        
+        tasks = []
+        for candidate in selected:
+            if candidate["kind"] == "price":
+                tasks.append(self.get_current_price(candidate["symbol"], PRIORITY_PREFETCH, refresh=True))
+            else:
+                tasks.append(self.get_market_data(candidate["symbol"], PRIORITY_PREFETCH, refresh=True))
+        
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.prefetch_stats["failed"] += 1
+            else:
+                self.prefetch_stats["refreshed"] += 1
+        self.prefetch_stats["cycles"] += 1
+    
+    async def _prefetch_loop(self):
+        """Background loop keeping hot symbols warm in the cache"""
+        logger.info("Starting market data prefetcher...")
+        while True:
+            try:
+                await self._prefetch_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in market data prefetch loop: {e}")
+            await asyncio.sleep(settings.market_data_prefetch_interval)
+    
+    def start_prefetcher(self):
+        """Start the background prefetcher if it isn't running"""
+        if self.prefetch_task is None or self.prefetch_task.done():
+            self.prefetch_task = asyncio.create_task(self._prefetch_loop())
+    
+    async def stop_prefetcher(self):
+        """Stop the background prefetcher"""
+        if self.prefetch_task is not None:
+            self.prefetch_task.cancel()
+            try:
+                await self.prefetch_task
+            except asyncio.CancelledError:
+                pass
+            self.prefetch_task = None
+            logger.info("Stopped market data prefetcher")
+    
+    def get_prefetch_status(self) -> Dict:
+        """Get prefetcher state and the current hot set"""
+        now = time.monotonic()
+        hot = [
+            {"symbol": stats["symbol"], "kind": stats["kind"], "score": round(score, 2)}
+            for stats in self.access_stats.values()
+            if (score := self._current_score(stats, now)) >= settings.market_data_prefetch_min_score
+        ]
+        hot.sort(key=lambda h: h["score"], reverse=True)
+        
+        return {
+            "running": self.prefetch_task is not None and not self.prefetch_task.done(),
+            "budget_per_cycle": settings.market_data_prefetch_budget,
+            "interval_seconds": settings.market_data_prefetch_interval,
+            "tracked_entries": len(self.access_stats),
+            "hot_entries": hot,
+            **self.prefetch_stats
+        }
+    
+    def get_upstream_status(self) -> Dict:
+        """Get rate limiter and circuit breaker state"""
+        return {
+            "rate_limiter": self.rate_limiter.get_status(),
+            "global_breaker": self.global_breaker.get_status(),
+            "symbol_breakers": {
+                symbol: breaker.get_status()
+                for symbol, breaker in self.symbol_breakers.items()
+            },
+            "open_breakers": [
+                symbol for symbol, breaker in self.symbol_breakers.items()
+                if breaker.state != STATE_CLOSED
+            ],
+            "shared_cache": self.shared_cache.get_status() if self.shared_cache is not None else None,
+            "executor": self.get_executor_status()
+        }
+    
     def clear_cache(self):
         """Clear the cache"""
         self.cache.clear()
+        if self.shared_cache is not None:
+            self.shared_cache.clear()
 
 # Global instance
 market_data_service = MarketDataService()
@@ -0,0 +1,276 @@
+import asyncio
+import json
+import os
+import tempfile
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional, Set
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, the bus is unavailable
+    fcntl = None
+
+from app.services.market_data_frames import dumps
+
+logger = logging.getLogger(__name__)
+
+# Largest bus message (one JSON line) a peer will accept
+MAX_LINE_SIZE = 1024 * 1024
+# Skip quotes for a worker whose socket has this much unsent data
+MAX_PEER_BUFFER = 512 * 1024
+RECONNECT_DELAY = 1.0
+
+
+def default_bus_path() -> str:
+    return os.path.join(tempfile.gettempdir(), "quantease_market_data.sock")
+
+
+class MarketDataBus:
+    """Host-local pub/sub bus between uvicorn workers over a Unix socket.
+
+    Exactly one worker (the leader) holds an flock on the bus lock file,
+    serves the socket and polls market data; the others connect to it,
+    report which symbols their clients are subscribed to, and receive the
+    leader's quotes to fan out locally. The lock is released by the OS if
+    the leader dies, and whichever worker grabs it next takes over.
+    """
+
+    def __init__(self, socket_path: str,
+                 on_quote: Callable[[str, Dict], Awaitable[None]],
+                 on_error: Callable[[str, Dict], Awaitable[None]]):
+        self.socket_path = socket_path
+        self.lock_path = f"{socket_path}.lock"
+        self.on_quote = on_quote
+        self.on_error = on_error
+        self.pid = os.getpid()
+        self.is_leader = False
+        self.connected = False
+        self.lock_fd: Optional[int] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.task: Optional[asyncio.Task] = None
+        # Leader side: interest reported by each connected worker
+        self.peers: Dict[asyncio.StreamWriter, Dict] = {}
+        # Follower side: connection to the leader
+        self.leader_writer: Optional[asyncio.StreamWriter] = None
+        # This worker's interest:
+        # {"connections": n, "symbols": {symbol: subscribers}, "owners": {owner key: connections}}
+        self.local_interest: Dict = {"connections": 0, "symbols": {}, "owners": {}}
+        # Every worker's interest as last published by the leader, keyed by pid
+        self.cluster: Dict[str, Dict] = {}
+        self.dropped_quotes = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self._close_leader()
+        if self.leader_writer is not None:
+            self.leader_writer.close()
+
+    async def _run(self):
+        """Lead if the lock is free, otherwise follow; retry on failure"""
+        while True:
+            try:
+                if self._try_lock():
+                    await self._lead()
+                else:
+                    await self._follow()
+            except asyncio.CancelledError:
+                raise
+            except (ConnectionError, FileNotFoundError, OSError) as e:
+                logger.debug(f"Market data bus connection failed: {e}")
+            except Exception as e:
+                logger.error(f"Market data bus error: {e}")
+
+            self.connected = False
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    def _try_lock(self) -> bool:
+        if self.lock_fd is None:
+            self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    # Leader side
+
+    async def _lead(self):
+        # A socket file left behind by a dead leader is stale: we hold the lock
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self.server = await asyncio.start_unix_server(
+            self._handle_peer, path=self.socket_path, limit=MAX_LINE_SIZE
+        )
+        self.is_leader = True
+        self.connected = True
+        self._publish_cluster()
+        logger.info(f"Worker {self.pid} is the market data bus leader")
+
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self._close_leader()
+
+    async def _close_leader(self):
+        if not self.is_leader:
+            return
+        self.is_leader = False
+        for writer in list(self.peers):
+            writer.close()
+        self.peers.clear()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    async def _handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Track one follower's reported interest until it disconnects"""
+        self.peers[writer] = {"pid": None, "connections": 0, "symbols": {}, "owners": {}}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message.get("op") == "interest":
+                    self.peers[writer] = {
+                        "pid": message.get("pid"),
+                        "connections": message.get("connections", 0),
+                        "symbols": message.get("symbols", {}),
+                        "owners": message.get("owners", {})
+                    }
+                    self._publish_cluster()
+        except (ConnectionError, json.JSONDecodeError, ValueError) as e:
+            logger.debug(f"Market data bus peer dropped: {e}")
+        finally:
+            self.peers.pop(writer, None)
+            writer.close()
+            self._publish_cluster()
+
+    def _send_to_peers(self, line: bytes, symbol: Optional[str] = None):
+        for writer, interest in list(self.peers.items()):
+            if symbol is not None and symbol not in interest["symbols"]:
+                continue
+            if writer.transport.get_write_buffer_size() > MAX_PEER_BUFFER:
+                # A stalled worker catches up with the next quote
+                self.dropped_quotes += 1
+                continue
+            writer.write(line)
+
+    def _publish_cluster(self):
+        """Share every worker's interest so each one can report cluster totals"""
+        workers = {str(self.pid): self.local_interest}
+        for interest in self.peers.values():
+            if interest["pid"] is not None:
+                workers[str(interest["pid"])] = {
+                    "connections": interest["connections"],
+                    "symbols": interest["symbols"],
+                    "owners": interest["owners"]
+                }
+        self.cluster = workers
+        self._send_to_peers((dumps({"op": "cluster", "workers": workers}) + "\n").encode())
+
+    def publish_quote(self, symbol: str, data: Dict):
+        """Leader: send a polled quote to the workers subscribed to it"""
+        if self.is_leader and self.peers:
+            self._send_to_peers((dumps({"op": "quote", "symbol": symbol, "data": data}) + "\n").encode(), symbol)
+
+    def publish_error(self, symbol: str, error: Dict):
+        """Leader: forward a fetch error to the workers subscribed to the symbol"""
+        if self.is_leader and self.peers:
+            self._send_to_peers((dumps({"op": "error", "symbol": symbol, "error": error}) + "\n").encode(), symbol)
+
+    def wanted_symbols(self) -> Set[str]:
+        """Leader: every symbol some worker has subscribers for"""
+        symbols = set(self.local_interest["symbols"])
+        for interest in self.peers.values():
+            symbols.update(interest["symbols"])
+        return symbols
+
+    # Follower side
+
+    async def _follow(self):
+        reader, writer = await asyncio.open_unix_connection(self.socket_path, limit=MAX_LINE_SIZE)
+        self.leader_writer = writer
+        self.connected = True
+        self._send_interest()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message.get("op")
+                if op == "quote":
+                    data = message["data"]
+                    if isinstance(data.get("timestamp"), str):
+                        data["timestamp"] = datetime.fromisoformat(data["timestamp"])
+                    await self.on_quote(message["symbol"], data)
+                elif op == "error":
+                    await self.on_error(message["symbol"], message["error"])
+                elif op == "cluster":
+                    self.cluster = message["workers"]
+        finally:
+            self.leader_writer = None
+            writer.close()
+            logger.info("Lost connection to the market data bus leader")
+
+    def _send_interest(self):
+        if self.leader_writer is not None:
+            self.leader_writer.write((dumps({"op": "interest", "pid": self.pid, **self.local_interest}) + "\n").encode())
+
+    def update_interest(self, connections: int, symbols: Dict[str, int], owners: Optional[Dict[str, int]] = None):
+        """Report this worker's connection count, per-symbol subscribers and per-owner connections"""
+        self.local_interest = {"connections": connections, "symbols": symbols, "owners": owners or {}}
+        if self.is_leader:
+            self._publish_cluster()
+        else:
+            self._send_interest()
+
+    def remote_connections(self, owner: str) -> int:
+        """Connections ``owner`` holds on the other workers, as last reported"""
+        if not self.connected:
+            return 0
+        return sum(
+            interest.get("owners", {}).get(owner, 0)
+            for pid, interest in self.cluster.items() if pid != str(self.pid)
+        )
+
+    def get_status(self) -> Dict:
+        """Cluster-wide subscription totals as seen from this worker"""
+        workers = dict(self.cluster)
+        workers[str(self.pid)] = self.local_interest
+
+        symbol_totals: Dict[str, int] = {}
+        for interest in workers.values():
+            for symbol, count in interest["symbols"].items():
+                symbol_totals[symbol] = symbol_totals.get(symbol, 0) + count
+
+        return {
+            "role": "leader" if self.is_leader else "follower",
+            "connected": self.connected,
+            "worker_pid": self.pid,
+            "workers": len(workers),
+            "total_connections": sum(interest["connections"] for interest in workers.values()),
+            "subscriptions": symbol_totals,
+            "dropped_quotes": self.dropped_quotes
+        }
+
+
+def create_market_data_bus(socket_path: str, on_quote, on_error) -> Optional[MarketDataBus]:
+    """Create the worker bus, or None where Unix sockets or flock are unavailable"""
+    if fcntl is None or not hasattr(asyncio, "start_unix_server"):
+        logger.warning("Market data bus needs Unix sockets; each worker will poll on its own")
+        return None
+    return MarketDataBus(socket_path, on_quote, on_error)
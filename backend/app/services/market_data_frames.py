@@ -0,0 +1,220 @@
+import json
+import struct
+from datetime import datetime
+from typing import Dict, List, Optional, Union
+import logging
+
+# Both are declared dependencies; an install without them still serves
+# JSON through the stdlib and doesn't offer the msgpack encoding
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+ENCODING_PACKED = "packed"
+
+
+def available_encodings():
+    """Encodings a client may negotiate on this server"""
+    encodings = [ENCODING_JSON, ENCODING_PACKED]
+    if msgpack is not None:
+        encodings.append(ENCODING_MSGPACK)
+    return encodings
+
+
+# Quote fields in wire order for the packed encoding; bit i of a delta's
+# field mask refers to QUOTE_FIELDS[i]
+QUOTE_FIELDS = (
+    ("price", "d"),
+    ("change", "d"),
+    ("change_percent", "d"),
+    ("volume", "q"),
+    ("high", "d"),
+    ("low", "d"),
+    ("open", "d"),
+    ("previous_close", "d"),
+)
+
+PACKED_SNAPSHOT = 1
+PACKED_DELTA = 2
+# frame type, seq, timestamp (epoch seconds), symbol length
+PACKED_HEADER = struct.Struct("<BIdB")
+PACKED_SNAPSHOT_BODY = struct.Struct("<" + "".join(fmt for _, fmt in QUOTE_FIELDS))
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(message) -> str:
+    """Compact JSON for WebSocket frames; datetimes become ISO 8601 strings.
+
+    Uses orjson when installed, which serializes datetimes natively.
+    """
+    if orjson is not None:
+        return orjson.dumps(message, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(message, separators=(",", ":"), default=_json_default)
+
+
+# Frames built and encodings produced since startup; encodes should track
+# frames per encoding in use, not the number of subscribers
+encode_stats = {"frames": 0, "encodes": 0}
+
+
+def _quote_timestamp(data: Dict) -> float:
+    timestamp = data.get("timestamp")
+    if isinstance(timestamp, datetime):
+        return timestamp.timestamp()
+    return datetime.now().timestamp()
+
+
+class MarketDataFrame:
+    """One version of a symbol's quote, encodable as a snapshot or a delta.
+
+    ``seq`` increases by one per change of the symbol's quote. The delta
+    holds only the fields that changed since ``seq - 1``, so it is only
+    valid for a client that has seen exactly that previous version.
+    Encodings are computed on first use and shared by every subscriber.
+    """
+
+    def __init__(self, symbol: str, seq: int, snapshot: Dict, delta: Optional[Dict]):
+        self.symbol = symbol
+        self.seq = seq
+        self.snapshot = snapshot
+        self.delta = delta
+        self.sent_at = datetime.utcnow()
+        self._encoded: Dict[tuple, Union[str, bytes]] = {}
+
+    def encode(self, as_delta: bool, encoding: str) -> Union[str, bytes]:
+        """Encoded frame, cached per (kind, encoding)"""
+        cache_key = (as_delta, encoding)
+        frame = self._encoded.get(cache_key)
+        if frame is None:
+            if encoding == ENCODING_PACKED:
+                frame = self._encode_packed(as_delta)
+            else:
+                message = self._message(as_delta)
+                if encoding == ENCODING_MSGPACK:
+                    frame = msgpack.packb(message, default=_json_default)
+                else:
+                    frame = dumps(message)
+            self._encoded[cache_key] = frame
+            encode_stats["encodes"] += 1
+        return frame
+
+    def _message(self, as_delta: bool) -> Dict:
+        if as_delta:
+            return {
+                "type": "market_data_delta",
+                "symbol": self.symbol,
+                "seq": self.seq,
+                "data": self.delta,
+                "timestamp": self.sent_at.isoformat()
+            }
+        return {
+            "type": "market_data",
+            "symbol": self.symbol,
+            "seq": self.seq,
+            "data": self.snapshot,
+            "timestamp": self.sent_at.isoformat()
+        }
+
+    def _encode_packed(self, as_delta: bool) -> bytes:
+        symbol = self.symbol.encode()
+        header = PACKED_HEADER.pack(
+            PACKED_DELTA if as_delta else PACKED_SNAPSHOT,
+            self.seq,
+            _quote_timestamp(self.snapshot),
+            len(symbol)
+        ) + symbol
+
+        if not as_delta:
+            values = [
+                int(self.snapshot.get(name) or 0) if fmt == "q" else float(self.snapshot.get(name) or 0.0)
+                for name, fmt in QUOTE_FIELDS
+            ]
+            return header + PACKED_SNAPSHOT_BODY.pack(*values)
+
+        mask = 0
+        formats = "<H"
+        values = []
+        for bit, (name, fmt) in enumerate(QUOTE_FIELDS):
+            if name in self.delta:
+                mask |= 1 << bit
+                formats += fmt
+                values.append(int(self.delta[name]) if fmt == "q" else float(self.delta[name]))
+        return header + struct.pack(formats, mask, *values)
+
+
+class FrameBuilder:
+    """Tracks the latest quote per symbol and builds versioned frames"""
+
+    def __init__(self):
+        self.latest: Dict[str, MarketDataFrame] = {}
+
+    def update(self, symbol: str, data: Dict) -> MarketDataFrame:
+        """Frame for a freshly polled quote; unchanged quotes keep their version"""
+        previous = self.latest.get(symbol)
+        if previous is not None and previous.snapshot is data:
+            # Same cached quote object as last time
+            return previous
+        if previous is None:
+            frame = MarketDataFrame(symbol, 1, data, None)
+        else:
+            delta = {
+                key: value for key, value in data.items()
+                if key != "timestamp" and previous.snapshot.get(key) != value
+            }
+            if not delta:
+                return previous
+            frame = MarketDataFrame(symbol, previous.seq + 1, data, delta)
+
+        self.latest[symbol] = frame
+        encode_stats["frames"] += 1
+        return frame
+
+    def discard(self, symbol: str):
+        self.latest.pop(symbol, None)
+
+
+class MarketDataBatch:
+    """Snapshots for several symbols sent to one client as a single frame.
+
+    Used to answer a subscription to a list of symbols. JSON and msgpack
+    clients get one ``market_data_batch`` message; packed clients get the
+    packed snapshot frames concatenated into one binary message (each is
+    self-delimiting: the header carries the symbol length and snapshot
+    bodies have a fixed size).
+    """
+
+    def __init__(self, frames: List[MarketDataFrame]):
+        self.frames = frames
+        self.sent_at = datetime.utcnow()
+
+    def encode(self, encoding: str) -> Union[str, bytes]:
+        if encoding == ENCODING_PACKED:
+            return b"".join(frame.encode(False, ENCODING_PACKED) for frame in self.frames)
+
+        message = {
+            "type": "market_data_batch",
+            "data": [
+                {"symbol": frame.symbol, "seq": frame.seq, "data": frame.snapshot}
+                for frame in self.frames
+            ],
+            "timestamp": self.sent_at.isoformat()
+        }
+        encode_stats["encodes"] += 1
+        if encoding == ENCODING_MSGPACK:
+            return msgpack.packb(message, default=_json_default)
+        return dumps(message)
@@ -0,0 +1,46 @@
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Optional, Set
+import logging
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# India has no daylight saving time, so a fixed offset is exact
+IST = timezone(timedelta(hours=5, minutes=30), "IST")
+NSE_OPEN = time(9, 15)
+NSE_CLOSE = time(15, 30)
+
+
+def _holidays() -> Set[date]:
+    holidays = set()
+    for value in settings.nse_holidays:
+        try:
+            holidays.add(date.fromisoformat(str(value)))
+        except ValueError:
+            logger.warning(f"Ignoring invalid NSE holiday date: {value}")
+    return holidays
+
+
+def is_trading_day(day: date) -> bool:
+    return day.weekday() < 5 and day not in _holidays()
+
+
+def is_market_open(now: Optional[datetime] = None) -> bool:
+    """Whether the NSE equity market is in its normal trading session"""
+    now = (now or datetime.now(IST)).astimezone(IST)
+    return is_trading_day(now.date()) and NSE_OPEN <= now.time() < NSE_CLOSE
+
+
+def next_market_open(now: Optional[datetime] = None) -> datetime:
+    """Start of the next trading session (now, if the market is open)"""
+    now = (now or datetime.now(IST)).astimezone(IST)
+    if is_market_open(now):
+        return now
+
+    day = now.date()
+    if now.time() >= NSE_OPEN:
+        day += timedelta(days=1)
+    while not is_trading_day(day):
+        day += timedelta(days=1)
+    return datetime.combine(day, NSE_OPEN, tzinfo=IST)
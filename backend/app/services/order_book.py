@@ -0,0 +1,208 @@
+import asyncio
+import heapq
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set
+import logging
+
+logger = logging.getLogger(__name__)
+
+ORDER_MARKET = "market"
+ORDER_LIMIT = "limit"
+ORDER_STOP = "stop"
+ORDER_TYPES = (ORDER_MARKET, ORDER_LIMIT, ORDER_STOP)
+
+
+class RestingOrder:
+    """A limit or stop order waiting for the market to reach its trigger price"""
+
+    __slots__ = ("id", "user_id", "symbol", "action", "order_type", "quantity",
+                 "trigger_price", "notes", "created_at", "active")
+
+    def __init__(self, id: str, user_id: str, symbol: str, action: str, order_type: str,
+                 quantity: int, trigger_price: float, notes: Optional[str], created_at: str):
+        self.id = id
+        self.user_id = user_id
+        self.symbol = symbol
+        self.action = action
+        self.order_type = order_type
+        self.quantity = quantity
+        self.trigger_price = trigger_price
+        self.notes = notes
+        self.created_at = created_at
+        self.active = True
+
+    def is_triggered(self, price: float) -> bool:
+        """Whether a quote at ``price`` fills (limit) or triggers (stop) this order"""
+        return _crosses(self.action, self.order_type, self.trigger_price, price)
+
+
+def _crosses(action: str, order_type: str, trigger_price: float, price: float) -> bool:
+    if order_type == ORDER_LIMIT:
+        return price <= trigger_price if action == "buy" else price >= trigger_price
+    # Stops trigger when the market moves through them
+    return price >= trigger_price if action == "buy" else price <= trigger_price
+
+
+class PriceLevels:
+    """One side of a symbol's book: FIFO queues per price level, best level first.
+
+    A heap over the distinct price levels finds the next level to cross in
+    O(log levels); the orders within a level keep arrival order, giving
+    price-time priority. Cancelled orders are skipped when reached rather
+    than searched for.
+    """
+
+    def __init__(self, action: str, order_type: str):
+        self.action = action
+        self.order_type = order_type
+        # Buy limits and sell stops are crossed highest price first
+        descending = (action == "buy") == (order_type == ORDER_LIMIT)
+        self.sign = -1 if descending else 1
+        self.heap: List[float] = []
+        self.levels: Dict[float, Deque[RestingOrder]] = {}
+
+    def add(self, order: RestingOrder):
+        level = self.levels.get(order.trigger_price)
+        if level is None:
+            level = self.levels[order.trigger_price] = deque()
+            heapq.heappush(self.heap, self.sign * order.trigger_price)
+        level.append(order)
+
+    def pop_crossed(self, price: float) -> List[RestingOrder]:
+        """Remove and return the orders a quote at ``price`` crosses, in priority order"""
+        crossed = []
+        while self.heap:
+            level_price = self.sign * self.heap[0]
+            level = self.levels[level_price]
+            while level and not level[0].active:
+                level.popleft()
+            if level and not _crosses(self.action, self.order_type, level_price, price):
+                break
+            crossed.extend(order for order in level if order.active)
+            heapq.heappop(self.heap)
+            del self.levels[level_price]
+        return crossed
+
+
+class SymbolBook:
+    def __init__(self):
+        self.sides = {
+            (action, order_type): PriceLevels(action, order_type)
+            for action in ("buy", "sell") for order_type in (ORDER_LIMIT, ORDER_STOP)
+        }
+        self.active = 0
+
+    def add(self, order: RestingOrder):
+        self.sides[(order.action, order.order_type)].add(order)
+        self.active += 1
+
+    def match(self, price: float) -> List[RestingOrder]:
+        crossed = []
+        for side in self.sides.values():
+            crossed.extend(side.pop_crossed(price))
+        self.active -= len(crossed)
+        return crossed
+
+
+class OrderMatchingEngine:
+    """Resting limit and stop orders for paper trading, matched on quote updates.
+
+    Each quote only visits the price levels it crosses, so the cost of a
+    quote is proportional to the orders it fills, not to the number resting.
+    Crossed orders are handed to ``on_fill`` with the quote price, which
+    books them as trades.
+    """
+
+    def __init__(self, on_fill: Callable[[RestingOrder, float], Awaitable[None]]):
+        self.on_fill = on_fill
+        self.books: Dict[str, SymbolBook] = {}
+        self.orders: Dict[str, RestingOrder] = {}
+        self.user_orders: Dict[str, Set[str]] = {}
+        # Called when the set of symbols with resting orders changes
+        self.on_symbols_changed: Optional[Callable[[], None]] = None
+        self.fill_tasks: Set[asyncio.Task] = set()
+        self.stats = {"placed": 0, "triggered": 0, "cancelled": 0, "quotes": 0}
+
+    def symbols(self) -> Iterable[str]:
+        """Symbols that need quotes because orders rest on them"""
+        return self.books.keys()
+
+    def add(self, order: RestingOrder):
+        book = self.books.get(order.symbol)
+        new_symbol = book is None
+        if new_symbol:
+            book = self.books[order.symbol] = SymbolBook()
+        book.add(order)
+        self.orders[order.id] = order
+        self.user_orders.setdefault(order.user_id, set()).add(order.id)
+        self.stats["placed"] += 1
+        if new_symbol:
+            self._symbols_changed()
+
+    def cancel(self, order_id: str) -> Optional[RestingOrder]:
+        """Withdraw a resting order; None if it isn't resting here"""
+        order = self.orders.get(order_id)
+        if order is None:
+            return None
+        order.active = False
+        self._forget(order)
+        self.stats["cancelled"] += 1
+
+        book = self.books.get(order.symbol)
+        if book is not None:
+            book.active -= 1
+            if book.active <= 0:
+                del self.books[order.symbol]
+                self._symbols_changed()
+        return order
+
+    def _forget(self, order: RestingOrder):
+        self.orders.pop(order.id, None)
+        owned = self.user_orders.get(order.user_id)
+        if owned is not None:
+            owned.discard(order.id)
+            if not owned:
+                del self.user_orders[order.user_id]
+
+    def orders_for(self, user_id: str) -> List[RestingOrder]:
+        return [self.orders[order_id] for order_id in self.user_orders.get(user_id, ())]
+
+    def on_quote(self, symbol: str, market_data: Dict):
+        """Match a fresh quote against the symbol's resting orders"""
+        book = self.books.get(symbol)
+        price = market_data.get("price")
+        if book is None or not price:
+            return
+        self.stats["quotes"] += 1
+
+        crossed = book.match(price)
+        if book.active <= 0:
+            del self.books[symbol]
+            self._symbols_changed()
+
+        for order in crossed:
+            order.active = False
+            self._forget(order)
+            self.stats["triggered"] += 1
+            task = asyncio.create_task(self._fill(order, price))
+            self.fill_tasks.add(task)
+            task.add_done_callback(self.fill_tasks.discard)
+
+    async def _fill(self, order: RestingOrder, price: float):
+        try:
+            await self.on_fill(order, price)
+        except Exception as e:
+            logger.error(f"Error filling paper order {order.id}: {e}")
+
+    def _symbols_changed(self):
+        if self.on_symbols_changed is not None:
+            self.on_symbols_changed()
+
+    def get_status(self) -> Dict:
+        return {
+            "resting_orders": len(self.orders),
+            "symbols": len(self.books),
+            "users": len(self.user_orders),
+            "filling": len(self.fill_tasks),
+            **self.stats
+        }
@@ -0,0 +1,270 @@
+import asyncio
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional
+import logging
+
+import pandas as pd
+from starlette.concurrency import run_in_threadpool
+
+from app.core.config import settings
+from app.core.database import supabase
+from app.services.market_data import market_data_service
+from app.services.market_hours import IST, NSE_CLOSE, is_market_open, is_trading_day
+from app.services.paper_ledger import UserLedger
+from app.services.paper_trading import paper_trading_service
+from app.services.rate_limiter import PRIORITY_PREFETCH
+from app.services.websocket_service import websocket_service
+
+logger = logging.getLogger(__name__)
+
+POINT_INTRADAY = "intraday"
+POINT_DAILY = "daily"
+POINT_KINDS = (POINT_INTRADAY, POINT_DAILY)
+
+# PostgREST returns at most this many rows per request by default
+READ_PAGE_SIZE = 1000
+WRITE_BATCH_SIZE = 500
+
+
+def value_portfolios(cash: pd.Series, positions: pd.DataFrame, prices: Dict[str, Optional[float]]) -> pd.DataFrame:
+    """Mark every portfolio to market in one pass.
+
+    ``cash`` is indexed by user id; ``positions`` has user_id, symbol,
+    quantity and avg_price columns. Positions without a quote are carried
+    at cost, as the portfolio view does. Returns cash, market_value,
+    invested and equity per user.
+    """
+    quotes = positions["symbol"].map(prices).astype(float)
+    marks = quotes.fillna(positions["avg_price"])
+    market_value = (positions["quantity"] * marks).groupby(positions["user_id"]).sum()
+    invested = (positions["quantity"] * positions["avg_price"]).groupby(positions["user_id"]).sum()
+
+    frame = pd.DataFrame({"cash": cash.astype(float)})
+    frame["market_value"] = market_value.reindex(frame.index, fill_value=0.0)
+    frame["invested"] = invested.reindex(frame.index, fill_value=0.0)
+    frame["equity"] = frame["cash"] + frame["market_value"]
+    return frame
+
+
+class PaperEquityService:
+    """Equity curves for paper portfolios.
+
+    While NSE is open, every portfolio is marked to market each
+    ``interval`` seconds from one shared batch of quotes, and an intraday
+    point is stored per user; after the close a daily point is stored and
+    intraday points older than ``retention_days`` are pruned. Points are
+    upserted on a timestamp rounded to the interval, so a restart or a
+    second worker overwrites rather than duplicates them. Each worker runs
+    the loop, but only the one ``is_scanner`` picks does the scans.
+    """
+
+    def __init__(self, interval: float, retention_days: int,
+                 live_ledgers: Callable[[], Iterable[UserLedger]] = lambda: (),
+                 is_scanner: Callable[[], bool] = lambda: True):
+        self.interval = interval
+        self.retention_days = retention_days
+        # In-memory ledgers are ahead of Supabase by their unflushed trades
+        self.live_ledgers = live_ledgers
+        self.is_scanner = is_scanner
+        self.task: Optional[asyncio.Task] = None
+        self.last_daily: Optional[date] = None
+        self.stats = {"runs": 0, "points": 0, "errors": 0, "last_run_seconds": 0.0}
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run_loop(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Error recording paper equity points: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def tick(self, now: Optional[datetime] = None):
+        """Record whichever point is due at ``now``"""
+        if not self.is_scanner():
+            return
+        now = (now or datetime.now(IST)).astimezone(IST)
+        if is_market_open(now):
+            bucket = now.timestamp() // self.interval * self.interval
+            await self.snapshot(POINT_INTRADAY, datetime.fromtimestamp(bucket, IST))
+        elif is_trading_day(now.date()) and now.time() >= NSE_CLOSE and self.last_daily != now.date():
+            await self.snapshot(POINT_DAILY, datetime.combine(now.date(), NSE_CLOSE, tzinfo=IST))
+            self.last_daily = now.date()
+            await self._prune_intraday(now)
+
+    async def snapshot(self, kind: str, ts: datetime) -> int:
+        """Value every portfolio and store one ``kind`` point per user at ``ts``"""
+        started = asyncio.get_running_loop().time()
+        cash_rows, position_rows = await asyncio.gather(
+            self._read_all(
+                lambda: supabase.table("user_portfolios").select("user_id, cash_balance").order("id")
+            ),
+            self._read_all(
+                lambda: supabase.table("paper_positions").select("user_id, symbol, quantity, avg_price").order("id")
+            )
+        )
+
+        cash = pd.Series({row["user_id"]: row["cash_balance"] for row in cash_rows}, dtype=float)
+        positions = pd.DataFrame(position_rows, columns=["user_id", "symbol", "quantity", "avg_price"])
+
+        live = list(self.live_ledgers())
+        if live:
+            live_ids = [ledger.user_id for ledger in live]
+            positions = pd.concat([
+                positions[~positions["user_id"].isin(live_ids)],
+                pd.DataFrame(
+                    [(ledger.user_id, symbol, position.quantity, position.avg_price)
+                     for ledger in live for symbol, position in ledger.positions.items()],
+                    columns=positions.columns
+                )
+            ], ignore_index=True)
+            cash = pd.concat([cash.drop(live_ids, errors="ignore"),
+                              pd.Series({ledger.user_id: ledger.cash_balance for ledger in live}, dtype=float)])
+
+        if cash.empty:
+            return 0
+
+        # One quote per held symbol, shared by every portfolio holding it
+        symbols = positions["symbol"].unique().tolist()
+        prices = await market_data_service.get_multiple_prices(symbols, PRIORITY_PREFETCH) if symbols else {}
+        valued = value_portfolios(cash, positions.astype({"quantity": float, "avg_price": float}), prices)
+
+        timestamp = ts.isoformat()
+        rows = [
+            {
+                "user_id": user_id,
+                "kind": kind,
+                "ts": timestamp,
+                "equity": round(equity, 2),
+                "cash": round(cash_balance, 2),
+                "invested": round(invested, 2)
+            }
+            for user_id, equity, cash_balance, invested in zip(
+                valued.index, valued["equity"], valued["cash"], valued["invested"]
+            )
+        ]
+        for start in range(0, len(rows), WRITE_BATCH_SIZE):
+            batch = rows[start:start + WRITE_BATCH_SIZE]
+            await run_in_threadpool(
+                lambda: supabase.table("paper_equity_points")
+                .upsert(batch, on_conflict="user_id,kind,ts")
+                .execute()
+            )
+
+        self.stats["runs"] += 1
+        self.stats["points"] += len(rows)
+        self.stats["last_run_seconds"] = round(asyncio.get_running_loop().time() - started, 3)
+        logger.info(f"Recorded {len(rows)} {kind} paper equity points for {ts.isoformat()}")
+        return len(rows)
+
+    async def _prune_intraday(self, now: datetime):
+        cutoff = (now - timedelta(days=self.retention_days)).isoformat()
+        await run_in_threadpool(
+            lambda: supabase.table("paper_equity_points")
+            .delete()
+            .eq("kind", POINT_INTRADAY)
+            .lt("ts", cutoff)
+            .execute()
+        )
+
+    async def _read_all(self, query: Callable) -> List[Dict]:
+        """Every row of ``query()``, read a page at a time"""
+        rows = []
+        start = 0
+        while True:
+            resp = await run_in_threadpool(
+                lambda: query().range(start, start + READ_PAGE_SIZE - 1).execute()
+            )
+            page = getattr(resp, "data", None) or []
+            rows.extend(page)
+            if len(page) < READ_PAGE_SIZE:
+                return rows
+            start += READ_PAGE_SIZE
+
+    async def get_equity_curve(self, user_id: str, kind: str = POINT_DAILY,
+                               start: Optional[datetime] = None, end: Optional[datetime] = None) -> Dict:
+        """Stored equity points for a user, oldest first, with drawdown from the running peak"""
+        if kind not in POINT_KINDS:
+            raise ValueError(f"Invalid kind: {kind}. Must be one of: {', '.join(POINT_KINDS)}")
+
+        def query():
+            q = (
+                supabase.table("paper_equity_points")
+                .select("ts, equity, cash, invested")
+                .eq("user_id", user_id)
+                .eq("kind", kind)
+            )
+            if start:
+                q = q.gte("ts", start.isoformat())
+            if end:
+                q = q.lt("ts", end.isoformat())
+            return q.order("ts")
+
+        points = await self._read_all(query)
+        if not points:
+            return {
+                "kind": kind,
+                "points": [],
+                "peak_equity": 0,
+                "max_drawdown": 0,
+                "max_drawdown_percent": 0,
+                "current_drawdown_percent": 0
+            }
+
+        equity = pd.Series([point["equity"] for point in points], dtype=float)
+        peak = equity.cummax()
+        drawdown = equity - peak
+        drawdown_percent = (drawdown / peak.where(peak > 0)).fillna(0) * 100
+        for point, value in zip(points, drawdown_percent):
+            point["drawdown_percent"] = round(value, 4)
+
+        return {
+            "kind": kind,
+            "points": points,
+            "peak_equity": float(peak.iloc[-1]),
+            "max_drawdown": float(drawdown.min()),
+            "max_drawdown_percent": float(drawdown_percent.min()),
+            "current_drawdown_percent": float(drawdown_percent.iloc[-1])
+        }
+
+    def get_status(self) -> Dict:
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "scanning": self.is_scanner(),
+            "interval_seconds": self.interval,
+            "last_daily": self.last_daily.isoformat() if self.last_daily else None,
+            **self.stats
+        }
+
+
+def _leads_market_data() -> bool:
+    """Scan on the worker that polls upstream: the bus leader, or every worker without a bus"""
+    bus = websocket_service.bus
+    return bus is None or not bus.connected or bus.is_leader
+
+
+def _live_ledgers() -> Iterable[UserLedger]:
+    ledger = paper_trading_service.ledger
+    return list(ledger.ledgers.values()) if ledger is not None else []
+
+
+# Global instance
+paper_equity_service = PaperEquityService(
+    interval=settings.paper_equity_interval,
+    retention_days=settings.paper_equity_intraday_retention_days,
+    live_ledgers=_live_ledgers,
+    is_scanner=_leads_market_data
+)
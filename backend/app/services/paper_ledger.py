@@ -0,0 +1,459 @@
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+import logging
+
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import fcntl
+except ImportError:  # Windows: one journal, no cross-process locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Most journal slots tried before giving up (one per concurrently running worker)
+MAX_JOURNAL_SLOTS = 64
+
+
+class LedgerUnavailableError(RuntimeError):
+    """Another process already runs the paper ledger for this journal directory"""
+
+
+class LedgerPosition:
+    __slots__ = ("quantity", "avg_price")
+
+    def __init__(self, quantity: float, avg_price: float):
+        self.quantity = quantity
+        self.avg_price = avg_price
+
+
+class UserLedger:
+    """Cash, positions and trade counts for one active paper trader.
+
+    ``lock`` serializes the user's orders: validation, journaling and the
+    in-memory update happen under it, so two concurrent orders can't both
+    spend the same cash.
+    """
+
+    def __init__(self, user_id: str, cash_balance: float, positions: Dict[str, LedgerPosition],
+                 trades_total: int, trades_today: int):
+        self.user_id = user_id
+        self.cash_balance = cash_balance
+        self.positions = positions
+        self.trades_total = trades_total
+        self.trades_today = trades_today
+        self.today = datetime.utcnow().date()
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        # Set once the ledger is dropped; holders of a stale reference must re-fetch
+        self.retired = False
+
+    def snapshot(self) -> "UserLedger":
+        """Detached copy for trying out trades without touching this ledger"""
+        positions = {
+            symbol: LedgerPosition(position.quantity, position.avg_price)
+            for symbol, position in self.positions.items()
+        }
+        return UserLedger(self.user_id, self.cash_balance, positions, self.trades_total, self.trades_today)
+
+    def check(self, symbol: str, action: str, quantity: float, total_value: float):
+        """Raise ValueError if the trade isn't covered by cash or holdings"""
+        if action == "buy":
+            if self.cash_balance < total_value:
+                raise ValueError(
+                    f"Insufficient funds. Required: ₹{total_value:,.2f}, Available: ₹{self.cash_balance:,.2f}"
+                )
+        elif action == "sell":
+            position = self.positions.get(symbol)
+            available = position.quantity if position is not None else 0
+            if available < quantity:
+                raise ValueError(f"Insufficient shares. Required: {quantity}, Available: {available}")
+        else:
+            raise ValueError(f"Invalid action: {action}. Must be 'buy' or 'sell'")
+
+    def apply(self, trade: Dict):
+        """Apply a validated trade, mirroring execute_paper_trades in SQL"""
+        symbol = trade["symbol"]
+        quantity = trade["quantity"]
+        price = trade["price"]
+        total_value = quantity * price
+        position = self.positions.get(symbol)
+
+        if trade["action"] == "buy":
+            self.cash_balance -= total_value
+            if position is None:
+                self.positions[symbol] = LedgerPosition(quantity, price)
+            else:
+                new_quantity = position.quantity + quantity
+                position.avg_price = (position.quantity * position.avg_price + total_value) / new_quantity
+                position.quantity = new_quantity
+        else:
+            self.cash_balance += total_value
+            if position is not None:
+                position.quantity -= quantity
+                if position.quantity <= 0:
+                    del self.positions[symbol]
+
+        # Trades are stamped in UTC, and so are the per-day counts
+        today = datetime.utcnow().date()
+        if self.today != today:
+            self.today = today
+            self.trades_today = 0
+        self.trades_total += 1
+        self.trades_today += 1
+
+
+class TradeJournal:
+    """Append-only, fsynced log of trades not yet persisted to Supabase.
+
+    Each worker owns one journal file, claimed with an flock so concurrent
+    workers never share one. Journals left by workers that are gone are
+    adopted on startup, so their trades are replayed by someone.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path: Optional[str] = None
+        self.file = None
+        self.owner_handle = None
+        self.write_lock = threading.Lock()
+        # Entries appended since the last rewrite, which a rewrite based on
+        # an older snapshot of the pending trades must not lose
+        self.appended: List[Dict] = []
+
+    def _slot_path(self, slot: int) -> str:
+        return os.path.join(self.directory, f"journal-{slot}.jsonl")
+
+    def _try_lock(self, handle) -> bool:
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def claim_owner(self) -> bool:
+        """Take the directory-wide owner lock; False if a live process holds it"""
+        os.makedirs(self.directory, exist_ok=True)
+        handle = open(os.path.join(self.directory, "owner.lock"), "a+")
+        if not self._try_lock(handle):
+            handle.close()
+            return False
+        self.owner_handle = handle
+        return True
+
+    def open(self) -> List[Dict]:
+        """Claim a journal slot; returns the trades found in it and in orphaned slots"""
+        os.makedirs(self.directory, exist_ok=True)
+        for slot in range(MAX_JOURNAL_SLOTS if fcntl is not None else 1):
+            handle = open(self._slot_path(slot), "a+")
+            if self._try_lock(handle):
+                self.path = self._slot_path(slot)
+                self.file = handle
+                break
+            handle.close()
+        else:
+            raise RuntimeError(f"No free paper ledger journal slot in {self.directory}")
+
+        trades = self._read(self.path)
+        for slot in range(MAX_JOURNAL_SLOTS if fcntl is not None else 1):
+            path = self._slot_path(slot)
+            if path == self.path or not os.path.exists(path):
+                continue
+            handle = open(path, "a+")
+            if not self._try_lock(handle):
+                handle.close()  # owned by a live worker
+                continue
+            orphaned = self._read(path)
+            if orphaned:
+                logger.warning(f"Adopting {len(orphaned)} unpersisted paper trade(s) from {path}")
+            trades.extend(orphaned)
+            # Safe to delete once they're in our own journal
+            self.rewrite(trades)
+            os.unlink(path)
+            handle.close()
+        return trades
+
+    def _read(self, path: str) -> List[Dict]:
+        trades = []
+        with open(path) as handle:
+            for line in handle:
+                try:
+                    trades.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A torn final line from a crash mid-write was never acknowledged
+                    logger.warning(f"Skipping unreadable paper ledger journal line in {path}")
+        return trades
+
+    def append(self, entries: List[Dict]):
+        """Durably record trades with one write and fsync (blocking; call from a thread)"""
+        lines = "".join(json.dumps(entry, separators=(",", ":")) + "\n" for entry in entries)
+        with self.write_lock:
+            self.file.write(lines)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.appended.extend(entries)
+
+    def rewrite(self, entries: List[Dict], snapshot_seq: Optional[int] = None):
+        """Replace the journal with just ``entries`` (blocking; call from a thread)
+
+        ``entries`` is a snapshot of the pending trades up to ``snapshot_seq``;
+        trades journaled after it are carried over as well.
+        """
+        with self.write_lock:
+            if snapshot_seq is not None:
+                entries = entries + [entry for entry in self.appended if entry["seq"] > snapshot_seq]
+            self.appended = []
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w") as handle:
+                for entry in entries:
+                    handle.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                handle.flush()
+                os.fsync(handle.fileno())
+            os.replace(temp_path, self.path)
+            # Keep the lock on the new file before letting go of the old one
+            new_file = open(self.path, "a+")
+            self._try_lock(new_file)
+            self.file.close()
+            self.file = new_file
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.owner_handle is not None:
+            self.owner_handle.close()
+            self.owner_handle = None
+
+
+class PaperLedger:
+    """In-process ledger for active paper traders with write-behind persistence.
+
+    Orders are validated against and applied to the in-memory ledger, written
+    to the local journal, and acknowledged; a background task then books them
+    in Supabase in per-user batches (one ``execute_paper_trades`` call each).
+    A trade only leaves the journal once Supabase has it, and the function
+    skips trade ids it has already booked, so replaying after a crash is safe.
+
+    The ledger is per process: with several workers, a user's orders should
+    reach the same worker (sticky routing), or the ledger should be disabled.
+    """
+
+    def __init__(self, journal_dir: str,
+                 load: Callable[[str], Awaitable[UserLedger]],
+                 book: Callable[[str, List[Dict]], Awaitable[Dict]],
+                 flush_interval: float, batch_size: int, idle_seconds: float,
+                 on_rejected: Callable[[str, Dict, str], Awaitable[None]]):
+        self.journal = TradeJournal(journal_dir)
+        self.load = load
+        self.book = book
+        # Records a trade that was acknowledged but that Supabase refused
+        self.on_rejected = on_rejected
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.idle_seconds = idle_seconds
+        self.ledgers: Dict[str, UserLedger] = {}
+        # Trades acknowledged but not yet in Supabase, per user in order
+        self.pending: Dict[str, List[Dict]] = {}
+        # Held while a user's ledger is loaded or their trades are flushed,
+        # so a load never misses or double-counts an in-flight batch
+        self.persist_locks: Dict[str, asyncio.Lock] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.flush_wakeup = asyncio.Event()
+        self.seq = itertools.count(1)
+        self.stats = {"trades": 0, "flushes": 0, "flushed_trades": 0, "flush_errors": 0, "rejected_trades": 0}
+
+    async def start(self):
+        """Replay the journal and start the write-behind task.
+
+        Only one process may run the ledger: each would validate orders
+        against its own copy of a user's cash. Raises LedgerUnavailableError
+        if another process already does.
+        """
+        if not await run_in_threadpool(self.journal.claim_owner):
+            raise LedgerUnavailableError(
+                f"another process already runs the paper ledger in {self.journal.directory}"
+            )
+        replayed = await run_in_threadpool(self.journal.open)
+        self.seq = itertools.count(max((trade.get("seq", 0) for trade in replayed), default=0) + 1)
+        seen = set()
+        for trade in replayed:
+            if trade["id"] in seen:
+                continue
+            seen.add(trade["id"])
+            self.pending.setdefault(trade["user_id"], []).append(trade)
+        if replayed:
+            logger.info(f"Replaying {len(seen)} unpersisted paper trade(s) from the journal")
+
+        self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Persist everything still pending, then stop"""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+        await self.flush()
+        self.journal.close()
+
+    def _persist_lock(self, user_id: str) -> asyncio.Lock:
+        lock = self.persist_locks.get(user_id)
+        if lock is None:
+            lock = self.persist_locks[user_id] = asyncio.Lock()
+        return lock
+
+    async def get(self, user_id: str) -> UserLedger:
+        """The user's ledger, loaded from Supabase on first use"""
+        ledger = self.ledgers.get(user_id)
+        if ledger is None:
+            async with self._persist_lock(user_id):
+                ledger = self.ledgers.get(user_id)
+                if ledger is None:
+                    ledger = await self.load(user_id)
+                    # Trades not yet in Supabase still count
+                    for trade in self.pending.get(user_id, []):
+                        ledger.apply(trade)
+                    self.ledgers[user_id] = ledger
+        ledger.last_used = time.monotonic()
+        return ledger
+
+    async def record(self, ledger: UserLedger, trade: Dict):
+        """Journal a validated trade and apply it; call with ``ledger.lock`` held"""
+        await self.record_many(ledger, [trade])
+
+    async def record_many(self, ledger: UserLedger, trades: List[Dict]):
+        """Journal validated trades in one write and apply them in order; call with ``ledger.lock`` held"""
+        entries = [dict(trade, user_id=ledger.user_id, seq=next(self.seq)) for trade in trades]
+        queue = self.pending.setdefault(ledger.user_id, [])
+        # Queued before the journal write so a concurrent rewrite keeps them
+        queue.extend(entries)
+        try:
+            await run_in_threadpool(self.journal.append, entries)
+        except Exception:
+            for entry in entries:
+                queue.remove(entry)
+            raise
+
+        for entry in entries:
+            ledger.apply(entry)
+        self.stats["trades"] += len(entries)
+        if len(queue) >= self.batch_size:
+            self.flush_wakeup.set()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_wakeup.clear()
+            try:
+                await self.flush()
+                self._evict_idle()
+            except Exception as e:
+                logger.error(f"Error in paper ledger flush loop: {e}")
+
+    async def flush(self):
+        """Book every user's pending trades in Supabase"""
+        users = [user_id for user_id, trades in self.pending.items() if trades]
+        if not users:
+            return
+        results = await asyncio.gather(*(self.flush_user(user_id) for user_id in users), return_exceptions=True)
+        if any(result is True for result in results):
+            # Compact: the journal only needs what is still pending
+            snapshot_seq = next(self.seq)
+            entries = [trade for trades in self.pending.values() for trade in trades]
+            await run_in_threadpool(self.journal.rewrite, entries, snapshot_seq)
+
+    async def flush_user(self, user_id: str) -> bool:
+        """Book one user's pending trades; returns True if any left the queue"""
+        async with self._persist_lock(user_id):
+            queue = self.pending.get(user_id)
+            if not queue:
+                return False
+            batch = queue[:self.batch_size]
+            trades = [
+                {key: value for key, value in trade.items() if key not in ("user_id", "seq")}
+                for trade in batch
+            ]
+
+            try:
+                try:
+                    await self.book(user_id, trades)
+                except ValueError as e:
+                    # Supabase disagrees with the ledger (e.g. the portfolio was
+                    # changed elsewhere); salvage what it accepts one by one
+                    logger.error(f"Supabase rejected a paper trade batch for {user_id}: {e}")
+                    await self._book_individually(user_id, trades)
+            except Exception as e:
+                # Supabase unreachable: keep the batch and retry next cycle;
+                # trades it already booked are skipped by id
+                self.stats["flush_errors"] += 1
+                logger.warning(f"Paper trade flush failed for {user_id}, will retry: {e}")
+                return False
+
+            del queue[:len(batch)]
+            if not queue:
+                del self.pending[user_id]
+            self.stats["flushes"] += 1
+            self.stats["flushed_trades"] += len(batch)
+            return True
+
+    async def _book_individually(self, user_id: str, trades: List[Dict]):
+        # The in-memory state no longer matches; reload it on next use
+        self._retire(user_id)
+        for trade in trades:
+            try:
+                await self.book(user_id, [trade])
+            except ValueError as e:
+                # Already acknowledged to the client, so record the rejection
+                # where the user can see it rather than just dropping it
+                logger.error(f"Paper trade {trade['id']} rejected by Supabase after acknowledgement: {e}")
+                await self.on_rejected(user_id, trade, str(e))
+                self.stats["rejected_trades"] += 1
+
+    def _retire(self, user_id: str):
+        ledger = self.ledgers.pop(user_id, None)
+        if ledger is not None:
+            ledger.retired = True
+
+    def _evict_idle(self):
+        """Drop ledgers of users who stopped trading and have nothing pending"""
+        cutoff = time.monotonic() - self.idle_seconds
+        for user_id, ledger in list(self.ledgers.items()):
+            if ledger.last_used < cutoff and not self.pending.get(user_id) and not ledger.lock.locked():
+                self._retire(user_id)
+                self.persist_locks.pop(user_id, None)
+
+    async def apply_external_change(self, user_id: str, change: Callable[[], Awaitable]):
+        """Run a direct Supabase change to a user's portfolio, such as a reset.
+
+        The user's pending trades are persisted first and the ledger is
+        dropped, so the next read reloads the changed state.
+        """
+        ledger = await self.get(user_id)
+        async with ledger.lock:
+            while self.pending.get(user_id):
+                if not await self.flush_user(user_id):
+                    raise RuntimeError("Pending paper trades could not be persisted, try again shortly")
+            self._retire(user_id)
+            async with self._persist_lock(user_id):
+                await change()
+
+    def get_status(self) -> Dict:
+        return {
+            "active_users": len(self.ledgers),
+            "pending_trades": sum(len(trades) for trades in self.pending.values()),
+            "journal": self.journal.path,
+            **self.stats
+        }
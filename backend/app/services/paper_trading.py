@@ -1,308 +1,658 @@
+import asyncio
+import os
 import uuid
-from datetime import datetime, date
-from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 import pandas as pd
 from app.services.market_data import market_data_service
+from app.services.rate_limiter import PRIORITY_TRADE
+from app.core.config import settings
 from app.core.database import supabase
+from app.services.trade_cursor import after_cursor_filter, encode_cursor
+from app.services.paper_ledger import LedgerPosition, LedgerUnavailableError, PaperLedger, UserLedger
+from app.services.order_book import (
+    ORDER_LIMIT, ORDER_MARKET, ORDER_TYPES, OrderMatchingEngine, RestingOrder
+)
+from postgrest.exceptions import APIError
 from starlette.concurrency import run_in_threadpool
 import logging
 
 logger = logging.getLogger(__name__)
 
+# SQLSTATE of the RAISE EXCEPTION in execute_paper_trades for a rejected order
+TRADE_REJECTED_SQLSTATE = "P0001"
+
+# Columns a trade history request may project
+TRADE_HISTORY_COLUMNS = (
+    "id", "user_id", "symbol", "action", "quantity", "price", "order_type", "total_value",
+    "notes", "status", "realized_pnl", "created_at", "executed_at"
+)
+MAX_TRADE_PAGE_SIZE = 500
+# A triggered order not settled for this long was claimed by a worker that died mid-fill
+STALE_TRIGGER_SECONDS = 60
+
+
 class PaperTradingService:
     """Service for paper trading operations"""
     
     def __init__(self):
         self.initial_cash = 1000000  # Default virtual cash: ₹10,00,000
+        self.ledger: Optional[PaperLedger] = None
+        if settings.paper_ledger_enabled:
+            self.ledger = PaperLedger(
+                settings.paper_ledger_journal_dir,
+                load=self._load_ledger,
+                book=self._book_trades,
+                flush_interval=settings.paper_ledger_flush_interval,
+                batch_size=settings.paper_ledger_flush_batch,
+                idle_seconds=settings.paper_ledger_idle_seconds,
+                on_rejected=self._record_rejected_trade
+            )
+        self.order_engine = OrderMatchingEngine(on_fill=self._fill_resting_order)
+    
+    async def start_ledger(self):
+        """Start the in-memory ledger, or fall back to direct booking if it can't run here.
+        
+        The ledger validates orders against this process's copy of each
+        user's cash and positions, so it must be the only process taking
+        paper orders.
+        """
+        if self.ledger is None:
+            return
+        
+        workers = int(os.environ.get("WEB_CONCURRENCY") or 1)
+        try:
+            if workers > 1:
+                raise LedgerUnavailableError(f"WEB_CONCURRENCY is {workers}")
+            await self.ledger.start()
+        except LedgerUnavailableError as e:
+            logger.error(
+                f"Paper ledger disabled, booking paper trades directly: {e}. "
+                "PAPER_LEDGER_ENABLED needs a single worker."
+            )
+            self.ledger = None
     
     async def get_user_portfolio(self, user_id: str) -> Dict:
         """Get user's portfolio summary"""
         try:
-            # Get user's cash balance
-            cash_resp = await run_in_threadpool(
+            if self.ledger is not None:
+                # Active traders are served from memory
+                ledger = await self.ledger.get(user_id)
+                position_rows = [
+                    {"symbol": symbol, "quantity": position.quantity, "avg_price": position.avg_price}
+                    for symbol, position in ledger.positions.items()
+                ]
+                return await self._summarize_portfolio(
+                    ledger.cash_balance, position_rows, ledger.trades_total, ledger.trades_today
+                )
+            
+            return await self._summarize_portfolio(*await self._read_portfolio(user_id))
+            
+        except Exception as e:
+            logger.error(f"Error getting portfolio for user {user_id}: {e}")
+            raise
+    
+    async def _read_portfolio(self, user_id: str) -> Tuple[float, List[Dict], int, int]:
+        """Cash balance, position rows and trade counts from Supabase"""
+        today = datetime.utcnow().date().isoformat()
+        # Cash, positions and the trade aggregates are independent reads
+        cash_resp, positions_resp, stats_resp, today_resp = await asyncio.gather(
+            run_in_threadpool(
                 lambda: supabase.table("user_portfolios")
                 .select("cash_balance")
                 .eq("user_id", user_id)
                 .execute()
-            )
-            
-            cash_balance = self.initial_cash
-            if getattr(cash_resp, "data", None) and len(cash_resp.data) > 0:
-                cash_balance = cash_resp.data[0].get("cash_balance", self.initial_cash)
-            else:
-                # Initialize portfolio if doesn't exist
-                await self._initialize_portfolio(user_id)
-            
-            # Get user's positions
-            positions_resp = await run_in_threadpool(
+            ),
+            run_in_threadpool(
                 lambda: supabase.table("paper_positions")
                 .select("*")
                 .eq("user_id", user_id)
                 .execute()
-            )
-            
-            positions = []
-            total_invested = 0
-            total_market_value = 0
-            
-            if getattr(positions_resp, "data", None):
-                for pos_data in positions_resp.data:
-                    symbol = pos_data["symbol"]
-                    quantity = pos_data["quantity"]
-                    avg_price = pos_data["avg_price"]
-                    
-                    # Get current price
-                    try:
-                        current_price = await market_data_service.get_current_price(symbol)
-                        market_value = quantity * current_price
-                        invested_value = quantity * avg_price
-                        unrealized_pnl = market_value - invested_value
-                        unrealized_pnl_percent = (unrealized_pnl / invested_value) * 100 if invested_value > 0 else 0
-                        
-                        position = {
-                            "symbol": symbol,
-                            "quantity": quantity,
-                            "avg_price": avg_price,
-                            "current_price": current_price,
-                            "market_value": market_value,
-                            "unrealized_pnl": unrealized_pnl,
-                            "unrealized_pnl_percent": unrealized_pnl_percent,
-                            "total_invested": invested_value
-                        }
-                        
-                        positions.append(position)
-                        total_invested += invested_value
-                        total_market_value += market_value
-                        
-                    except Exception as e:
-                        logger.error(f"Error getting price for {symbol}: {e}")
-                        # Use avg_price as fallback
-                        position = {
-                            "symbol": symbol,
-                            "quantity": quantity,
-                            "avg_price": avg_price,
-                            "current_price": avg_price,
-                            "market_value": quantity * avg_price,
-                            "unrealized_pnl": 0,
-                            "unrealized_pnl_percent": 0,
-                            "total_invested": quantity * avg_price
-                        }
-                        positions.append(position)
-                        total_invested += quantity * avg_price
-                        total_market_value += quantity * avg_price
-            
-            # Calculate portfolio metrics
-            total_value = cash_balance + total_market_value
-            total_pnl = total_market_value - total_invested
-            total_pnl_percent = (total_pnl / total_invested) * 100 if total_invested > 0 else 0
-            
-            # Get trade counts
-            trades_resp = await run_in_threadpool(
-                lambda: supabase.table("paper_trading_trades")
-                .select("id, created_at")
+            ),
+            run_in_threadpool(
+                lambda: supabase.table("paper_trading_stats")
+                .select("total_trades")
+                .eq("user_id", user_id)
+                .execute()
+            ),
+            run_in_threadpool(
+                lambda: supabase.table("paper_trading_days")
+                .select("trades")
                 .eq("user_id", user_id)
+                .eq("day", today)
                 .execute()
             )
+        )
+        
+        cash_balance = self.initial_cash
+        if getattr(cash_resp, "data", None) and len(cash_resp.data) > 0:
+            cash_balance = cash_resp.data[0].get("cash_balance", self.initial_cash)
+        else:
+            # Initialize portfolio if doesn't exist
+            await self._initialize_portfolio(user_id)
+        
+        trades_total = stats_resp.data[0]["total_trades"] if getattr(stats_resp, "data", None) else 0
+        trades_today = today_resp.data[0]["trades"] if getattr(today_resp, "data", None) else 0
+        
+        return cash_balance, getattr(positions_resp, "data", None) or [], trades_total, trades_today
+    
+    async def _load_ledger(self, user_id: str) -> UserLedger:
+        """Build a user's in-memory ledger from Supabase"""
+        cash_balance, position_rows, trades_total, trades_today = await self._read_portfolio(user_id)
+        positions = {
+            row["symbol"]: LedgerPosition(row["quantity"], row["avg_price"]) for row in position_rows
+        }
+        return UserLedger(user_id, cash_balance, positions, trades_total, trades_today)
+    
+    async def _summarize_portfolio(self, cash_balance: float, position_rows: List[Dict],
+                                   trades_total: int, trades_today: int) -> Dict:
+        """Value positions at current prices and compute portfolio metrics"""
+        positions = []
+        total_invested = 0
+        total_market_value = 0
+        
+        if position_rows:
+            # Price every position in one batch
+            prices = await market_data_service.get_multiple_prices(
+                [pos_data["symbol"] for pos_data in position_rows]
+            )
             
-            trades_today = 0
-            trades_total = 0
-            
-            if getattr(trades_resp, "data", None):
-                trades_total = len(trades_resp.data)
-                today = date.today()
-                trades_today = sum(1 for trade in trades_resp.data 
-                                 if datetime.fromisoformat(trade["created_at"]).date() == today)
-            
-            portfolio = {
-                "total_value": total_value,
-                "cash_balance": cash_balance,
-                "invested_value": total_invested,
-                "total_pnl": total_pnl,
-                "total_pnl_percent": total_pnl_percent,
-                "positions": positions,
-                "trades_today": trades_today,
-                "trades_total": trades_total
-            }
-            
-            return portfolio
-            
-        except Exception as e:
-            logger.error(f"Error getting portfolio for user {user_id}: {e}")
-            raise
+            for pos_data in position_rows:
+                position = self._value_position(pos_data, prices.get(pos_data["symbol"]))
+                positions.append(position)
+                total_invested += position["total_invested"]
+                total_market_value += position["market_value"]
+        
+        # Calculate portfolio metrics
+        total_value = cash_balance + total_market_value
+        total_pnl = total_market_value - total_invested
+        total_pnl_percent = (total_pnl / total_invested) * 100 if total_invested > 0 else 0
+        
+        return {
+            "total_value": total_value,
+            "cash_balance": cash_balance,
+            "invested_value": total_invested,
+            "total_pnl": total_pnl,
+            "total_pnl_percent": total_pnl_percent,
+            "positions": positions,
+            "trades_today": trades_today,
+            "trades_total": trades_total
+        }
+    
+    def _value_position(self, pos_data: Dict, current_price: Optional[float]) -> Dict:
+        """Mark a position to market; falls back to avg_price without a quote"""
+        symbol = pos_data["symbol"]
+        quantity = pos_data["quantity"]
+        avg_price = pos_data["avg_price"]
+        
+        if current_price is None:
+            logger.error(f"No current price for {symbol}, valuing at average price")
+            current_price = avg_price
+        
+        market_value = quantity * current_price
+        invested_value = quantity * avg_price
+        unrealized_pnl = market_value - invested_value
+        unrealized_pnl_percent = (unrealized_pnl / invested_value) * 100 if invested_value > 0 else 0
+        
+        return {
+            "symbol": symbol,
+            "quantity": quantity,
+            "avg_price": avg_price,
+            "current_price": current_price,
+            "market_value": market_value,
+            "unrealized_pnl": unrealized_pnl,
+            "unrealized_pnl_percent": unrealized_pnl_percent,
+            "total_invested": invested_value
+        }
     
     async def execute_trade(self, user_id: str, symbol: str, action: str, 
                           quantity: int, price: Optional[float] = None, 
-                          order_type: str = "market", notes: Optional[str] = None) -> Dict:
-        """Execute a paper trade"""
+                          order_type: str = "market", notes: Optional[str] = None,
+                          stop_price: Optional[float] = None) -> Dict:
+        """Execute a paper trade, or place a limit/stop order that rests until triggered"""
         try:
-            # Get current market price if not provided
-            if price is None:
-                price = await market_data_service.get_current_price(symbol)
+            if action not in ("buy", "sell"):
+                raise ValueError(f"Invalid action: {action}. Must be 'buy' or 'sell'")
+            if order_type not in ORDER_TYPES:
+                raise ValueError(f"Invalid order type: {order_type}. Must be one of: {', '.join(ORDER_TYPES)}")
             
-            total_value = quantity * price
+            if order_type != ORDER_MARKET:
+                return await self.place_order(user_id, symbol, action, quantity, order_type,
+                                              price if order_type == ORDER_LIMIT else stop_price, notes)
             
-            # Check if user has sufficient funds/positions
-            portfolio = await self.get_user_portfolio(user_id)
-            
-            if action == "buy":
-                if portfolio["cash_balance"] < total_value:
-                    raise ValueError(f"Insufficient funds. Required: ₹{total_value:,.2f}, Available: ₹{portfolio['cash_balance']:,.2f}")
-            elif action == "sell":
-                # Check if user has sufficient quantity
-                current_position = next((pos for pos in portfolio["positions"] if pos["symbol"] == symbol), None)
-                if not current_position or current_position["quantity"] < quantity:
-                    raise ValueError(f"Insufficient shares. Required: {quantity}, Available: {current_position['quantity'] if current_position else 0}")
+            # Get current market price if not provided
+            if price is None:
+                price = await market_data_service.get_current_price(symbol, PRIORITY_TRADE)
             
-            # Create trade record
-            trade_id = uuid.uuid4()
-            now = datetime.utcnow().isoformat()
+            return await self._execute(str(uuid.uuid4()), user_id, symbol, action, quantity, price, order_type, notes)
             
-            trade_data = {
-                "id": str(trade_id),
+        except Exception as e:
+            logger.error(f"Error executing trade: {e}")
+            raise
+    
+    async def _execute(self, trade_id: str, user_id: str, symbol: str, action: str,
+                       quantity: int, price: float, order_type: str, notes: Optional[str]) -> Dict:
+        """Book a trade at ``price``; returns the PaperTradeOut fields"""
+        trade_data = self._new_trade(trade_id, symbol, action, quantity, price, order_type, notes)
+        
+        if self.ledger is not None:
+            await self._record_in_ledger(user_id, trade_data, quantity * price)
+        else:
+            # Validate, book the trade and update cash and position atomically
+            await self._book_trades(user_id, [trade_data])
+        
+        return self._executed_trade_out(user_id, trade_data)
+    
+    def _new_trade(self, trade_id: str, symbol: str, action: str, quantity: int,
+                   price: float, order_type: str, notes: Optional[str]) -> Dict:
+        """Trade record in the shape execute_paper_trades and the ledger take"""
+        return {
+            "id": trade_id,
+            "symbol": symbol,
+            "action": action,
+            "quantity": quantity,
+            "price": price,
+            "order_type": order_type,
+            "notes": notes,
+            "created_at": datetime.utcnow().isoformat()
+        }
+    
+    def _executed_trade_out(self, user_id: str, trade_data: Dict) -> Dict:
+        """The full trade data that matches PaperTradeOut model"""
+        return {
+            **trade_data,
+            "user_id": user_id,
+            "total_value": trade_data["quantity"] * trade_data["price"],
+            "executed_at": trade_data["created_at"],
+            "status": "executed"
+        }
+    
+    async def execute_basket(self, user_id: str, orders: List[Dict]) -> List[Dict]:
+        """Validate, price and book a list of market orders together.
+        
+        Orders are checked in sequence against one snapshot of the portfolio,
+        so a sell early in the basket can fund a buy after it. Unpriced
+        symbols are quoted in one batch. Orders that fail validation are
+        rejected individually; the rest are booked in a single write. Returns
+        one ``{"index", "status", "trade", "error"}`` result per order.
+        """
+        results = [{"index": index, "status": "rejected", "trade": None, "error": None}
+                   for index in range(len(orders))]
+        
+        unpriced = {
+            order["symbol"] for order in orders
+            if order.get("price") is None and order.get("order_type", ORDER_MARKET) == ORDER_MARKET
+        }
+        prices = await market_data_service.get_multiple_prices(list(unpriced), PRIORITY_TRADE) if unpriced else {}
+        
+        # Trades that pass the cheap checks, with their result slot
+        candidates: List[Tuple[Dict, Dict]] = []
+        for order, result in zip(orders, results):
+            action = order["action"]
+            order_type = order.get("order_type", ORDER_MARKET)
+            price = order.get("price")
+            if price is None:
+                price = prices.get(order["symbol"])
+            
+            if action not in ("buy", "sell"):
+                result["error"] = f"Invalid action: {action}. Must be 'buy' or 'sell'"
+            elif order_type != ORDER_MARKET:
+                result["error"] = "Basket orders must be market orders"
+            elif price is None:
+                result["error"] = f"No price available for {order['symbol']}"
+            else:
+                candidates.append((self._new_trade(
+                    str(uuid.uuid4()), order["symbol"], action, order["quantity"],
+                    price, order_type, order.get("notes")
+                ), result))
+        
+        if self.ledger is not None:
+            while True:
+                ledger = await self.ledger.get(user_id)
+                async with ledger.lock:
+                    if ledger.retired:
+                        continue  # dropped while we waited; use the reloaded one
+                    accepted = self._check_basket(ledger.snapshot(), candidates)
+                    if accepted:
+                        await self.ledger.record_many(ledger, [trade for trade, _ in accepted])
+                    break
+        else:
+            accepted = self._check_basket(await self._load_ledger(user_id), candidates)
+            if accepted:
+                try:
+                    # Still checked again in the transaction; the snapshot may be stale
+                    await self._book_trades(user_id, [trade for trade, _ in accepted])
+                except ValueError as e:
+                    for _, result in accepted:
+                        result["error"] = str(e)
+                    return results
+        
+        for trade, result in accepted:
+            result["status"] = "executed"
+            result["trade"] = self._executed_trade_out(user_id, trade)
+        return results
+    
+    def _check_basket(self, snapshot: UserLedger,
+                      candidates: List[Tuple[Dict, Dict]]) -> List[Tuple[Dict, Dict]]:
+        """Apply candidates to ``snapshot`` in order, keeping those it can cover"""
+        accepted = []
+        for trade, result in candidates:
+            try:
+                snapshot.check(trade["symbol"], trade["action"], trade["quantity"],
+                               trade["quantity"] * trade["price"])
+            except ValueError as e:
+                result["error"] = str(e)
+                continue
+            snapshot.apply(trade)
+            accepted.append((trade, result))
+        return accepted
+    
+    async def place_order(self, user_id: str, symbol: str, action: str, quantity: int,
+                          order_type: str, trigger_price: Optional[float], notes: Optional[str] = None) -> Dict:
+        """Fill a limit or stop order now if the market is already through it, otherwise rest it.
+        
+        Resting orders are matched against every quote the market data loop
+        fetches and fill at that quote. Funds and holdings are checked when
+        the order fills, not when it is placed.
+        """
+        if trigger_price is None or trigger_price <= 0:
+            field = "price" if order_type == ORDER_LIMIT else "stop_price"
+            raise ValueError(f"A {order_type} order needs a positive {field}")
+        
+        order = RestingOrder(
+            str(uuid.uuid4()), user_id, symbol, action, order_type, quantity,
+            trigger_price, notes, datetime.utcnow().isoformat()
+        )
+        
+        current_price = await market_data_service.get_current_price(symbol, PRIORITY_TRADE)
+        if order.is_triggered(current_price):
+            return await self._execute(order.id, user_id, symbol, action, quantity, current_price, order_type, notes)
+        
+        await run_in_threadpool(
+            lambda: supabase.table("paper_orders").insert({
+                "id": order.id,
                 "user_id": user_id,
                 "symbol": symbol,
                 "action": action,
-                "quantity": quantity,
-                "price": price,
                 "order_type": order_type,
-                "total_value": total_value,
-                "notes": notes,
-                "status": "executed",
-                "created_at": now,
-                "executed_at": now
-            }
-            
-            # Save trade
-            trade_resp = await run_in_threadpool(
-                lambda: supabase.table("paper_trading_trades").insert(trade_data).execute()
-            )
-            
-            if not trade_resp.data:
-                raise ValueError("Failed to save trade")
-            
-            # Update portfolio
-            await self._update_portfolio(user_id, symbol, action, quantity, price, total_value)
-            
-            # Return the full trade data that matches PaperTradeOut model
-            return {
-                "id": trade_id,
-                "user_id": user_id,
-                "symbol": symbol,
-                "action": action,
                 "quantity": quantity,
-                "price": price,
-                "order_type": order_type,
-                "total_value": total_value,
+                "trigger_price": trigger_price,
+                "status": "open",
                 "notes": notes,
-                "created_at": now,
-                "executed_at": now,
-                "status": "executed"
-            }
-            
+                "created_at": order.created_at
+            }).execute()
+        )
+        self.order_engine.add(order)
+        
+        return {
+            "id": order.id,
+            "user_id": user_id,
+            "symbol": symbol,
+            "action": action,
+            "quantity": quantity,
+            "price": trigger_price,
+            "order_type": order_type,
+            "total_value": quantity * trigger_price,
+            "notes": notes,
+            "created_at": order.created_at,
+            "executed_at": None,
+            "status": "pending"
+        }
+    
+    async def _fill_resting_order(self, order: RestingOrder, price: float):
+        """Book a triggered order at the quote that crossed it"""
+        # Claim the order first so a concurrent cancel, or another worker
+        # holding the same order, cannot also act on it
+        claim_resp = await run_in_threadpool(
+            lambda: supabase.table("paper_orders")
+            .update({"status": "triggered", "updated_at": datetime.utcnow().isoformat()})
+            .eq("id", order.id)
+            .eq("status", "open")
+            .execute()
+        )
+        if not getattr(claim_resp, "data", None):
+            return
+        
+        update = {"status": "filled", "fill_price": price}
+        try:
+            # The trade reuses the order id, so the pending and executed
+            # views of an order share one id
+            await self._execute(order.id, order.user_id, order.symbol, order.action,
+                                order.quantity, price, order.order_type, order.notes)
+        except ValueError as e:
+            logger.info(f"Rejected paper order {order.id}: {e}")
+            update = {"status": "rejected", "reason": str(e)}
         except Exception as e:
-            logger.error(f"Error executing trade: {e}")
-            raise
+            # Not booked as far as we know; rest the order again so the next
+            # crossing quote retries it (a booking that did land is skipped
+            # by trade id)
+            logger.error(f"Error filling paper order {order.id}, returning it to the book: {e}")
+            await run_in_threadpool(
+                lambda: supabase.table("paper_orders")
+                .update({"status": "open", "updated_at": datetime.utcnow().isoformat()})
+                .eq("id", order.id)
+                .eq("status", "triggered")
+                .execute()
+            )
+            order.active = True
+            self.order_engine.add(order)
+            return
+        
+        update["updated_at"] = datetime.utcnow().isoformat()
+        await run_in_threadpool(
+            lambda: supabase.table("paper_orders")
+            .update(update)
+            .eq("id", order.id)
+            .eq("status", "triggered")
+            .execute()
+        )
     
-    async def _update_portfolio(self, user_id: str, symbol: str, action: str, 
-                              quantity: int, price: float, total_value: float):
-        """Update user's portfolio after a trade"""
+    async def get_open_orders(self, user_id: str) -> List[Dict]:
+        """Get user's resting limit and stop orders, newest first"""
         try:
-            # Get current portfolio
-            portfolio_resp = await run_in_threadpool(
-                lambda: supabase.table("user_portfolios")
+            orders_resp = await run_in_threadpool(
+                lambda: supabase.table("paper_orders")
                 .select("*")
                 .eq("user_id", user_id)
+                .eq("status", "open")
+                .order("created_at", desc=True)
                 .execute()
             )
+            return getattr(orders_resp, "data", None) or []
             
-            if not getattr(portfolio_resp, "data", None) or len(portfolio_resp.data) == 0:
-                await self._initialize_portfolio(user_id)
-                portfolio_resp = await run_in_threadpool(
-                    lambda: supabase.table("user_portfolios")
-                    .select("*")
-                    .eq("user_id", user_id)
-                    .execute()
-                )
-            
-            portfolio_data = portfolio_resp.data[0]
-            cash_balance = portfolio_data["cash_balance"]
-            
-            # Update cash balance
-            if action == "buy":
-                cash_balance -= total_value
-            elif action == "sell":
-                cash_balance += total_value
-            
-            # Update cash balance
+        except Exception as e:
+            logger.error(f"Error getting open orders: {e}")
+            raise
+    
+    async def cancel_order(self, user_id: str, order_id: str) -> bool:
+        """Cancel a resting order; False if it isn't open (or isn't the user's)"""
+        cancel_resp = await run_in_threadpool(
+            lambda: supabase.table("paper_orders")
+            .update({"status": "cancelled", "updated_at": datetime.utcnow().isoformat()})
+            .eq("id", order_id)
+            .eq("user_id", user_id)
+            .eq("status", "open")
+            .execute()
+        )
+        if not getattr(cancel_resp, "data", None):
+            return False
+        self.order_engine.cancel(order_id)
+        return True
+    
+    async def reconcile_triggered_orders(self):
+        """Settle orders whose fill was claimed but never finished.
+        
+        A worker that dies between claiming an order and booking it leaves
+        the order triggered. If its trade (same id) was booked the order is
+        marked filled, otherwise it is reopened. Recent claims are left
+        alone, since another worker may still be filling them.
+        """
+        cutoff = (datetime.utcnow() - timedelta(seconds=STALE_TRIGGER_SECONDS)).isoformat()
+        orders_resp = await run_in_threadpool(
+            lambda: supabase.table("paper_orders")
+            .select("id")
+            .eq("status", "triggered")
+            .lt("updated_at", cutoff)
+            .execute()
+        )
+        stale = [row["id"] for row in getattr(orders_resp, "data", None) or []]
+        if not stale:
+            return
+        
+        trades_resp = await run_in_threadpool(
+            lambda: supabase.table("paper_trading_trades")
+            .select("id, price")
+            .in_("id", stale)
+            .execute()
+        )
+        booked = {row["id"]: row["price"] for row in getattr(trades_resp, "data", None) or []}
+        if self.ledger is not None:
+            # Replayed from the journal but not yet written to Supabase
+            for trades in self.ledger.pending.values():
+                booked.update((trade["id"], trade["price"]) for trade in trades if trade["id"] in stale)
+        
+        for order_id in stale:
+            if order_id in booked:
+                update = {"status": "filled", "fill_price": booked[order_id]}
+            else:
+                update = {"status": "open"}
+            update["updated_at"] = datetime.utcnow().isoformat()
             await run_in_threadpool(
-                lambda: supabase.table("user_portfolios")
-                .update({"cash_balance": cash_balance})
-                .eq("user_id", user_id)
+                lambda: supabase.table("paper_orders")
+                .update(update)
+                .eq("id", order_id)
+                .eq("status", "triggered")
                 .execute()
             )
-            
-            # Update positions
-            position_resp = await run_in_threadpool(
+        logger.warning(
+            f"Reconciled {len(stale)} stranded paper order(s): "
+            f"{len(booked)} filled, {len(stale) - len(booked)} reopened"
+        )
+    
+    async def load_open_orders(self):
+        """Rebuild the order book from open orders, oldest first to keep time priority.
+        
+        Orders stranded in the triggered state by a dead worker are settled first.
+        """
+        try:
+            await self.reconcile_triggered_orders()
+        except Exception as e:
+            logger.error(f"Could not reconcile triggered paper orders: {e}")
+        orders_resp = await run_in_threadpool(
+            lambda: supabase.table("paper_orders")
+            .select("*")
+            .eq("status", "open")
+            .order("created_at")
+            .execute()
+        )
+        for row in getattr(orders_resp, "data", None) or []:
+            if row["id"] in self.order_engine.orders:
+                continue
+            self.order_engine.add(RestingOrder(
+                row["id"], row["user_id"], row["symbol"], row["action"], row["order_type"],
+                row["quantity"], row["trigger_price"], row.get("notes"), row["created_at"]
+            ))
+        logger.info(f"Loaded {len(self.order_engine.orders)} open paper orders")
+    
+    async def _record_in_ledger(self, user_id: str, trade_data: Dict, total_value: float):
+        """Validate against and apply to the in-memory ledger; persisted write-behind"""
+        while True:
+            ledger = await self.ledger.get(user_id)
+            async with ledger.lock:
+                if ledger.retired:
+                    continue  # dropped while we waited; use the reloaded one
+                ledger.check(trade_data["symbol"], trade_data["action"], trade_data["quantity"], total_value)
+                await self.ledger.record(ledger, trade_data)
+                return
+    
+    async def reset_portfolio(self, user_id: str):
+        """Cancel open orders, delete all positions and restore the initial cash balance"""
+        cancel_resp = await run_in_threadpool(
+            lambda: supabase.table("paper_orders")
+            .update({"status": "cancelled", "updated_at": datetime.utcnow().isoformat()})
+            .eq("user_id", user_id)
+            .eq("status", "open")
+            .execute()
+        )
+        for row in getattr(cancel_resp, "data", None) or []:
+            self.order_engine.cancel(row["id"])
+        
+        async def reset():
+            await run_in_threadpool(
                 lambda: supabase.table("paper_positions")
-                .select("*")
+                .delete()
                 .eq("user_id", user_id)
-                .eq("symbol", symbol)
                 .execute()
             )
-            
-            if getattr(position_resp, "data", None) and len(position_resp.data) > 0:
-                # Update existing position
-                current_pos = position_resp.data[0]
-                current_quantity = current_pos["quantity"]
-                current_avg_price = current_pos["avg_price"]
-                
-                if action == "buy":
-                    new_quantity = current_quantity + quantity
-                    new_avg_price = ((current_quantity * current_avg_price) + (quantity * price)) / new_quantity
-                else:  # sell
-                    new_quantity = current_quantity - quantity
-                    new_avg_price = current_avg_price  # Keep same avg price
-                
-                if new_quantity > 0:
-                    # Update position
-                    await run_in_threadpool(
-                        lambda: supabase.table("paper_positions")
-                        .update({
-                            "quantity": new_quantity,
-                            "avg_price": new_avg_price
-                        })
-                        .eq("user_id", user_id)
-                        .eq("symbol", symbol)
-                        .execute()
-                    )
-                else:
-                    # Remove position
-                    await run_in_threadpool(
-                        lambda: supabase.table("paper_positions")
-                        .delete()
-                        .eq("user_id", user_id)
-                        .eq("symbol", symbol)
-                        .execute()
-                    )
-            else:
-                # Create new position (only for buy orders)
-                if action == "buy":
-                    position_data = {
-                        "id": str(uuid.uuid4()),
-                        "user_id": user_id,
-                        "symbol": symbol,
-                        "quantity": quantity,
-                        "avg_price": price,
-                        "created_at": datetime.utcnow().isoformat()
-                    }
-                    
-                    await run_in_threadpool(
-                        lambda: supabase.table("paper_positions").insert(position_data).execute()
-                    )
-            
-        except Exception as e:
-            logger.error(f"Error updating portfolio: {e}")
+            await run_in_threadpool(
+                lambda: supabase.table("paper_position_lots")
+                .delete()
+                .eq("user_id", user_id)
+                .execute()
+            )
+            await run_in_threadpool(
+                lambda: supabase.table("user_portfolios")
+                .update({"cash_balance": self.initial_cash})
+                .eq("user_id", user_id)
+                .execute()
+            )
+        
+        if self.ledger is not None:
+            await self.ledger.apply_external_change(user_id, reset)
+        else:
+            await reset()
+    
+    async def _book_trades(self, user_id: str, trades: List[Dict]) -> Dict:
+        """Book trades in one transaction with the execute_paper_trades function.
+        
+        The function locks the user's portfolio row, checks funds or holdings
+        for each trade in order, inserts the trade rows and applies the cash
+        and position changes (weighted average price on buys). Either every
+        trade is booked or none is. Returns the new cash balance.
+        """
+        try:
+            resp = await run_in_threadpool(
+                lambda: supabase.rpc("execute_paper_trades", {
+                    "p_user_id": user_id,
+                    "p_trades": trades,
+                    "p_initial_cash": self.initial_cash
+                }).execute()
+            )
+        except APIError as e:
+            if e.code == TRADE_REJECTED_SQLSTATE:
+                # Insufficient funds/shares, raised by the function
+                raise ValueError(e.message)
             raise
+        
+        return resp.data
+    
+    async def _record_rejected_trade(self, user_id: str, trade: Dict, reason: str):
+        """Record a ledger-acknowledged trade that Supabase refused as rejected"""
+        now = datetime.utcnow().isoformat()
+        await run_in_threadpool(
+            lambda: supabase.table("paper_trading_trades").upsert({
+                "id": trade["id"],
+                "user_id": user_id,
+                "symbol": trade["symbol"],
+                "action": trade["action"],
+                "quantity": trade["quantity"],
+                "price": trade["price"],
+                "order_type": trade.get("order_type", ORDER_MARKET),
+                "total_value": trade["quantity"] * trade["price"],
+                "notes": trade.get("notes"),
+                "status": "rejected",
+                "rejection_reason": reason,
+                "created_at": trade["created_at"]
+            }).execute()
+        )
+        # A resting order whose fill this was
+        await run_in_threadpool(
+            lambda: supabase.table("paper_orders")
+            .update({"status": "rejected", "reason": reason, "updated_at": now})
+            .eq("id", trade["id"])
+            .in_("status", ["triggered", "filled"])
+            .execute()
+        )
     
     async def _initialize_portfolio(self, user_id: str):
         """Initialize user's portfolio with default cash"""
@@ -322,38 +672,93 @@ class PaperTradingService:
             logger.error(f"Error initializing portfolio: {e}")
             raise
     
-    async def get_trade_history(self, user_id: str, limit: int = 50) -> List[Dict]:
-        """Get user's trade history"""
+    async def get_trade_history(self, user_id: str, limit: int = 50, cursor: Optional[str] = None,
+                                symbol: Optional[str] = None, action: Optional[str] = None,
+                                start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                fields: Optional[List[str]] = None) -> Tuple[List[Dict], Optional[str]]:
+        """Get one page of user's trade history, newest first.
+        
+        Pages are keyed on (created_at, id): ``cursor`` is the ``next_cursor``
+        of the previous page, so deep pages cost the same as the first.
+        ``start`` is inclusive and ``end`` exclusive. ``fields`` projects the
+        columns; created_at and id are always returned since the cursor needs
+        them. Returns the trades and the cursor of the next page, or None on
+        the last page.
+        """
         try:
-            trades_resp = await run_in_threadpool(
-                lambda: supabase.table("paper_trading_trades")
-                .select("*")
+            if not 0 < limit <= MAX_TRADE_PAGE_SIZE:
+                raise ValueError(f"limit must be between 1 and {MAX_TRADE_PAGE_SIZE}")
+            
+            columns = "*"
+            if fields:
+                unknown = [field for field in fields if field not in TRADE_HISTORY_COLUMNS]
+                if unknown:
+                    raise ValueError(f"Unknown trade fields: {', '.join(unknown)}")
+                columns = ",".join(dict.fromkeys(["id", "created_at", *fields]))
+            
+            query = (
+                supabase.table("paper_trading_trades")
+                .select(columns)
                 .eq("user_id", user_id)
+            )
+            if symbol:
+                query = query.eq("symbol", symbol)
+            if action:
+                query = query.eq("action", action)
+            if start:
+                query = query.gte("created_at", start.isoformat())
+            if end:
+                query = query.lt("created_at", end.isoformat())
+            if cursor:
+                query = query.or_(after_cursor_filter(cursor))
+            
+            # One extra row tells us whether another page follows
+            trades_resp = await run_in_threadpool(
+                lambda: query
                 .order("created_at", desc=True)
-                .limit(limit)
+                .order("id", desc=True)
+                .limit(limit + 1)
                 .execute()
             )
             
-            if getattr(trades_resp, "data", None):
-                return trades_resp.data
-            else:
-                return []
+            trades = getattr(trades_resp, "data", None) or []
+            next_cursor = None
+            if len(trades) > limit:
+                trades = trades[:limit]
+                next_cursor = encode_cursor(trades[-1])
+            return trades, next_cursor
                 
         except Exception as e:
             logger.error(f"Error getting trade history: {e}")
             raise
     
+    async def iter_trade_history(self, user_id: str, page_size: int = MAX_TRADE_PAGE_SIZE,
+                                 **filters) -> AsyncIterator[Dict]:
+        """Every trade matching the filters, newest first, fetched a page at a time"""
+        cursor = None
+        while True:
+            trades, cursor = await self.get_trade_history(user_id, page_size, cursor, **filters)
+            for trade in trades:
+                yield trade
+            if cursor is None:
+                return
+    
     async def get_trading_stats(self, user_id: str) -> Dict:
-        """Get user's trading statistics"""
+        """Get user's trading statistics.
+        
+        Served from the per-user aggregates that execute_paper_trades updates
+        as each trade is booked, including the realized P&L of sells closing
+        FIFO lots.
+        """
         try:
-            trades_resp = await run_in_threadpool(
-                lambda: supabase.table("paper_trading_trades")
+            stats_resp = await run_in_threadpool(
+                lambda: supabase.table("paper_trading_stats")
                 .select("*")
                 .eq("user_id", user_id)
                 .execute()
             )
             
-            if not getattr(trades_resp, "data", None):
+            if not getattr(stats_resp, "data", None):
                 return {
                     "total_trades": 0,
                     "winning_trades": 0,
@@ -368,44 +773,23 @@ class PaperTradingService:
                     "trading_days": 0
                 }
             
-            trades = trades_resp.data
-            
-            # Calculate statistics
-            total_trades = len(trades)
-            total_volume = sum(trade["total_value"] for trade in trades)
-            
-            # Symbol frequency
-            symbol_counts = {}
-            for trade in trades:
-                symbol = trade["symbol"]
-                symbol_counts[symbol] = symbol_counts.get(symbol, 0) + 1
-            
-            most_traded_symbol = max(symbol_counts.items(), key=lambda x: x[1])[0] if symbol_counts else ""
-            
-            # Trading days
-            trading_dates = set()
-            for trade in trades:
-                trade_date = datetime.fromisoformat(trade["created_at"]).date()
-                trading_dates.add(trade_date)
-            trading_days = len(trading_dates)
-            
-            # P&L analysis (simplified - would need more complex logic for accurate P&L)
-            # For now, we'll use portfolio P&L
-            portfolio = await self.get_user_portfolio(user_id)
-            total_pnl = portfolio["total_pnl"]
+            aggregates = stats_resp.data[0]
+            closed_trades = aggregates["closed_trades"]
+            winning_trades = aggregates["winning_trades"]
+            realized_pnl = aggregates["realized_pnl"]
             
             stats = {
-                "total_trades": total_trades,
-                "winning_trades": 0,  # Would need position tracking for accurate calculation
-                "losing_trades": 0,   # Would need position tracking for accurate calculation
-                "win_rate": 0,        # Would need position tracking for accurate calculation
-                "total_pnl": total_pnl,
-                "avg_trade_pnl": total_pnl / total_trades if total_trades > 0 else 0,
-                "best_trade": 0,      # Would need individual trade P&L calculation
-                "worst_trade": 0,     # Would need individual trade P&L calculation
-                "total_volume": total_volume,
-                "most_traded_symbol": most_traded_symbol,
-                "trading_days": trading_days
+                "total_trades": aggregates["total_trades"],
+                "winning_trades": winning_trades,
+                "losing_trades": aggregates["losing_trades"],
+                "win_rate": (winning_trades / closed_trades) * 100 if closed_trades > 0 else 0,
+                "total_pnl": realized_pnl,
+                "avg_trade_pnl": realized_pnl / closed_trades if closed_trades > 0 else 0,
+                "best_trade": aggregates["best_trade"] or 0,
+                "worst_trade": aggregates["worst_trade"] or 0,
+                "total_volume": aggregates["total_volume"],
+                "most_traded_symbol": aggregates["most_traded_symbol"] or "",
+                "trading_days": aggregates["trading_days"]
             }
             
             return stats
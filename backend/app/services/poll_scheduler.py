@@ -0,0 +1,148 @@
+import math
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional
+import logging
+
+from app.services.market_hours import is_market_open, next_market_open
+
+logger = logging.getLogger(__name__)
+
+# Smoothing for the per-symbol volatility estimate (weight of the newest move)
+VOLATILITY_ALPHA = 0.3
+
+
+class SymbolSchedule:
+    __slots__ = ("subscribers", "interval", "last_polled", "volatility", "last_price", "last_price_at")
+
+    def __init__(self):
+        self.subscribers = 0
+        self.interval = 0.0
+        self.last_polled: Optional[float] = None
+        self.volatility: Optional[float] = None
+        self.last_price: Optional[float] = None
+        self.last_price_at: Optional[float] = None
+
+
+class PollScheduler:
+    """Decides how often each subscribed symbol is refreshed upstream.
+
+    A symbol with one subscriber at reference volatility is polled every
+    ``base_interval`` seconds. More subscribers shorten the interval
+    logarithmically, and so does a recent volatility above the reference
+    (a quiet symbol is polled less often). Intervals are clamped to
+    ``[min_interval, max_interval]`` and then stretched together if their
+    combined rate would exceed ``budget`` polls per second. Outside NSE
+    trading hours every symbol is polled every ``closed_interval`` seconds.
+    """
+
+    def __init__(self, base_interval: float, min_interval: float, max_interval: float,
+                 closed_interval: float, budget: float, volatility_reference: float):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.closed_interval = closed_interval
+        self.budget = budget
+        self.volatility_reference = volatility_reference
+        self.symbols: Dict[str, SymbolSchedule] = {}
+        self.market_open = False
+        self.budget_scale = 1.0
+
+    def due(self, demand: Dict[str, int]) -> List[str]:
+        """Symbols to refresh now, given the subscriber count per wanted symbol"""
+        now = time.monotonic()
+        for symbol in list(self.symbols):
+            if symbol not in demand:
+                del self.symbols[symbol]
+        for symbol, subscribers in demand.items():
+            schedule = self.symbols.get(symbol)
+            if schedule is None:
+                schedule = self.symbols[symbol] = SymbolSchedule()
+            schedule.subscribers = subscribers
+
+        self._plan()
+
+        due = []
+        for symbol, schedule in self.symbols.items():
+            if schedule.last_polled is None or now - schedule.last_polled >= schedule.interval:
+                schedule.last_polled = now
+                due.append(symbol)
+        return due
+
+    def _plan(self):
+        """Recompute every symbol's interval"""
+        self.market_open = is_market_open()
+        if not self.market_open:
+            self.budget_scale = 1.0
+            for schedule in self.symbols.values():
+                schedule.interval = self.closed_interval
+            return
+
+        for schedule in self.symbols.values():
+            demand = 1.0 + math.log2(max(schedule.subscribers, 1))
+            activity = 1.0
+            if schedule.volatility is not None and self.volatility_reference > 0:
+                activity = min(max(schedule.volatility / self.volatility_reference, 0.5), 4.0)
+            interval = self.base_interval / (demand * activity)
+            schedule.interval = min(max(interval, self.min_interval), self.max_interval)
+
+        rate = sum(1.0 / schedule.interval for schedule in self.symbols.values())
+        self.budget_scale = max(rate / self.budget, 1.0) if self.budget > 0 else 1.0
+        if self.budget_scale > 1.0:
+            for schedule in self.symbols.values():
+                schedule.interval *= self.budget_scale
+
+    def observe(self, symbol: str, price: Optional[float]):
+        """Feed a polled price into the symbol's volatility estimate"""
+        schedule = self.symbols.get(symbol)
+        if schedule is None or not price:
+            return
+
+        now = time.monotonic()
+        if schedule.last_price and price != schedule.last_price:
+            # Absolute return scaled to a one-minute horizon, so estimates
+            # are comparable whatever the polling interval was
+            elapsed = max(now - schedule.last_price_at, 1.0)
+            move = abs(price / schedule.last_price - 1.0) / math.sqrt(elapsed / 60.0)
+            if schedule.volatility is None:
+                schedule.volatility = move
+            else:
+                schedule.volatility += VOLATILITY_ALPHA * (move - schedule.volatility)
+            schedule.last_price_at = now
+        elif schedule.last_price is None:
+            schedule.last_price_at = now
+        schedule.last_price = price
+
+    def max_age(self, symbol: str) -> Optional[timedelta]:
+        """How old a cached quote may be when this symbol is polled"""
+        schedule = self.symbols.get(symbol)
+        if schedule is None or not schedule.interval:
+            return None
+        # A little under the interval, so each poll really is a refresh
+        return timedelta(seconds=schedule.interval * 0.9)
+
+    def get_status(self) -> Dict:
+        now = time.monotonic()
+        symbols = {}
+        for symbol, schedule in self.symbols.items():
+            next_in = 0.0
+            if schedule.last_polled is not None:
+                next_in = max(schedule.last_polled + schedule.interval - now, 0.0)
+            symbols[symbol] = {
+                "subscribers": schedule.subscribers,
+                "interval_seconds": round(schedule.interval, 2),
+                "volatility": round(schedule.volatility, 6) if schedule.volatility is not None else None,
+                "next_poll_in_seconds": round(next_in, 2)
+            }
+
+        return {
+            "market_open": self.market_open,
+            "next_market_open": None if self.market_open else next_market_open().isoformat(),
+            "base_interval_seconds": self.base_interval,
+            "budget_per_second": self.budget,
+            "budget_scale": round(self.budget_scale, 3),
+            "planned_polls_per_second": round(
+                sum(1.0 / s.interval for s in self.symbols.values() if s.interval), 3
+            ),
+            "symbols": symbols
+        }
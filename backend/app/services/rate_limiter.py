@@ -0,0 +1,115 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Dict, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Request priorities for upstream market data calls (lower value is served first)
+PRIORITY_TRADE = 0
+PRIORITY_DASHBOARD = 1
+PRIORITY_WEBSOCKET = 2
+PRIORITY_PREFETCH = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_TRADE: "trade",
+    PRIORITY_DASHBOARD: "dashboard",
+    PRIORITY_WEBSOCKET: "websocket",
+    PRIORITY_PREFETCH: "prefetch",
+}
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a caller waits longer than its timeout for a token"""
+
+
+class TokenBucketRateLimiter:
+    """Token bucket rate limiter that hands out tokens by priority.
+
+    Tokens refill continuously at ``rate`` per second up to ``capacity``.
+    When the bucket is empty callers queue up and are released strictly in
+    priority order, FIFO within a priority.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self.granted: Dict[int, int] = {priority: 0 for priority in PRIORITY_NAMES}
+
+    def _refill(self):
+        """Add the tokens accrued since the last refill"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _grant(self, priority: int):
+        self.tokens -= 1
+        self.granted[priority] = self.granted.get(priority, 0) + 1
+
+    def _dispatch(self):
+        """Release queued waiters while tokens are available"""
+        self._wakeup = None
+        self._refill()
+
+        while self._waiters and self.tokens >= 1:
+            priority, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # Waiter gave up (timeout or cancellation)
+                continue
+            self._grant(priority)
+            future.set_result(None)
+
+        # Drop abandoned waiters so they don't keep the timer alive
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+
+        if self._waiters:
+            delay = max((1 - self.tokens) / self.rate, 0.001)
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    async def acquire(self, priority: int = PRIORITY_DASHBOARD, timeout: Optional[float] = None):
+        """Wait for a token, honouring priority order"""
+        self._refill()
+
+        # Fast path: nobody queued ahead of us and a token is available
+        if not self._waiters and self.tokens >= 1:
+            self._grant(priority)
+            return
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+
+        if self._wakeup is None:
+            self._dispatch()
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise RateLimitTimeout(
+                f"Timed out waiting for upstream capacity ({PRIORITY_NAMES.get(priority, priority)})"
+            )
+
+    def get_status(self) -> Dict:
+        """Get a snapshot of the limiter state"""
+        self._refill()
+        queued: Dict[str, int] = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, future in self._waiters:
+            if not future.done():
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                queued[name] = queued.get(name, 0) + 1
+
+        return {
+            "rate": self.rate,
+            "capacity": self.capacity,
+            "available_tokens": round(self.tokens, 2),
+            "queued": queued,
+            "granted": {PRIORITY_NAMES.get(p, str(p)): n for p, n in self.granted.items()},
+        }
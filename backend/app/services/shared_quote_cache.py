@@ -0,0 +1,230 @@
+import json
+import os
+import struct
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Optional, Tuple
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, shared cache is unavailable
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"QEQUOTE1"
+HEADER = struct.Struct("<8sII")  # magic, layout version, slot count
+LAYOUT_VERSION = 1
+
+# updated_at, lease_pid, lease_expires, key_len, payload_len, key
+SLOT_HEADER = struct.Struct("<didHH48s")
+SLOT_SIZE = 512
+MAX_KEY_SIZE = 48
+MAX_PAYLOAD_SIZE = SLOT_SIZE - SLOT_HEADER.size
+MAX_PROBES = 16
+
+
+def _encode(value: Any) -> bytes:
+    """Serialize a cache value to JSON, keeping datetimes round-trippable"""
+    return json.dumps(
+        value,
+        separators=(",", ":"),
+        default=lambda o: {"__dt__": o.isoformat()} if isinstance(o, datetime) else float(o)
+    ).encode()
+
+
+def _decode(payload: bytes) -> Any:
+    """Inverse of _encode"""
+    return json.loads(
+        payload,
+        object_hook=lambda d: datetime.fromisoformat(d["__dt__"]) if "__dt__" in d else d
+    )
+
+
+class SharedQuoteCache:
+    """Quote cache living in a POSIX shared-memory segment.
+
+    Every uvicorn worker on the host attaches to the same segment, so a
+    quote fetched by one worker is served to all of them. Entries are fixed
+    size slots in an open-addressed table keyed by crc32; access is
+    serialized with an flock on a sidecar lock file. Each slot also carries
+    an upstream lease so only one process polls yfinance for a key at a time.
+    """
+
+    def __init__(self, name: str, slots: int):
+        self.name = name
+        self.slots = slots
+        self.lock_path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        size = HEADER.size + slots * SLOT_SIZE
+        with self._locked():
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+                self._format()
+            except FileExistsError:
+                self.shm = shared_memory.SharedMemory(name=name)
+                magic, version, existing_slots = HEADER.unpack_from(self.shm.buf, 0)
+                if (magic, version, existing_slots) != (MAGIC, LAYOUT_VERSION, slots) or self.shm.size < size:
+                    # Left over from an older layout: replace it
+                    logger.warning(f"Recreating shared quote cache {name} with new layout")
+                    self.shm.close()
+                    self.shm.unlink()
+                    self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+                    self._format()
+
+        # The segment outlives any single worker; keep the resource tracker
+        # from unlinking it when this process exits.
+        resource_tracker.unregister(self.shm._name, "shared_memory")
+
+    def _format(self):
+        self.shm.buf[:HEADER.size + self.slots * SLOT_SIZE] = bytes(HEADER.size + self.slots * SLOT_SIZE)
+        HEADER.pack_into(self.shm.buf, 0, MAGIC, LAYOUT_VERSION, self.slots)
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def _offset(self, index: int) -> int:
+        return HEADER.size + index * SLOT_SIZE
+
+    def _read_slot(self, index: int):
+        return SLOT_HEADER.unpack_from(self.shm.buf, self._offset(index))
+
+    def _find_slot(self, key: bytes, create: bool) -> Optional[int]:
+        """Find the slot for a key, optionally claiming one for it"""
+        start = zlib.crc32(key) % self.slots
+        oldest_index, oldest_updated = None, None
+        now = time.time()
+
+        for probe in range(MAX_PROBES):
+            index = (start + probe) % self.slots
+            updated_at, _, lease_expires, key_len, _, slot_key = self._read_slot(index)
+
+            if key_len == 0:
+                return index if create else None
+            if slot_key[:key_len] == key:
+                return index
+            if lease_expires < now and (oldest_updated is None or updated_at < oldest_updated):
+                oldest_index, oldest_updated = index, updated_at
+
+        if not create or oldest_index is None:
+            return None
+
+        # Probe window is full: evict its least recently updated entry
+        SLOT_HEADER.pack_into(self.shm.buf, self._offset(oldest_index), 0.0, 0, 0.0, 0, 0, b"")
+        return oldest_index
+
+    def get(self, cache_key: str, max_age: float) -> Optional[Tuple[Any, float]]:
+        """Get (value, written_at) if it was written less than max_age seconds ago"""
+        key = cache_key.encode()
+        with self._locked():
+            index = self._find_slot(key, create=False)
+            if index is None:
+                return None
+            updated_at, _, _, _, payload_len, _ = self._read_slot(index)
+            if payload_len == 0 or time.time() - updated_at >= max_age:
+                return None
+            start = self._offset(index) + SLOT_HEADER.size
+            payload = bytes(self.shm.buf[start:start + payload_len])
+        return _decode(payload), updated_at
+
+    def put(self, cache_key: str, value: Any):
+        """Store a value, keeping any lease on the slot"""
+        key = cache_key.encode()
+        payload = _encode(value)
+        if len(key) > MAX_KEY_SIZE or len(payload) > MAX_PAYLOAD_SIZE:
+            logger.debug(f"Value for {cache_key} too large for shared quote cache")
+            return
+
+        with self._locked():
+            index = self._find_slot(key, create=True)
+            if index is None:
+                return
+            _, lease_pid, lease_expires, _, _, _ = self._read_slot(index)
+            offset = self._offset(index)
+            SLOT_HEADER.pack_into(
+                self.shm.buf, offset,
+                time.time(), lease_pid, lease_expires, len(key), len(payload), key
+            )
+            start = offset + SLOT_HEADER.size
+            self.shm.buf[start:start + len(payload)] = payload
+
+    def try_lease(self, cache_key: str, lease_seconds: float) -> bool:
+        """Claim the right to fetch a key from upstream"""
+        key = cache_key.encode()
+        if len(key) > MAX_KEY_SIZE:
+            return True
+
+        with self._locked():
+            index = self._find_slot(key, create=True)
+            if index is None:
+                # Table saturated with live leases; don't block the caller
+                return True
+            updated_at, lease_pid, lease_expires, key_len, payload_len, _ = self._read_slot(index)
+            now = time.time()
+            pid = os.getpid()
+            if lease_pid not in (0, pid) and lease_expires > now:
+                return False
+            SLOT_HEADER.pack_into(
+                self.shm.buf, self._offset(index),
+                updated_at, pid, now + lease_seconds, len(key), payload_len, key
+            )
+            return True
+
+    def release_lease(self, cache_key: str):
+        """Give up a lease taken with try_lease"""
+        key = cache_key.encode()
+        with self._locked():
+            index = self._find_slot(key, create=False)
+            if index is None:
+                return
+            updated_at, lease_pid, _, key_len, payload_len, slot_key = self._read_slot(index)
+            if lease_pid == os.getpid():
+                SLOT_HEADER.pack_into(
+                    self.shm.buf, self._offset(index),
+                    updated_at, 0, 0.0, key_len, payload_len, slot_key
+                )
+
+    def get_status(self) -> dict:
+        """Get occupancy and lease counts for the segment"""
+        used = leased = 0
+        now = time.time()
+        with self._locked():
+            for index in range(self.slots):
+                _, lease_pid, lease_expires, key_len, _, _ = self._read_slot(index)
+                if key_len:
+                    used += 1
+                if lease_pid and lease_expires > now:
+                    leased += 1
+        return {"name": self.name, "slots": self.slots, "used_slots": used, "active_leases": leased}
+
+    def clear(self):
+        """Drop every entry in the segment"""
+        with self._locked():
+            self._format()
+
+    def close(self):
+        self.shm.close()
+        os.close(self.lock_fd)
+
+
+def create_shared_quote_cache(name: str, slots: int) -> Optional[SharedQuoteCache]:
+    """Attach to the host-wide quote cache, or return None if unavailable"""
+    if fcntl is None:
+        logger.warning("Shared quote cache needs fcntl; falling back to per-process cache")
+        return None
+    try:
+        return SharedQuoteCache(name, slots)
+    except Exception as e:
+        logger.warning(f"Could not attach shared quote cache {name}: {e}; falling back to per-process cache")
+        return None
@@ -0,0 +1,121 @@
+from array import array
+from datetime import datetime
+from typing import Dict, List, Optional
+import logging
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TickRingBuffer:
+    """Fixed-size ring buffer of (timestamp, price, volume) ticks.
+
+    Ticks live in three preallocated typed arrays, so memory per symbol is
+    fixed at ``capacity * 24`` bytes and appends never allocate.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.prices = array("d", bytes(8 * capacity))
+        self.volumes = array("q", bytes(8 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def last_timestamp(self) -> Optional[float]:
+        if self.size == 0:
+            return None
+        return self.timestamps[(self.start + self.size - 1) % self.capacity]
+
+    def append(self, timestamp: float, price: float, volume: int):
+        """Add a tick, overwriting the oldest one when full"""
+        index = (self.start + self.size) % self.capacity
+        self.timestamps[index] = timestamp
+        self.prices[index] = price
+        self.volumes[index] = volume
+
+        if self.size == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.size += 1
+
+    def _slice(self, values: array, first: int) -> List:
+        """Values from logical position ``first`` to the newest, oldest first"""
+        if first >= self.size:
+            return []
+        begin = (self.start + first) % self.capacity
+        end = (self.start + self.size) % self.capacity
+        if begin < end:
+            return values[begin:end].tolist()
+        return values[begin:].tolist() + values[:end].tolist()
+
+    def since(self, cutoff: float) -> Dict[str, List]:
+        """Ticks at or after ``cutoff`` as compact parallel arrays"""
+        # Timestamps are appended in order, so binary search the logical view
+        low, high = 0, self.size
+        while low < high:
+            mid = (low + high) // 2
+            if self.timestamps[(self.start + mid) % self.capacity] < cutoff:
+                low = mid + 1
+            else:
+                high = mid
+        first = low
+
+        return {
+            "t": self._slice(self.timestamps, first),
+            "p": self._slice(self.prices, first),
+            "v": self._slice(self.volumes, first),
+        }
+
+
+class TickHistoryService:
+    """Keeps a tick ring buffer per symbol fed by the market data loop"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.buffers: Dict[str, TickRingBuffer] = {}
+
+    def record(self, symbol: str, market_data: Dict):
+        """Store a polled quote, skipping repeats of a cached quote"""
+        timestamp = market_data.get("timestamp")
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.timestamp()
+        if timestamp is None:
+            timestamp = datetime.now().timestamp()
+
+        buffer = self.buffers.get(symbol)
+        if buffer is None:
+            buffer = TickRingBuffer(self.capacity)
+            self.buffers[symbol] = buffer
+
+        last = buffer.last_timestamp
+        if last is not None and timestamp <= last:
+            return
+
+        buffer.append(timestamp, float(market_data["price"]), int(market_data.get("volume") or 0))
+
+    def get_history(self, symbol: str, minutes: float) -> Dict:
+        """Ticks from the last ``minutes`` minutes"""
+        buffer = self.buffers.get(symbol)
+        if buffer is None:
+            return {"symbol": symbol, "t": [], "p": [], "v": []}
+
+        cutoff = datetime.now().timestamp() - minutes * 60
+        return {"symbol": symbol, **buffer.since(cutoff)}
+
+    def has_history(self, symbol: str) -> bool:
+        buffer = self.buffers.get(symbol)
+        return buffer is not None and len(buffer) > 0
+
+    def discard(self, symbol: str):
+        """Drop the buffer for a symbol nobody is subscribed to"""
+        self.buffers.pop(symbol, None)
+
+
+# Global instance
+tick_history_service = TickHistoryService(settings.tick_history_capacity)
@@ -0,0 +1,31 @@
+import base64
+import json
+import uuid
+from datetime import datetime
+from typing import Dict, Tuple
+
+
+def encode_cursor(trade: Dict) -> str:
+    """Opaque cursor for the position just after ``trade`` in history order"""
+    raw = json.dumps([trade["created_at"], trade["id"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, uuid.UUID]:
+    """The (created_at, id) a cursor points after; ValueError if it is malformed.
+
+    Cursors come back from clients, so both parts are parsed rather than
+    trusted: only a timestamp and a UUID ever reach a query filter.
+    """
+    try:
+        created_at, trade_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), uuid.UUID(trade_id)
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError("Invalid cursor")
+
+
+def after_cursor_filter(cursor: str) -> str:
+    """PostgREST ``or`` filter for trades older than the cursor, newest-first order"""
+    created_at, trade_id = decode_cursor(cursor)
+    timestamp = created_at.isoformat()
+    return f'created_at.lt."{timestamp}",and(created_at.eq."{timestamp}",id.lt.{trade_id})'
@@ -0,0 +1,305 @@
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Union
+import logging
+
+from app.services.market_data_frames import ENCODING_JSON, MarketDataBatch, MarketDataFrame
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_CONFLATE = "conflate"
+OVERFLOW_DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_CONFLATE, OVERFLOW_DISCONNECT)
+
+# Close code sent to clients that can't keep up under the disconnect policy
+SLOW_CONSUMER_CLOSE_CODE = 1008
+# Close codes for connections the server evicts or turns away
+GOING_AWAY_CLOSE_CODE = 1001
+UNAUTHORIZED_CLOSE_CODE = 1008
+TRY_AGAIN_LATER_CLOSE_CODE = 1013
+# Don't wait longer than this for a close frame to reach a dead client
+CLOSE_TIMEOUT = 5.0
+
+EVICTED_SLOW_CONSUMER = "slow_consumer"
+EVICTED_HEARTBEAT_TIMEOUT = "heartbeat_timeout"
+EVICTED_IDLE = "idle"
+
+# Queue key for heartbeats: only the newest one is worth sending
+HEARTBEAT_KEY = ("_heartbeat",)
+# Queue key for a pending protocol switch; a newer one replaces it in place
+PROTOCOL_KEY = ("_protocol",)
+
+
+class ProtocolSwitch:
+    """A protocol change waiting in the send queue.
+
+    It takes effect when the writer reaches it, so messages queued before
+    it keep the old encoding and ``ack`` goes out before any message in
+    the new one.
+    """
+
+    __slots__ = ("encoding", "deltas", "ack")
+
+    def __init__(self, encoding: str, deltas: bool, ack: str):
+        self.encoding = encoding
+        self.deltas = deltas
+        self.ack = ack
+
+
+class ClientConnection:
+    """Outbound side of one WebSocket client.
+
+    Messages are queued without awaiting and written by a dedicated writer
+    task, so a slow client only ever delays itself. Keyed messages (the
+    latest quote for a symbol) are always conflated: a newer one replaces
+    the queued one in place, so a slow consumer gets the newest value for
+    each symbol rather than a backlog. The queue is bounded; what happens
+    when it fills up with distinct messages is set by ``overflow_policy``:
+
+    - ``drop_oldest``: discard the oldest queued message
+    - ``conflate``: discard the oldest unkeyed message. Keyed messages are
+      held outside the bound, at most one per key, so the newest quote for
+      every subscribed symbol is always delivered
+    - ``disconnect``: close the connection
+
+    Quote frames are rendered at send time in the encoding the client
+    negotiated; a protocol switch is queued in order with them and is
+    never dropped. With deltas enabled a client gets the changed fields only
+    when it has seen the previous version of the symbol, and a full
+    snapshot otherwise (first frame, or after updates were dropped).
+    A batch of snapshots counts as having seen each symbol in it.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, websocket: Any, max_queue_size: int, overflow_policy: str, on_closed=None,
+                 user_key: Optional[str] = None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown WebSocket overflow policy: {overflow_policy}")
+
+        self.id = next(self._ids)
+        self.websocket = websocket
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.on_closed = on_closed
+        self.user_key = user_key
+        self.connected_at = time.monotonic()
+        self.last_received = self.connected_at
+        self.idle_since: Optional[float] = None
+        self.close_reason: Optional[str] = None
+        self.pending: "OrderedDict[Hashable, Union[str, bytes, MarketDataFrame, MarketDataBatch, ProtocolSwitch]]" = (
+            OrderedDict()
+        )
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.overflowed = False
+        self.sent_messages = 0
+        self.dropped_messages = 0
+        self.conflated_messages = 0
+        self.dropped_by_key: Dict[str, int] = {}
+        self._unkeyed = itertools.count()
+        self.queued_unkeyed = 0
+        self.encoding = ENCODING_JSON
+        self.deltas = False
+        self.last_seq: Dict[str, int] = {}
+        self.writer_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the writer task"""
+        self.writer_task = asyncio.create_task(self._writer())
+
+    def enqueue(self, message: Union[str, bytes, MarketDataFrame, MarketDataBatch, ProtocolSwitch],
+                key: Optional[Hashable] = None) -> bool:
+        """Queue a message for sending; returns False if the client is gone"""
+        if self.closed or self.overflowed:
+            return False
+
+        if key is not None and key in self.pending:
+            # Replace in place: keeps its queue position, carries the newest value
+            self.pending[key] = message
+            self.conflated_messages += 1
+            self._count_drop(key)
+            return True
+
+        if self._is_full(key):
+            if self.overflow_policy == OVERFLOW_DISCONNECT:
+                self.overflowed = True
+                self.close_reason = EVICTED_SLOW_CONSUMER
+                self.wakeup.set()
+                return False
+            self._evict()
+
+        if key is None:
+            key = ("_", next(self._unkeyed))
+            self.queued_unkeyed += 1
+        self.pending[key] = message
+        self.wakeup.set()
+        return True
+
+    def _is_full(self, key: Optional[Hashable]) -> bool:
+        if self.overflow_policy == OVERFLOW_CONFLATE:
+            # Keyed messages are bounded by the keys (subscriptions), not the queue
+            return key is None and self.queued_unkeyed >= self.max_queue_size
+        return len(self.pending) >= self.max_queue_size
+
+    def _evict(self):
+        """Make room in a full queue according to the overflow policy"""
+        if self.overflow_policy == OVERFLOW_CONFLATE:
+            victim = next(k for k in self.pending if _is_unkeyed(k))
+        else:
+            victim = next((k for k in self.pending if k != PROTOCOL_KEY), None)
+            if victim is None:
+                return
+        del self.pending[victim]
+
+        self._dequeued(victim)
+        self.dropped_messages += 1
+        self._count_drop(victim)
+
+    def _dequeued(self, key: Hashable):
+        if _is_unkeyed(key):
+            self.queued_unkeyed -= 1
+
+    def _count_drop(self, key: Hashable):
+        """Track dropped updates per key (e.g. per symbol) for monitoring"""
+        if str(key[0]).startswith("_"):
+            return
+        name = str(key[-1])
+        self.dropped_by_key[name] = self.dropped_by_key.get(name, 0) + 1
+
+    def touch(self):
+        """Record that the client sent something; any message proves liveness"""
+        self.last_received = time.monotonic()
+
+    def set_protocol(self, encoding: str, deltas: bool, ack: str) -> bool:
+        """Switch encoding after everything already queued, then send ``ack``.
+
+        The next frame per symbol after the switch is a full snapshot.
+        """
+        return self.enqueue(ProtocolSwitch(encoding, deltas, ack), PROTOCOL_KEY)
+
+    def _apply_protocol(self, switch: ProtocolSwitch) -> str:
+        self.encoding = switch.encoding
+        self.deltas = switch.deltas
+        self.last_seq.clear()
+        return switch.ack
+
+    def forget(self, symbol: str):
+        """Make the next frame for a symbol a full snapshot"""
+        self.last_seq.pop(symbol, None)
+
+    def _render(self, message: Union[str, bytes, MarketDataFrame, MarketDataBatch, ProtocolSwitch]
+                ) -> Optional[Union[str, bytes]]:
+        """Pick the wire form of a queued message; None if there is nothing new"""
+        if isinstance(message, ProtocolSwitch):
+            return self._apply_protocol(message)
+        if isinstance(message, MarketDataBatch):
+            for frame in message.frames:
+                self.last_seq[frame.symbol] = frame.seq
+            return message.encode(self.encoding)
+        if not isinstance(message, MarketDataFrame):
+            return message
+
+        last_seq = self.last_seq.get(message.symbol)
+        as_delta = False
+        if self.deltas and last_seq is not None:
+            if last_seq >= message.seq:
+                return None
+            as_delta = message.delta is not None and last_seq == message.seq - 1
+
+        self.last_seq[message.symbol] = message.seq
+        return message.encode(as_delta, self.encoding)
+
+    async def _send(self, message: Union[str, bytes]):
+        """Send on either a Starlette WebSocket or a websockets connection"""
+        if isinstance(message, bytes):
+            send = getattr(self.websocket, "send_bytes", None)
+        else:
+            send = getattr(self.websocket, "send_text", None)
+        if send is None:
+            send = self.websocket.send
+        await send(message)
+
+    async def _writer(self):
+        """Drain the queue to the socket until the connection closes"""
+        try:
+            while not self.closed:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+
+                if self.overflowed:
+                    logger.warning("Closing slow WebSocket consumer after send queue overflow")
+                    await self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+                    break
+
+                while self.pending and not self.closed:
+                    key, message = self.pending.popitem(last=False)
+                    self._dequeued(key)
+                    frame = self._render(message)
+                    if frame is None:
+                        continue
+                    await self._send(frame)
+                    self.sent_messages += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"WebSocket writer stopped: {e}")
+
+        self.closed = True
+        self._clear()
+        if self.on_closed is not None:
+            await self.on_closed(self.websocket)
+
+    async def evict(self, reason: str, code: int = GOING_AWAY_CLOSE_CODE):
+        """Close the connection from the server side.
+
+        The writer is cancelled first, since for a dead peer it may be stuck
+        in a send that will never complete.
+        """
+        if self.closed:
+            return
+        self.close_reason = reason
+        await self.close()
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), CLOSE_TIMEOUT)
+        except Exception as e:
+            logger.debug(f"Error closing evicted WebSocket: {e}")
+        if self.on_closed is not None:
+            await self.on_closed(self.websocket)
+
+    def _clear(self):
+        self.pending.clear()
+        self.queued_unkeyed = 0
+
+    async def close(self):
+        """Stop the writer task and drop anything still queued"""
+        self.closed = True
+        self._clear()
+        task = self.writer_task
+        if task is not None and task is not asyncio.current_task() and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def get_status(self) -> dict:
+        return {
+            "id": self.id,
+            "connected_seconds": round(time.monotonic() - self.connected_at, 1),
+            "last_message_seconds_ago": round(time.monotonic() - self.last_received, 1),
+            "encoding": self.encoding,
+            "deltas": self.deltas,
+            "queued": len(self.pending),
+            "sent": self.sent_messages,
+            "conflated": self.conflated_messages,
+            "dropped": self.dropped_messages,
+            "dropped_by_symbol": dict(self.dropped_by_key),
+        }
+
+
+def _is_unkeyed(key: Hashable) -> bool:
+    return key[0] == "_"
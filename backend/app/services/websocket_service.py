@@ -1,96 +1,514 @@
 import asyncio
 import json
 import logging
-from typing import Dict, Set, List
+import time
+from typing import Dict, Iterable, Set, List, Protocol
 from datetime import datetime, timedelta
 import websockets
 from websockets.server import WebSocketServerProtocol
+from app.core.config import settings
 from app.services.market_data import market_data_service
+from app.services.rate_limiter import PRIORITY_WEBSOCKET
+from app.services.tick_history import tick_history_service
+from app.services.websocket_connection import (
+    ClientConnection, EVICTED_HEARTBEAT_TIMEOUT, EVICTED_IDLE, EVICTED_SLOW_CONSUMER,
+    HEARTBEAT_KEY, TRY_AGAIN_LATER_CLOSE_CODE
+)
+from app.services.market_data_bus import create_market_data_bus, default_bus_path
+from app.services.poll_scheduler import PollScheduler
+from app.services.market_data_frames import (
+    FrameBuilder, MarketDataBatch, ENCODING_PACKED, QUOTE_FIELDS, available_encodings, dumps, encode_stats
+)
 
 logger = logging.getLogger(__name__)
 
+# Owner keys for connections without a token; many users can share an address
+ADDRESS_KEY_PREFIX = "addr:"
+
+
+class SubscriptionLimitError(ValueError):
+    """A connection asked for more symbols than it may subscribe to"""
+
+
+class ConnectionLimitError(ValueError):
+    """A new connection would exceed the global or per-user connection cap"""
+
+
+class QuoteConsumer(Protocol):
+    """Something other than a client connection that needs live quotes"""
+    
+    def symbols(self) -> Iterable[str]: ...
+    
+    def on_quote(self, symbol: str, market_data: Dict) -> None: ...
+
+
 class WebSocketService:
     """WebSocket service for real-time market data updates"""
     
     def __init__(self):
-        self.connections: Set[WebSocketServerProtocol] = set()
+        self.connections: Dict[WebSocketServerProtocol, ClientConnection] = {}
+        # Subscription index, kept in both directions so a disconnect only
+        # touches that connection's own symbols
         self.subscribed_symbols: Dict[str, Set[WebSocketServerProtocol]] = {}
-        self.update_interval = 5  # Update every 5 seconds
+        self.connection_symbols: Dict[WebSocketServerProtocol, Set[str]] = {}
+        self.user_connections: Dict[str, Set[WebSocketServerProtocol]] = {}
+        self.update_interval = 5  # Base refresh interval for a symbol with one subscriber
         self.is_running = False
         self.update_task = None
+        self.heartbeat_task = None
+        self.connection_stats = {
+            "accepted": 0,
+            "rejected_global_limit": 0,
+            "rejected_user_limit": 0,
+            "evicted_" + EVICTED_HEARTBEAT_TIMEOUT: 0,
+            "evicted_" + EVICTED_IDLE: 0,
+            "evicted_" + EVICTED_SLOW_CONSUMER: 0
+        }
+        self.frames = FrameBuilder()
+        self.quote_consumers: List[QuoteConsumer] = []
+        self.bus = None
+        self._interest_flush_scheduled = False
+        self.refresh_slots = asyncio.Semaphore(settings.websocket_refresh_concurrency)
+        self.scheduler = PollScheduler(
+            base_interval=self.update_interval,
+            min_interval=settings.websocket_min_poll_interval,
+            max_interval=settings.websocket_max_poll_interval,
+            closed_interval=settings.websocket_closed_poll_interval,
+            budget=settings.websocket_poll_budget,
+            volatility_reference=settings.websocket_volatility_reference
+        )
+        self.cycle_stats = {
+            "cycles": 0,
+            "overruns": 0,
+            "last_cycle_seconds": 0.0,
+            "max_cycle_seconds": 0.0,
+            "total_cycle_seconds": 0.0,
+            "last_symbol_count": 0
+        }
     
-    async def register(self, websocket: WebSocketServerProtocol):
-        """Register a new WebSocket connection"""
-        self.connections.add(websocket)
+    async def register(self, websocket: WebSocketServerProtocol, user_key: str = None):
+        """Register a new WebSocket connection
+        
+        ``user_key`` identifies the owner for the per-user cap. Raises
+        ConnectionLimitError, without registering, if a cap is reached.
+        """
+        self._check_connection_limits(user_key)
+        
+        client = ClientConnection(
+            websocket,
+            max_queue_size=settings.websocket_send_queue_size,
+            overflow_policy=settings.websocket_overflow_policy,
+            on_closed=self.unregister,
+            user_key=user_key
+        )
+        self.connections[websocket] = client
+        self.connection_symbols[websocket] = set()
+        if user_key is not None:
+            self.user_connections.setdefault(user_key, set()).add(websocket)
+        self.connection_stats["accepted"] += 1
+        client.start()
+        self._interest_changed()
         logger.info(f"New WebSocket connection registered. Total connections: {len(self.connections)}")
     
     async def unregister(self, websocket: WebSocketServerProtocol):
-        """Unregister a WebSocket connection"""
-        self.connections.discard(websocket)
+        """Unregister a WebSocket connection; safe to call more than once"""
+        client = self.connections.pop(websocket, None)
+        
+        # Remove from this connection's symbol subscriptions, even if the
+        # client was already gone, so no index entry outlives it
+        symbols = self.connection_symbols.pop(websocket, set())
+        for symbol in symbols:
+            self._remove_subscription(websocket, symbol)
+        
+        if client is None:
+            if symbols:
+                self._interest_changed()
+            return
+        await client.close()
+        if client.close_reason is not None:
+            self.connection_stats["evicted_" + client.close_reason] += 1
         
-        # Remove from all symbol subscriptions
-        for symbol, connections in self.subscribed_symbols.items():
-            connections.discard(websocket)
+        if client.user_key is not None:
+            owned = self.user_connections.get(client.user_key)
+            if owned is not None:
+                owned.discard(websocket)
+                if not owned:
+                    del self.user_connections[client.user_key]
         
+        self._interest_changed()
         logger.info(f"WebSocket connection unregistered. Total connections: {len(self.connections)}")
     
+    def _check_connection_limits(self, user_key: str = None):
+        if settings.websocket_max_connections and len(self.connections) >= settings.websocket_max_connections:
+            self.connection_stats["rejected_global_limit"] += 1
+            raise ConnectionLimitError("Server is at its WebSocket connection limit, try again later")
+        
+        if user_key is None:
+            return
+        if user_key.startswith(ADDRESS_KEY_PREFIX):
+            limit, owner = settings.websocket_max_connections_per_address, "address"
+        else:
+            limit, owner = settings.websocket_max_connections_per_user, "user"
+        if limit and self._owner_connections(user_key) >= limit:
+            self.connection_stats["rejected_user_limit"] += 1
+            raise ConnectionLimitError(f"Too many WebSocket connections: at most {limit} per {owner}")
+    
+    def _owner_connections(self, user_key: str) -> int:
+        """Connections an owner holds across workers.
+        
+        Other workers' counts come from their bus interest reports, so two
+        connections opened at once on different workers can both get in.
+        """
+        count = len(self.user_connections.get(user_key, ()))
+        if self.bus is not None:
+            count += self.bus.remote_connections(user_key)
+        return count
+    
+    async def _heartbeat_loop(self):
+        """Send heartbeats and evict silent or idle connections"""
+        while True:
+            await asyncio.sleep(settings.websocket_heartbeat_interval)
+            try:
+                await self._check_connections()
+            except Exception as e:
+                logger.error(f"Error in WebSocket heartbeat loop: {e}")
+    
+    async def _check_connections(self):
+        now = time.monotonic()
+        evictions = []
+        heartbeat = dumps({"type": "heartbeat", "timestamp": datetime.utcnow().isoformat()})
+        
+        for websocket, client in list(self.connections.items()):
+            if now - client.last_received > settings.websocket_heartbeat_timeout:
+                evictions.append(client.evict(EVICTED_HEARTBEAT_TIMEOUT))
+                continue
+            
+            if self.connection_symbols.get(websocket):
+                client.idle_since = None
+            elif client.idle_since is None:
+                client.idle_since = now
+            elif now - client.idle_since > settings.websocket_idle_timeout:
+                evictions.append(client.evict(EVICTED_IDLE))
+                continue
+            
+            client.enqueue(heartbeat, HEARTBEAT_KEY)
+        
+        if evictions:
+            logger.info(f"Evicting {len(evictions)} dead or idle WebSocket connection(s)")
+            await asyncio.gather(*evictions, return_exceptions=True)
+    
+    def get_connection_status(self) -> Dict:
+        """Connection caps, heartbeat settings and admission/eviction counters"""
+        return {
+            "max_connections": settings.websocket_max_connections,
+            "max_connections_per_user": settings.websocket_max_connections_per_user,
+            "max_connections_per_address": settings.websocket_max_connections_per_address,
+            "users": len(self.user_connections),
+            "heartbeat_interval": settings.websocket_heartbeat_interval,
+            "heartbeat_timeout": settings.websocket_heartbeat_timeout,
+            "idle_timeout": settings.websocket_idle_timeout,
+            **self.connection_stats
+        }
+    
+    def _interest_changed(self):
+        """Report subscriptions to the bus once the current burst of changes is done"""
+        if self.bus is None or self._interest_flush_scheduled:
+            return
+        self._interest_flush_scheduled = True
+        asyncio.get_running_loop().call_soon(self._flush_interest)
+    
+    def _flush_interest(self):
+        self._interest_flush_scheduled = False
+        if self.bus is not None:
+            symbols = {symbol: len(connections) for symbol, connections in self.subscribed_symbols.items() if connections}
+            for symbol in self._consumer_symbols():
+                symbols.setdefault(symbol, 0)
+            owners = {key: len(connections) for key, connections in self.user_connections.items()}
+            self.bus.update_interest(len(self.connections), symbols, owners)
+    
+    def register_quote_consumer(self, consumer: QuoteConsumer):
+        """Poll the consumer's symbols too and hand it every fresh quote for them.
+        
+        A consumer with an ``on_symbols_changed`` attribute is given a callback
+        to invoke whenever its symbol set changes.
+        """
+        self.quote_consumers.append(consumer)
+        if hasattr(consumer, "on_symbols_changed"):
+            consumer.on_symbols_changed = self._interest_changed
+        self._interest_changed()
+    
+    def _consumer_symbols(self) -> Set[str]:
+        symbols = set()
+        for consumer in self.quote_consumers:
+            symbols.update(consumer.symbols())
+        return symbols
+    
+    def _notify_consumers(self, symbol: str, market_data: Dict):
+        for consumer in self.quote_consumers:
+            try:
+                consumer.on_quote(symbol, market_data)
+            except Exception as e:
+                logger.error(f"Error handing quote for {symbol} to {type(consumer).__name__}: {e}")
+    
+    async def start(self):
+        """Join the worker bus and start the market data update loop"""
+        if settings.websocket_bus_enabled and self.bus is None:
+            self.bus = create_market_data_bus(
+                settings.websocket_bus_path or default_bus_path(),
+                on_quote=self._on_bus_quote,
+                on_error=self.broadcast_error
+            )
+            if self.bus is not None:
+                self.bus.start()
+                self._interest_changed()
+        
+        if self.update_task is None or self.update_task.done():
+            self.update_task = asyncio.create_task(self.start_market_data_updates())
+        if self.heartbeat_task is None or self.heartbeat_task.done():
+            self.heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+    
+    async def stop(self):
+        """Stop the update loop and leave the worker bus"""
+        await self.stop_market_data_updates()
+        if self.update_task is not None:
+            self.update_task.cancel()
+            self.update_task = None
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        if self.bus is not None:
+            await self.bus.stop()
+            self.bus = None
+    
+    async def _on_bus_quote(self, symbol: str, market_data: Dict):
+        """Fan out a quote polled by the bus leader to local subscribers"""
+        self._notify_consumers(symbol, market_data)
+        if symbol in self.subscribed_symbols:
+            tick_history_service.record(symbol, market_data)
+            await self.broadcast_to_subscribers(symbol, market_data)
+    
+    def _poll_demand(self) -> Dict[str, int]:
+        """Subscriber count per symbol this worker must fetch upstream"""
+        if self.bus is None or not self.bus.connected:
+            demand = {symbol: len(connections) for symbol, connections in self.subscribed_symbols.items()}
+        elif self.bus.is_leader:
+            # Poll for every worker, weighted by cluster-wide subscribers
+            demand = self.bus.get_status()["subscriptions"]
+            for symbol, connections in self.subscribed_symbols.items():
+                demand.setdefault(symbol, len(connections))
+        else:
+            # Followers get their quotes from the leader
+            return {}
+        for symbol in self._consumer_symbols():
+            demand.setdefault(symbol, 0)
+        return demand
+    
     async def subscribe_to_symbol(self, websocket: WebSocketServerProtocol, symbol: str):
         """Subscribe a connection to updates for a specific symbol"""
-        if symbol not in self.subscribed_symbols:
-            self.subscribed_symbols[symbol] = set()
-        
-        self.subscribed_symbols[symbol].add(websocket)
-        logger.info(f"Connection subscribed to {symbol}. Total subscribers: {len(self.subscribed_symbols[symbol])}")
+        self._check_limit(websocket, self._symbols_for(websocket) | {symbol})
+        self._add_subscription(websocket, symbol)
+        self._interest_changed()
+        logger.info(f"Connection subscribed to {symbol}. Total subscribers: {len(self.subscribed_symbols.get(symbol, ()))}")
     
     async def unsubscribe_from_symbol(self, websocket: WebSocketServerProtocol, symbol: str):
         """Unsubscribe a connection from updates for a specific symbol"""
-        if symbol in self.subscribed_symbols:
-            self.subscribed_symbols[symbol].discard(websocket)
-            if not self.subscribed_symbols[symbol]:
-                del self.subscribed_symbols[symbol]
+        if self._remove_subscription(websocket, symbol):
+            self._interest_changed()
             logger.info(f"Connection unsubscribed from {symbol}")
     
+    def _check_limit(self, websocket: WebSocketServerProtocol, symbols: Set[str]):
+        """Reject a change that would leave a connection with too many symbols"""
+        limit = settings.websocket_max_subscriptions_per_connection
+        if limit and len(symbols) > limit:
+            raise SubscriptionLimitError(
+                f"Subscription limit exceeded: at most {limit} symbols per connection"
+            )
+    
+    def _add_subscription(self, websocket: WebSocketServerProtocol, symbol: str):
+        # A handler can still be running for a connection that was already
+        # unregistered; indexing it again would leak it
+        if websocket not in self.connections:
+            return
+        if symbol not in self.subscribed_symbols:
+            self.subscribed_symbols[symbol] = set()
+        self.subscribed_symbols[symbol].add(websocket)
+        self.connection_symbols.setdefault(websocket, set()).add(symbol)
+    
+    def _remove_subscription(self, websocket: WebSocketServerProtocol, symbol: str) -> bool:
+        """Drop one subscription; returns False if there was none"""
+        client = self.connections.get(websocket)
+        if client is not None:
+            client.forget(symbol)
+        
+        symbols = self.connection_symbols.get(websocket)
+        if symbols is not None:
+            symbols.discard(symbol)
+        
+        if symbol not in self.subscribed_symbols:
+            return False
+        self.subscribed_symbols[symbol].discard(websocket)
+        if not self.subscribed_symbols[symbol]:
+            del self.subscribed_symbols[symbol]
+            tick_history_service.discard(symbol)
+            self.frames.discard(symbol)
+        return True
+    
+    def _symbols_for(self, websocket: WebSocketServerProtocol) -> Set[str]:
+        """Symbols a connection is currently subscribed to"""
+        return self.connection_symbols.get(websocket, set())
+    
+    async def subscribe_many(self, websocket: WebSocketServerProtocol, symbols: List[str]):
+        """Subscribe a connection to several symbols in one go; all or none"""
+        self._check_limit(websocket, self._symbols_for(websocket) | set(symbols))
+        for symbol in symbols:
+            self._add_subscription(websocket, symbol)
+        self._interest_changed()
+        logger.info(f"Connection subscribed to {len(symbols)} symbols")
+    
+    async def unsubscribe_many(self, websocket: WebSocketServerProtocol, symbols: List[str]):
+        """Unsubscribe a connection from several symbols in one go"""
+        removed = [symbol for symbol in symbols if self._remove_subscription(websocket, symbol)]
+        if removed:
+            self._interest_changed()
+            logger.info(f"Connection unsubscribed from {len(removed)} symbols")
+    
+    async def set_watchlist(self, websocket: WebSocketServerProtocol, symbols: List[str]):
+        """Replace a connection's subscriptions with exactly ``symbols``.
+        
+        The swap happens without yielding to the event loop, so no update
+        cycle or broadcast ever sees a half-applied watchlist.
+        Returns the (added, removed) symbols.
+        """
+        wanted = set(symbols)
+        self._check_limit(websocket, wanted)
+        current = set(self._symbols_for(websocket))
+        removed = sorted(current - wanted)
+        added = [symbol for symbol in symbols if symbol not in current]
+        
+        for symbol in removed:
+            self._remove_subscription(websocket, symbol)
+        for symbol in added:
+            self._add_subscription(websocket, symbol)
+        
+        if added or removed:
+            self._interest_changed()
+        logger.info(f"Connection watchlist set to {len(wanted)} symbols (+{len(added)} -{len(removed)})")
+        return added, removed
+    
+    async def send_snapshots(self, websocket: WebSocketServerProtocol, symbols: List[str], history_minutes: float):
+        """Send tick backfill and current quotes for newly subscribed symbols.
+        
+        Quotes are fetched concurrently and sent as one ``market_data_batch``
+        frame; symbols that fail get an individual error message.
+        """
+        if not symbols:
+            return
+        
+        # Backfill recent ticks so charts don't start empty
+        histories = [
+            tick_history_service.get_history(symbol, history_minutes)
+            for symbol in symbols if tick_history_service.has_history(symbol)
+        ]
+        if histories:
+            self.send(websocket, {
+                "type": "tick_history_batch",
+                "data": histories,
+                "timestamp": datetime.utcnow().isoformat()
+            })
+        
+        results = await asyncio.gather(
+            *(market_data_service.get_market_data(symbol, PRIORITY_WEBSOCKET) for symbol in symbols),
+            return_exceptions=True
+        )
+        
+        frames = []
+        for symbol, result in zip(symbols, results):
+            if isinstance(result, Exception):
+                self.send(websocket, {
+                    "type": "error",
+                    "symbol": symbol,
+                    "message": f"Failed to fetch market data: {str(result)}",
+                    "timestamp": datetime.utcnow().isoformat()
+                })
+                continue
+            if symbol in self.subscribed_symbols:
+                tick_history_service.record(symbol, result)
+            frames.append(self.frames.update(symbol, result))
+        
+        client = self.connections.get(websocket)
+        if client is not None and frames:
+            client.enqueue(MarketDataBatch(frames))
+    
+    def get_queue_status(self) -> Dict:
+        """Aggregate outbound queue metrics across connections"""
+        clients = list(self.connections.values())
+        lagging = sorted(
+            (client for client in clients if client.conflated_messages or client.dropped_messages),
+            key=lambda client: client.conflated_messages + client.dropped_messages,
+            reverse=True
+        )
+        return {
+            "overflow_policy": settings.websocket_overflow_policy,
+            "max_queue_size": settings.websocket_send_queue_size,
+            "queued_messages": sum(len(client.pending) for client in clients),
+            "max_queued": max((len(client.pending) for client in clients), default=0),
+            "conflated_messages": sum(client.conflated_messages for client in clients),
+            "dropped_messages": sum(client.dropped_messages for client in clients),
+            "frames_built": encode_stats["frames"],
+            "frame_encodes": encode_stats["encodes"],
+            "slowest_connections": [client.get_status() for client in lagging[:10]]
+        }
+    
+    def get_subscription_status(self) -> Dict:
+        """Subscription index sizes and the per-connection limit"""
+        per_connection = [len(symbols) for symbols in self.connection_symbols.values()]
+        return {
+            "symbols": len(self.subscribed_symbols),
+            "subscriptions": sum(per_connection),
+            "max_per_connection": max(per_connection, default=0),
+            "limit_per_connection": settings.websocket_max_subscriptions_per_connection
+        }
+    
+    def send(self, websocket: WebSocketServerProtocol, message: Dict):
+        """Queue a message for one connection"""
+        client = self.connections.get(websocket)
+        if client is not None:
+            client.enqueue(dumps(message))
+    
     async def broadcast_to_subscribers(self, symbol: str, data: Dict):
         """Broadcast market data to all subscribers of a symbol"""
         if symbol not in self.subscribed_symbols:
             return
         
-        message = json.dumps({
-            "type": "market_data",
-            "symbol": symbol,
-            "data": data,
-            "timestamp": datetime.utcnow().isoformat()
-        })
+        frame = self.frames.update(symbol, data)
         
-        # Send to all subscribers
-        disconnected = set()
+        # Queue for all subscribers; each connection's writer task encodes
+        # it in the client's protocol, sharing the encoded bytes
+        key = ("market_data", symbol)
         for websocket in self.subscribed_symbols[symbol]:
-            try:
-                await websocket.send(message)
-            except websockets.exceptions.ConnectionClosed:
-                disconnected.add(websocket)
+            client = self.connections.get(websocket)
+            if client is not None:
+                client.enqueue(frame, key)
+    
+    async def broadcast_error(self, symbol: str, error: Dict):
+        """Send an error message to all subscribers of a symbol"""
+        if symbol not in self.subscribed_symbols:
+            return
         
-        # Clean up disconnected connections
-        for websocket in disconnected:
-            await self.unregister(websocket)
+        message = dumps(error)
+        for websocket in self.subscribed_symbols[symbol]:
+            client = self.connections.get(websocket)
+            if client is not None:
+                client.enqueue(message)
     
     async def broadcast_to_all(self, message: Dict):
         """Broadcast a message to all connected clients"""
         if not self.connections:
             return
         
-        message_str = json.dumps(message)
-        disconnected = set()
-        
-        for websocket in self.connections:
-            try:
-                await websocket.send(message_str)
-            except websockets.exceptions.ConnectionClosed:
-                disconnected.add(websocket)
-        
-        # Clean up disconnected connections
-        for websocket in disconnected:
-            await self.unregister(websocket)
+        message_str = dumps(message)
+        for client in self.connections.values():
+            client.enqueue(message_str)
     
     async def start_market_data_updates(self):
         """Start the market data update loop"""
@@ -100,30 +518,83 @@ class WebSocketService:
         self.is_running = True
         logger.info("Starting market data update loop...")
         
+        loop = asyncio.get_running_loop()
+        tick = settings.websocket_min_poll_interval
+        next_cycle = loop.time()
+        
         while self.is_running:
             try:
-                # Update all subscribed symbols
-                for symbol in list(self.subscribed_symbols.keys()):
-                    try:
-                        market_data = await market_data_service.get_market_data(symbol)
-                        await self.broadcast_to_subscribers(symbol, market_data)
-                    except Exception as e:
-                        logger.error(f"Error updating market data for {symbol}: {e}")
-                        # Send error message to subscribers
-                        error_message = {
-                            "type": "error",
-                            "symbol": symbol,
-                            "message": f"Failed to fetch market data: {str(e)}",
-                            "timestamp": datetime.utcnow().isoformat()
-                        }
-                        await self.broadcast_to_subscribers(symbol, error_message)
-                
-                # Wait before next update
-                await asyncio.sleep(self.update_interval)
-                
+                # Refresh the symbols the scheduler says are due, concurrently
+                symbols = self.scheduler.due(self._poll_demand())
+                if symbols:
+                    cycle_start = loop.time()
+                    await asyncio.gather(*(self._refresh_symbol(symbol) for symbol in symbols))
+                    self._record_cycle(loop.time() - cycle_start, len(symbols))
             except Exception as e:
                 logger.error(f"Error in market data update loop: {e}")
-                await asyncio.sleep(self.update_interval)
+            
+            # Fixed-rate schedule: the scheduler is consulted every tick
+            # regardless of how long the fetches took
+            next_cycle += tick
+            now = loop.time()
+            if next_cycle < now:
+                missed = int((now - next_cycle) // tick) + 1
+                self.cycle_stats["overruns"] += 1
+                logger.warning(
+                    f"Market data cycle overran its {tick}s tick, skipping {missed} tick(s)"
+                )
+                next_cycle += missed * tick
+            await asyncio.sleep(next_cycle - now)
+    
+    async def _refresh_symbol(self, symbol: str):
+        """Fetch and broadcast one symbol, bounded by the refresh semaphore"""
+        async with self.refresh_slots:
+            try:
+                market_data = await market_data_service.get_market_data(
+                    symbol, PRIORITY_WEBSOCKET, max_age=self.scheduler.max_age(symbol)
+                )
+                self.scheduler.observe(symbol, market_data.get("price"))
+                self._notify_consumers(symbol, market_data)
+                if self.bus is not None:
+                    self.bus.publish_quote(symbol, market_data)
+                if symbol in self.subscribed_symbols:
+                    tick_history_service.record(symbol, market_data)
+                    await self.broadcast_to_subscribers(symbol, market_data)
+            except Exception as e:
+                logger.error(f"Error updating market data for {symbol}: {e}")
+                # Send error message to subscribers
+                error_message = {
+                    "type": "error",
+                    "symbol": symbol,
+                    "message": f"Failed to fetch market data: {str(e)}",
+                    "timestamp": datetime.utcnow().isoformat()
+                }
+                if self.bus is not None:
+                    self.bus.publish_error(symbol, error_message)
+                await self.broadcast_error(symbol, error_message)
+    
+    def _record_cycle(self, duration: float, symbol_count: int):
+        """Update cycle-duration metrics"""
+        stats = self.cycle_stats
+        stats["cycles"] += 1
+        stats["last_cycle_seconds"] = round(duration, 3)
+        stats["max_cycle_seconds"] = round(max(stats["max_cycle_seconds"], duration), 3)
+        stats["total_cycle_seconds"] += duration
+        stats["last_symbol_count"] = symbol_count
+        logger.debug(f"Market data cycle refreshed {symbol_count} symbols in {duration:.3f}s")
+    
+    def get_cycle_status(self) -> Dict:
+        """Get update loop timing metrics"""
+        stats = self.cycle_stats
+        return {
+            "cycles": stats["cycles"],
+            "overruns": stats["overruns"],
+            "last_cycle_seconds": stats["last_cycle_seconds"],
+            "max_cycle_seconds": stats["max_cycle_seconds"],
+            "avg_cycle_seconds": round(stats["total_cycle_seconds"] / stats["cycles"], 3) if stats["cycles"] else 0,
+            "last_symbol_count": stats["last_symbol_count"],
+            "refresh_concurrency": settings.websocket_refresh_concurrency
+        }
     
     async def stop_market_data_updates(self):
         """Stop the market data update loop"""
@@ -133,68 +604,158 @@ class WebSocketService:
     async def handle_message(self, websocket: WebSocketServerProtocol, message: str):
         """Handle incoming WebSocket messages"""
         try:
+            client = self.connections.get(websocket)
+            if client is not None:
+                client.touch()
+            
             data = json.loads(message)
             message_type = data.get("type")
             
             if message_type == "subscribe":
+                history_minutes = float(data.get("history_minutes", settings.tick_history_backfill_minutes))
+                if "symbols" in data:
+                    symbols = self._parse_symbols(websocket, data)
+                    if symbols is not None:
+                        await self.subscribe_many(websocket, symbols)
+                        await self.send_snapshots(websocket, symbols, history_minutes)
+                    return
+                
                 symbol = data.get("symbol")
                 if symbol:
                     await self.subscribe_to_symbol(websocket, symbol)
-                    # Send current market data immediately
-                    try:
-                        market_data = await market_data_service.get_market_data(symbol)
-                        await websocket.send(json.dumps({
-                            "type": "market_data",
+                    # Backfill recent ticks so charts don't start empty
+                    if tick_history_service.has_history(symbol):
+                        history = tick_history_service.get_history(symbol, history_minutes)
+                        self.send(websocket, {
+                            "type": "tick_history",
                             "symbol": symbol,
-                            "data": market_data,
+                            "data": history,
                             "timestamp": datetime.utcnow().isoformat()
-                        }))
+                        })
+                    # Send current market data immediately
+                    try:
+                        market_data = await market_data_service.get_market_data(symbol, PRIORITY_WEBSOCKET)
+                        tick_history_service.record(symbol, market_data)
+                        client = self.connections.get(websocket)
+                        if client is not None:
+                            client.forget(symbol)
+                            client.enqueue(self.frames.update(symbol, market_data), ("market_data", symbol))
                     except Exception as e:
-                        await websocket.send(json.dumps({
+                        self.send(websocket, {
                             "type": "error",
                             "symbol": symbol,
                             "message": f"Failed to fetch market data: {str(e)}",
                             "timestamp": datetime.utcnow().isoformat()
-                        }))
+                        })
             
             elif message_type == "unsubscribe":
+                if "symbols" in data:
+                    symbols = self._parse_symbols(websocket, data)
+                    if symbols is not None:
+                        await self.unsubscribe_many(websocket, symbols)
+                    return
+                
                 symbol = data.get("symbol")
                 if symbol:
                     await self.unsubscribe_from_symbol(websocket, symbol)
             
+            elif message_type == "set_watchlist":
+                symbols = self._parse_symbols(websocket, data)
+                if symbols is not None:
+                    added, removed = await self.set_watchlist(websocket, symbols)
+                    self.send(websocket, {
+                        "type": "watchlist",
+                        "symbols": symbols,
+                        "added": added,
+                        "removed": removed,
+                        "timestamp": datetime.utcnow().isoformat()
+                    })
+                    await self.send_snapshots(
+                        websocket, added,
+                        float(data.get("history_minutes", settings.tick_history_backfill_minutes))
+                    )
+            
+            elif message_type == "set_protocol":
+                encoding = data.get("encoding", "json")
+                deltas = bool(data.get("deltas", False))
+                client = self.connections.get(websocket)
+                if encoding not in available_encodings():
+                    self.send(websocket, {
+                        "type": "error",
+                        "message": f"Unsupported encoding: {encoding}. Available: {available_encodings()}",
+                        "timestamp": datetime.utcnow().isoformat()
+                    })
+                elif client is not None:
+                    reply = {
+                        "type": "protocol",
+                        "encoding": encoding,
+                        "deltas": deltas,
+                        "timestamp": datetime.utcnow().isoformat()
+                    }
+                    if encoding == ENCODING_PACKED:
+                        reply["fields"] = [name for name, _ in QUOTE_FIELDS]
+                    # Queued behind earlier frames, which keep the old encoding
+                    client.set_protocol(encoding, deltas, dumps(reply))
+            
             elif message_type == "ping":
-                await websocket.send(json.dumps({
+                self.send(websocket, {
                     "type": "pong",
                     "timestamp": datetime.utcnow().isoformat()
-                }))
+                })
+            
+            elif message_type == "pong":
+                # Heartbeat reply; receiving it already marked the client alive
+                pass
             
             else:
-                await websocket.send(json.dumps({
+                self.send(websocket, {
                     "type": "error",
                     "message": f"Unknown message type: {message_type}",
                     "timestamp": datetime.utcnow().isoformat()
-                }))
+                })
                 
+        except SubscriptionLimitError as e:
+            self.send(websocket, {
+                "type": "error",
+                "message": str(e),
+                "timestamp": datetime.utcnow().isoformat()
+            })
         except json.JSONDecodeError:
-            await websocket.send(json.dumps({
+            self.send(websocket, {
                 "type": "error",
                 "message": "Invalid JSON message",
                 "timestamp": datetime.utcnow().isoformat()
-            }))
+            })
         except Exception as e:
             logger.error(f"Error handling WebSocket message: {e}")
-            await websocket.send(json.dumps({
+            self.send(websocket, {
                 "type": "error",
                 "message": f"Internal server error: {str(e)}",
                 "timestamp": datetime.utcnow().isoformat()
-            }))
+            })
+
+    def _parse_symbols(self, websocket: WebSocketServerProtocol, data: Dict):
+        """Validated, de-duplicated ``symbols`` list from a message; None after replying with an error"""
+        symbols = data.get("symbols")
+        if not isinstance(symbols, list) or not all(isinstance(symbol, str) and symbol for symbol in symbols):
+            self.send(websocket, {
+                "type": "error",
+                "message": "'symbols' must be a list of symbol strings",
+                "timestamp": datetime.utcnow().isoformat()
+            })
+            return None
+        return list(dict.fromkeys(symbols))
 
 # Global WebSocket service instance
 websocket_service = WebSocketService()
 
 async def websocket_handler(websocket: WebSocketServerProtocol, path: str):
     """WebSocket connection handler"""
-    await websocket_service.register(websocket)
+    try:
+        await websocket_service.register(websocket, f"{ADDRESS_KEY_PREFIX}{websocket.remote_address[0]}")
+    except ConnectionLimitError as e:
+        await websocket.close(code=TRY_AGAIN_LATER_CLOSE_CODE, reason=str(e))
+        return
     
     try:
         async for message in websocket:
@@ -209,9 +770,13 @@ async def start_websocket_server(host: str = "localhost", port: int = 8765):
     logger.info(f"Starting WebSocket server on {host}:{port}")
     
     # Start market data update loop
-    asyncio.create_task(websocket_service.start_market_data_updates())
+    await websocket_service.start()
     
     # Start WebSocket server
-    async with websockets.serve(websocket_handler, host, port):
+    async with websockets.serve(
+        websocket_handler, host, port,
+        ping_interval=settings.websocket_heartbeat_interval,
+        ping_timeout=settings.websocket_heartbeat_timeout
+    ):
         logger.info(f"WebSocket server started on {host}:{port}")
         await asyncio.Future()  # Run forever
@@ -0,0 +1,60 @@
+import pytest
+
+from app.services import circuit_breaker
+from app.services.circuit_breaker import (
+    CircuitBreaker, STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, allow_all
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", lambda: now[0])
+    return now
+
+
+def opened(name, clock, recovery_timeout=30.0):
+    breaker = CircuitBreaker(name, failure_threshold=1, recovery_timeout=recovery_timeout)
+    breaker.record_failure()
+    assert breaker.state == STATE_OPEN
+    return breaker
+
+
+def test_would_allow_does_not_claim_the_trial(clock):
+    breaker = opened("TCS.NS", clock)
+    assert not breaker.would_allow()
+
+    clock[0] += 30
+    assert breaker.would_allow()
+    assert breaker.would_allow()
+    assert breaker.state == STATE_OPEN
+
+    assert breaker.allow()
+    assert breaker.state == STATE_HALF_OPEN
+    assert not breaker.would_allow()
+    assert not breaker.allow()
+
+
+def test_refusing_breaker_keeps_the_other_trial(clock):
+    symbol = opened("TCS.NS", clock)
+    clock[0] += 30
+    upstream = opened("global", clock, recovery_timeout=60.0)
+
+    assert not allow_all(upstream, symbol)
+    assert not allow_all(symbol, upstream)
+    assert symbol.state == STATE_OPEN
+    assert upstream.rejected_calls == 2
+    assert symbol.rejected_calls == 0
+
+    # The symbol's trial is still there once the global breaker recovers
+    clock[0] += 60
+    assert allow_all(upstream, symbol)
+    assert symbol.state == STATE_HALF_OPEN
+    assert upstream.state == STATE_HALF_OPEN
+    symbol.record_success()
+    upstream.record_success()
+    assert symbol.state == upstream.state == STATE_CLOSED
+
+
+def test_allow_all_with_closed_breakers(clock):
+    assert allow_all(CircuitBreaker("a", 1, 30.0), CircuitBreaker("b", 1, 30.0))
@@ -0,0 +1,265 @@
+"""Runs the paper trading SQL from SETUP_GUIDE.md against a throwaway Postgres.
+
+Uses ``TEST_DATABASE_URL`` if set (the tests work in a fresh schema there),
+otherwise starts a temporary cluster with ``initdb`` and ``pg_ctl`` from
+PATH. Skipped when neither is available.
+"""
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import uuid
+from decimal import Decimal
+from pathlib import Path
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+from psycopg2.extras import Json
+
+SETUP_GUIDE = Path(__file__).resolve().parents[2] / "SETUP_GUIDE.md"
+INITIAL_CASH = 100000
+
+
+def paper_trading_sql() -> list:
+    """The SQL blocks of the guide's paper trading section, in order"""
+    guide = SETUP_GUIDE.read_text()
+    start = guide.index("### 2. Paper Trading Tables and Functions")
+    end = guide.index("\n## ", start)
+    return re.findall(r"```sql\n(.*?)```", guide[start:end], re.S)
+
+
+def _temporary_cluster():
+    if not shutil.which("initdb") or not shutil.which("pg_ctl"):
+        pytest.skip("needs TEST_DATABASE_URL, or initdb and pg_ctl on PATH")
+    if os.geteuid() == 0:
+        pytest.skip("PostgreSQL refuses to run as root")
+
+    directory = tempfile.mkdtemp(prefix="paper-trading-pg-")
+    data = os.path.join(directory, "data")
+    subprocess.run(["initdb", "-D", data, "-U", "postgres", "-A", "trust", "-E", "UTF8", "--locale", "C"],
+                   check=True, capture_output=True)
+    subprocess.run(["pg_ctl", "-D", data, "-w", "-l", os.path.join(directory, "log"),
+                    "-o", f"-c listen_addresses='' -k {directory}", "start"],
+                   check=True, capture_output=True)
+    return directory, data
+
+
+@pytest.fixture(scope="module")
+def conn():
+    url = os.environ.get("TEST_DATABASE_URL")
+    directory = data = None
+    if url:
+        connection = psycopg2.connect(url)
+        schema = f"paper_trading_test_{uuid.uuid4().hex[:8]}"
+        connection.autocommit = True
+        with connection.cursor() as cur:
+            cur.execute(f"CREATE SCHEMA {schema}")
+            cur.execute(f"SET search_path TO {schema}, public")
+    else:
+        directory, data = _temporary_cluster()
+        connection = psycopg2.connect(host=directory, user="postgres", dbname="postgres")
+        connection.autocommit = True
+
+    # The guide's error messages use the rupee sign
+    connection.set_client_encoding("UTF8")
+    try:
+        with connection.cursor() as cur:
+            for block in paper_trading_sql():
+                cur.execute(block)
+        yield connection
+    finally:
+        if url:
+            with connection.cursor() as cur:
+                cur.execute(f"DROP SCHEMA {schema} CASCADE")
+        connection.close()
+        if data:
+            subprocess.run(["pg_ctl", "-D", data, "-m", "immediate", "stop"], capture_output=True)
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def trade(symbol, action, quantity, price, created_at=None, **fields):
+    return {
+        "id": str(uuid.uuid4()),
+        "symbol": symbol,
+        "action": action,
+        "quantity": quantity,
+        "price": price,
+        "order_type": "market",
+        "created_at": created_at,
+        **fields
+    }
+
+
+def book(conn, user_id, trades):
+    with conn.cursor() as cur:
+        cur.execute("SELECT execute_paper_trades(%s, %s, %s)", (user_id, Json(trades), INITIAL_CASH))
+        return cur.fetchone()[0]
+
+
+def query(conn, sql, *params):
+    with conn.cursor() as cur:
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+
+def cash(conn, user_id):
+    rows = query(conn, "SELECT cash_balance FROM user_portfolios WHERE user_id = %s", user_id)
+    return rows[0][0] if rows else None
+
+
+def position(conn, user_id, symbol):
+    rows = query(conn, "SELECT quantity, avg_price FROM paper_positions WHERE user_id = %s AND symbol = %s",
+                 user_id, symbol)
+    return rows[0] if rows else None
+
+
+def lots(conn, user_id, symbol):
+    return query(conn, "SELECT quantity, price FROM paper_position_lots "
+                       "WHERE user_id = %s AND symbol = %s ORDER BY id", user_id, symbol)
+
+
+def stats(conn, user_id):
+    with conn.cursor() as cur:
+        cur.execute("SELECT * FROM paper_trading_stats WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
+        return dict(zip([column.name for column in cur.description], row)) if row else None
+
+
+@pytest.fixture
+def user_id():
+    return str(uuid.uuid4())
+
+
+def test_buy_opens_position_and_lot(conn, user_id):
+    buy = trade("TCS", "buy", 10, 350.5, notes="first")
+
+    result = book(conn, user_id, [buy])
+
+    assert Decimal(str(result["cash_balance"])) == INITIAL_CASH - Decimal("3505.0")
+    assert cash(conn, user_id) == INITIAL_CASH - Decimal("3505.0")
+    assert position(conn, user_id, "TCS") == (10, Decimal("350.5"))
+    assert lots(conn, user_id, "TCS") == [(10, Decimal("350.5"))]
+    assert query(conn, "SELECT status, total_value, realized_pnl, notes FROM paper_trading_trades WHERE id = %s",
+                 buy["id"]) == [("executed", Decimal("3505.0"), None, "first")]
+
+
+def test_partial_sell_realizes_fifo_pnl(conn, user_id):
+    book(conn, user_id, [trade("INFY", "buy", 10, 100), trade("INFY", "buy", 10, 120)])
+    assert position(conn, user_id, "INFY") == (20, 110)
+
+    sell = trade("INFY", "sell", 15, 130)
+    book(conn, user_id, [sell])
+
+    # 10 from the 100 lot and 5 from the 120 lot
+    assert query(conn, "SELECT realized_pnl FROM paper_trading_trades WHERE id = %s", sell["id"]) == [(350,)]
+    assert position(conn, user_id, "INFY") == (5, 110)
+    assert lots(conn, user_id, "INFY") == [(5, 120)]
+    assert cash(conn, user_id) == INITIAL_CASH - 2200 + 1950
+
+
+def test_full_sell_closes_position_and_lots(conn, user_id):
+    book(conn, user_id, [trade("SBIN", "buy", 4, 500), trade("SBIN", "buy", 6, 520)])
+
+    sell = trade("SBIN", "sell", 10, 510)
+    book(conn, user_id, [sell])
+
+    assert position(conn, user_id, "SBIN") is None
+    assert lots(conn, user_id, "SBIN") == []
+    assert query(conn, "SELECT realized_pnl FROM paper_trading_trades WHERE id = %s", sell["id"]) == [(-20,)]
+    assert cash(conn, user_id) == INITIAL_CASH - 5120 + 5100
+
+
+def test_sell_without_lots_closes_at_average_price(conn, user_id):
+    # A position from before lots were tracked
+    query(conn, "INSERT INTO paper_positions (user_id, symbol, quantity, avg_price) "
+                "VALUES (%s, 'ITC', 10, 400) RETURNING id", user_id)
+
+    sell = trade("ITC", "sell", 4, 450)
+    book(conn, user_id, [sell])
+
+    assert query(conn, "SELECT realized_pnl FROM paper_trading_trades WHERE id = %s", sell["id"]) == [(200,)]
+    assert position(conn, user_id, "ITC") == (6, 400)
+
+
+def test_insufficient_funds_raises_and_books_nothing(conn, user_id):
+    with pytest.raises(psycopg2.Error) as excinfo:
+        book(conn, user_id, [trade("TCS", "buy", 1, 100), trade("TCS", "buy", 1000, 100)])
+
+    assert excinfo.value.pgcode == "P0001"
+    assert "Insufficient funds" in excinfo.value.pgerror
+    assert cash(conn, user_id) is None
+    assert position(conn, user_id, "TCS") is None
+    assert query(conn, "SELECT count(*) FROM paper_trading_trades WHERE user_id = %s", user_id) == [(0,)]
+    assert stats(conn, user_id) is None
+
+
+def test_insufficient_shares_raises_and_keeps_position(conn, user_id):
+    book(conn, user_id, [trade("HDFCBANK", "buy", 5, 1600)])
+
+    with pytest.raises(psycopg2.Error) as excinfo:
+        book(conn, user_id, [trade("HDFCBANK", "sell", 6, 1650)])
+
+    assert excinfo.value.pgcode == "P0001"
+    assert "Insufficient shares" in excinfo.value.pgerror
+    assert position(conn, user_id, "HDFCBANK") == (5, 1600)
+    assert lots(conn, user_id, "HDFCBANK") == [(5, 1600)]
+    assert cash(conn, user_id) == INITIAL_CASH - 8000
+
+
+def test_replayed_trade_is_skipped(conn, user_id):
+    buy = trade("WIPRO", "buy", 10, 250, created_at="2026-03-02T10:00:00")
+    book(conn, user_id, [buy])
+
+    # A write-behind batch retried after the first attempt committed
+    book(conn, user_id, [buy, trade("WIPRO", "buy", 2, 260, created_at="2026-03-02T11:00:00")])
+    book(conn, user_id, [buy])
+
+    assert cash(conn, user_id) == INITIAL_CASH - 2500 - 520
+    quantity, avg_price = position(conn, user_id, "WIPRO")
+    assert quantity == 12 and round(avg_price, 4) == Decimal("251.6667")
+    assert len(lots(conn, user_id, "WIPRO")) == 2
+    assert query(conn, "SELECT count(*) FROM paper_trading_trades WHERE user_id = %s", user_id) == [(2,)]
+    assert stats(conn, user_id)["total_trades"] == 2
+    assert query(conn, "SELECT trades FROM paper_trading_days WHERE user_id = %s", user_id) == [(2,)]
+
+
+def test_stats_and_days_track_each_trade(conn, user_id):
+    book(conn, user_id, [
+        trade("TCS", "buy", 10, 100, created_at="2026-03-02T09:30:00"),
+        trade("TCS", "buy", 10, 110, created_at="2026-03-02T10:30:00"),
+        trade("INFY", "buy", 5, 200, created_at="2026-03-02T11:30:00"),
+    ])
+    book(conn, user_id, [
+        trade("TCS", "sell", 10, 130, created_at="2026-03-03T09:30:00"),
+        trade("INFY", "sell", 5, 180, created_at="2026-03-03T10:30:00"),
+    ])
+
+    assert query(conn, "SELECT day::TEXT, trades FROM paper_trading_days WHERE user_id = %s ORDER BY day",
+                 user_id) == [("2026-03-02", 3), ("2026-03-03", 2)]
+
+    row = stats(conn, user_id)
+    assert row["total_trades"] == 5
+    assert row["total_volume"] == 1000 + 1100 + 1000 + 1300 + 900
+    assert row["symbol_counts"] == {"TCS": 3, "INFY": 2}
+    assert row["most_traded_symbol"] == "TCS"
+    assert row["trading_days"] == 2
+    assert row["closed_trades"] == 2
+    assert row["winning_trades"] == 1
+    assert row["losing_trades"] == 1
+    assert row["realized_pnl"] == 300 - 100
+    assert row["best_trade"] == 300
+    assert row["worst_trade"] == -100
+
+    # INFY overtakes TCS; a third day is counted once however many trades it has
+    book(conn, user_id, [
+        trade("INFY", "buy", 1, 190, created_at="2026-03-04T09:30:00"),
+        trade("INFY", "buy", 1, 190, created_at="2026-03-04T10:30:00"),
+    ])
+    row = stats(conn, user_id)
+    assert row["symbol_counts"] == {"TCS": 3, "INFY": 4}
+    assert row["most_traded_symbol"] == "INFY"
+    assert row["trading_days"] == 3
+    assert row["closed_trades"] == 2
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+from app.services.market_data_bus import create_market_data_bus
+
+
+async def nothing(symbol, data):
+    pass
+
+
+async def wait_for(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("condition not met in time")
+        await asyncio.sleep(0.01)
+
+
+def test_connection_owners_are_shared_across_workers():
+    path = os.path.join(tempfile.mkdtemp(), "bus.sock")
+    leader = create_market_data_bus(path, nothing, nothing)
+    follower = create_market_data_bus(path, nothing, nothing)
+    if leader is None:
+        pytest.skip("needs Unix sockets and flock")
+    # Both workers run in this process; tell them apart as the bus would by pid
+    follower.pid = leader.pid + 1
+
+    async def scenario():
+        leader.start()
+        await wait_for(lambda: leader.is_leader)
+        follower.start()
+        await wait_for(lambda: follower.connected)
+
+        leader.update_interest(2, {}, {"user:a": 2})
+        follower.update_interest(3, {}, {"user:a": 1, "addr:10.0.0.1": 2})
+        await wait_for(lambda: leader.remote_connections("user:a") == 1)
+        await wait_for(lambda: follower.remote_connections("user:a") == 2)
+
+        assert leader.remote_connections("addr:10.0.0.1") == 2
+        assert follower.remote_connections("addr:10.0.0.1") == 0
+        assert leader.remote_connections("user:b") == 0
+        assert leader.get_status()["total_connections"] == 5
+
+        await follower.stop()
+        await wait_for(lambda: leader.remote_connections("user:a") == 0)
+        await leader.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,133 @@
+import asyncio
+
+from app.services.order_book import ORDER_LIMIT, ORDER_STOP, OrderMatchingEngine, RestingOrder
+
+
+def order(id, action, order_type, trigger_price, symbol="TCS", user_id="user-1"):
+    return RestingOrder(id, user_id, symbol, action, order_type, 1, trigger_price, None, "2026-03-02T10:00:00")
+
+
+def run_quotes(orders, prices, cancel=(), symbol="TCS"):
+    """Rest ``orders``, cancel some, feed ``prices``; returns (engine, filled ids in fill order)"""
+    filled = []
+
+    async def on_fill(resting, price):
+        filled.append((resting.id, price))
+
+    async def scenario():
+        engine = OrderMatchingEngine(on_fill)
+        for resting in orders:
+            engine.add(resting)
+        for order_id in cancel:
+            engine.cancel(order_id)
+        for price in prices:
+            engine.on_quote(symbol, {"price": price})
+            await asyncio.gather(*engine.fill_tasks)
+        return engine
+
+    engine = asyncio.run(scenario())
+    return engine, filled
+
+
+def test_buy_limits_fill_best_price_then_arrival_order():
+    orders = [
+        order("a", "buy", ORDER_LIMIT, 100),
+        order("b", "buy", ORDER_LIMIT, 100),
+        order("c", "buy", ORDER_LIMIT, 101),
+        order("d", "buy", ORDER_LIMIT, 99),
+    ]
+    engine, filled = run_quotes(orders, [100.5, 99.5])
+
+    assert filled == [("c", 100.5), ("a", 99.5), ("b", 99.5)]
+    assert [resting.id for resting in engine.orders_for("user-1")] == ["d"]
+
+
+def test_sell_limits_fill_lowest_price_first():
+    orders = [
+        order("a", "sell", ORDER_LIMIT, 110),
+        order("b", "sell", ORDER_LIMIT, 108),
+        order("c", "sell", ORDER_LIMIT, 112),
+    ]
+    _, filled = run_quotes(orders, [111])
+
+    assert filled == [("b", 111), ("a", 111)]
+
+
+def test_stops_trigger_when_the_market_moves_through_them():
+    def orders():
+        return [
+            order("buy-stop", "buy", ORDER_STOP, 105),
+            order("sell-stop", "sell", ORDER_STOP, 95),
+            order("buy-limit", "buy", ORDER_LIMIT, 95),
+            order("sell-limit", "sell", ORDER_LIMIT, 105),
+        ]
+
+    _, filled = run_quotes(orders(), [104, 96])
+    assert filled == []
+
+    _, filled = run_quotes(orders(), [105])
+    assert sorted(filled) == [("buy-stop", 105), ("sell-limit", 105)]
+
+    _, filled = run_quotes(orders(), [95])
+    assert sorted(filled) == [("buy-limit", 95), ("sell-stop", 95)]
+
+
+def test_sell_stops_trigger_highest_price_first():
+    orders = [
+        order("low", "sell", ORDER_STOP, 90),
+        order("high", "sell", ORDER_STOP, 95),
+    ]
+    _, filled = run_quotes(orders, [89])
+
+    assert filled == [("high", 89), ("low", 89)]
+
+
+def test_cancelled_orders_are_skipped_when_reached():
+    orders = [
+        order("a", "buy", ORDER_LIMIT, 100),
+        order("b", "buy", ORDER_LIMIT, 100),
+        order("c", "buy", ORDER_LIMIT, 101),
+    ]
+    engine, filled = run_quotes(orders, [99], cancel=["a", "c"])
+
+    assert filled == [("b", 99)]
+    assert engine.stats["cancelled"] == 2
+    assert engine.stats["triggered"] == 1
+    assert not engine.orders
+    assert list(engine.symbols()) == []
+
+
+def test_cancelled_head_does_not_hide_a_crossed_level():
+    orders = [
+        order("a", "buy", ORDER_LIMIT, 100),
+        order("b", "buy", ORDER_LIMIT, 100),
+    ]
+    _, filled = run_quotes(orders, [100], cancel=["a"])
+
+    assert filled == [("b", 100)]
+
+
+def test_cancelling_the_last_order_drops_the_symbol():
+    changes = []
+
+    async def on_fill(resting, price):
+        pass
+
+    engine = OrderMatchingEngine(on_fill)
+    engine.on_symbols_changed = lambda: changes.append(sorted(engine.symbols()))
+    engine.add(order("a", "buy", ORDER_LIMIT, 100))
+    engine.add(order("b", "buy", ORDER_LIMIT, 101))
+
+    assert engine.cancel("a") is not None
+    assert engine.cancel("a") is None
+    assert list(engine.symbols()) == ["TCS"]
+    engine.cancel("b")
+
+    assert changes == [["TCS"], []]
+    assert engine.get_status()["resting_orders"] == 0
+
+
+def test_quotes_for_other_symbols_do_not_match():
+    _, filled = run_quotes([order("a", "buy", ORDER_LIMIT, 100)], [90], symbol="INFY")
+
+    assert filled == []
@@ -0,0 +1,39 @@
+import base64
+import json
+import uuid
+
+import pytest
+
+from app.services.trade_cursor import after_cursor_filter, decode_cursor, encode_cursor
+
+
+def raw_cursor(created_at, trade_id) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created_at, trade_id]).encode()).decode()
+
+
+def test_cursor_round_trip():
+    trade_id = str(uuid.uuid4())
+    cursor = encode_cursor({"created_at": "2026-03-02T10:00:00.123456", "id": trade_id})
+
+    assert after_cursor_filter(cursor) == (
+        'created_at.lt."2026-03-02T10:00:00.123456",'
+        f'and(created_at.eq."2026-03-02T10:00:00.123456",id.lt.{trade_id})'
+    )
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"not json").decode(),
+    base64.urlsafe_b64encode(b'{"created_at": "2026-03-02"}').decode(),
+    raw_cursor("2026-03-02T10:00:00", "not-a-uuid"),
+    raw_cursor("2026-03-02T10:00:00", None),
+    raw_cursor(12345, str(uuid.uuid4())),
+    # Closing the quote to smuggle in extra filter terms
+    raw_cursor('2026-03-02T10:00:00",user_id.neq.00000000-0000-0000-0000-000000000000', str(uuid.uuid4())),
+    raw_cursor("2026-03-02T10:00:00", f"{uuid.uuid4()}),user_id.neq.x"),
+])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(cursor)
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        after_cursor_filter(cursor)
@@ -0,0 +1,81 @@
+import asyncio
+import json
+from typing import get_args
+
+import pytest
+
+from app.services.market_data_frames import ENCODING_PACKED, FrameBuilder, PACKED_HEADER, PACKED_SNAPSHOT
+from app.services.websocket_connection import ClientConnection, OVERFLOW_DROP_OLDEST, OVERFLOW_POLICIES
+
+
+class RecordingSocket:
+    """Collects what the writer sends, in order"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, message):
+        self.sent.append(message)
+
+    async def send_bytes(self, message):
+        self.sent.append(message)
+
+    async def close(self, code=1000):
+        pass
+
+
+def quote(price):
+    return {"price": price, "change": 0.0, "change_percent": 0.0, "volume": 100,
+            "high": price, "low": price, "open": price, "previous_close": price}
+
+
+async def drain(connection: ClientConnection):
+    connection.start()
+    for _ in range(10):
+        await asyncio.sleep(0)
+    await connection.close()
+
+
+def test_protocol_switch_is_ordered_with_queued_frames():
+    socket = RecordingSocket()
+    connection = ClientConnection(socket, max_queue_size=16, overflow_policy=OVERFLOW_DROP_OLDEST)
+    frames = FrameBuilder()
+
+    connection.enqueue(frames.update("TCS", quote(100.0)), ("market_data", "TCS"))
+    connection.set_protocol(ENCODING_PACKED, False, json.dumps({"type": "protocol", "encoding": "packed"}))
+    connection.enqueue(frames.update("INFY", quote(200.0)), ("market_data", "INFY"))
+    asyncio.run(drain(connection))
+
+    before, ack, after = socket.sent
+    assert json.loads(before)["symbol"] == "TCS"
+    assert json.loads(ack)["type"] == "protocol"
+    assert isinstance(after, bytes)
+    assert PACKED_HEADER.unpack_from(after)[0] == PACKED_SNAPSHOT
+    assert connection.encoding == ENCODING_PACKED
+
+
+def test_protocol_switch_survives_overflow():
+    socket = RecordingSocket()
+    connection = ClientConnection(socket, max_queue_size=2, overflow_policy=OVERFLOW_DROP_OLDEST)
+
+    connection.set_protocol(ENCODING_PACKED, False, "ack")
+    for i in range(5):
+        connection.enqueue(f"message {i}")
+    asyncio.run(drain(connection))
+
+    assert socket.sent == ["ack", "message 4"]
+
+
+def test_bad_overflow_policy_fails_at_startup(monkeypatch):
+    pytest.importorskip("pydantic_settings")
+    from pydantic import ValidationError
+    for name in ("SUPABASE_URL", "SUPABASE_ANON_KEY", "SUPABASE_SERVICE_ROLE_KEY"):
+        monkeypatch.setenv(name, "test")
+    from app.core.config import Settings
+
+    field = Settings.model_fields["websocket_overflow_policy"]
+    assert set(get_args(field.annotation)) == set(OVERFLOW_POLICIES)
+
+    monkeypatch.setenv("WEBSOCKET_OVERFLOW_POLICY", "drop-oldest")
+    with pytest.raises(ValidationError, match="websocket_overflow_policy"):
+        Settings()